@@ -0,0 +1,144 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Benchmarks the download engine against a local HTTP server.
+
+Compares the download engine with the previous approach of iterating over
+8 KiB chunks with requests. Requires that the package is installed, e.g.:
+
+    make benchmark ARGS="--size-mib 1024 --rounds 3"
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from gen_vm_image.utils.net import _download_file
+
+
+def make_handler(size, chunked):
+    block = os.urandom(1024 * 1024)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.send_header("Content-Length", str(size))
+            self.end_headers()
+            remaining = size
+            while remaining > 0:
+                chunk = block[: min(len(block), remaining)]
+                if chunked:
+                    self.wfile.write(b"%x\r\n" % len(chunk))
+                self.wfile.write(chunk)
+                if chunked:
+                    self.wfile.write(b"\r\n")
+                remaining -= len(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def iter_content_download(url, output_path, chunk_size=8192):
+    with open(output_path, "wb") as _file:
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            total = int(r.headers.get("content-length", 0))
+            downloaded = 0
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                downloaded += len(chunk)
+                "{:.2f}%".format((downloaded / total) * 100)
+                _file.write(chunk)
+    return True, {}
+
+
+def bench(name, func, url, output_path, size, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        downloaded, response = func(url, output_path)
+        timings.append(time.perf_counter() - start)
+        if not downloaded:
+            raise RuntimeError(response["msg"])
+        assert os.path.getsize(output_path) == size
+        os.remove(output_path)
+    best = min(timings)
+    print(
+        "{:<28} best {:7.3f}s  {:9.1f} MiB/s".format(
+            name, best, size / best / (1024 * 1024)
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mib", type=int, default=1024)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    size = args.size_mib * 1024 * 1024
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for chunked in (False, True):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(size, chunked))
+            server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 << 20)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = "http://127.0.0.1:{}/image".format(server.server_address[1])
+            output_path = os.path.join(tmp_dir, "image")
+            suffix = " (chunked)" if chunked else ""
+            try:
+                if not chunked:
+                    # The previous implementation fails without a Content-Length
+                    bench(
+                        "iter_content 8 KiB" + suffix,
+                        iter_content_download,
+                        url,
+                        output_path,
+                        size,
+                        args.rounds,
+                    )
+                bench(
+                    "download engine" + suffix,
+                    _download_file,
+                    url,
+                    output_path,
+                    size,
+                    args.rounds,
+                )
+            finally:
+                server.shutdown()
+                server.server_close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
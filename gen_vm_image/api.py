@@ -13,9 +13,12 @@ def api():
 
     for action in parser._actions:
         if isinstance(action, argparse._StoreAction):
-            # Strip the leading double dash
-            striped_key = action.option_strings[1].strip("--")
-            key = striped_key.replace("-", "_")
+            # Strip the leading double dash of the long option,
+            # since some options don't have a short form
+            long_option = [
+                option for option in action.option_strings if option.startswith("--")
+            ][0]
+            key = long_option[2:].replace("-", "_")
             default_options[key] = action.default
         if isinstance(action, PositionalArgumentsAction):
             default_args.append(action.dest)
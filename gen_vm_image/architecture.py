@@ -14,11 +14,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import asyncio
+import hashlib
+import itertools
+import json
 import os
 
 import yaml
 
 from gen_vm_image.common.codes import (
+    ARCHITECTURE_VALIDATION_ERROR_MSG,
+    CHECKSUM_ERROR,
     INVALID_ATTRIBUTE_TYPE_ERROR,
     INVALID_ATTRIBUTE_TYPE_ERROR_MSG,
     MISSING_ATTRIBUTE_ERROR,
@@ -29,11 +35,58 @@ from gen_vm_image.common.codes import (
     PATH_LOAD_ERROR_MSG,
     PATH_NOT_FOUND_ERROR,
     PATH_NOT_FOUND_ERROR_MSG,
+    SHARD_ERROR,
+    SHARD_ERROR_MSG,
     SUCCESS,
 )
-from gen_vm_image.common.defaults import DEFAULT_BUFFER_SIZE, GENERATED_IMAGE_DIR
-from gen_vm_image.image import generate_image
-from gen_vm_image.utils.io import exists, load, makedirs
+from gen_vm_image.common.defaults import (
+    DEFAULT_ARCHITECTURE_JOBS,
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_CONVERT_JOBS,
+    DEFAULT_HASH_JOBS,
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_NETWORK_JOBS,
+    DEFAULT_PROGRESS_FD,
+    DEFAULT_RETRIES,
+    DEFAULT_RETRY_BACKOFF,
+    DEFAULTS,
+    GENERATED_IMAGE_DIR,
+    MATRIX,
+    MATRIX_EXCLUDE,
+    MATRIX_IMAGE_ATTRIBUTES,
+    PLAN_INPUT_MISSING,
+    RETRY_STAGES,
+    SCHEDULER_CONVERT,
+    TMP_DIR,
+)
+from gen_vm_image.image import (
+    convert_image,
+    estimate_image_size,
+    generate_image,
+    image_output_path,
+    prepare_input,
+)
+from gen_vm_image.plan import plan_groups
+from gen_vm_image.shard import (
+    describe_shards,
+    new_shard_report,
+    parse_shard,
+    plan_shards,
+    write_shard_report,
+)
+from gen_vm_image.utils.io import exists, load, makedirs, remove
+from gen_vm_image.utils.job import priority_verbose_outputs
+from gen_vm_image.utils.lock import FileLock
+from gen_vm_image.utils.manifest import ChecksumManifests, OutputManifest
+from gen_vm_image.utils.net import http_session
+from gen_vm_image.utils.progress import new_progress_reporter, stage, stage_callback
+from gen_vm_image.utils.retry import Retrier, retry_verbose_outputs
+from gen_vm_image.utils.scheduler import ResourceScheduler, reserved, scheduled
+from gen_vm_image.utils.throttle import new_bandwidth, parse_bandwidth
+
+# Use the libyaml backed loader if it is available since it is
+# considerably faster than the pure-Python one for large architecture files
+ArchitectureLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 def load_architecture(architecture_path):
@@ -45,7 +98,7 @@ def load_architecture(architecture_path):
         )
         return False, response
 
-    architecture = load(architecture_path, handler=yaml, Loader=yaml.FullLoader)
+    architecture = load(architecture_path, handler=yaml, Loader=ArchitectureLoader)
     if not architecture:
         response["error_code"] = PATH_LOAD_ERROR
         response["msg"] = PATH_LOAD_ERROR_MSG.format(
@@ -56,109 +109,374 @@ def load_architecture(architecture_path):
     return True, response
 
 
-def correct_architecture_structure(architecture):
-    response = {}
+def _type_error(value, expected):
+    return (
+        INVALID_ATTRIBUTE_TYPE_ERROR,
+        INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(type(value), value, expected),
+    )
+
+
+def architecture_errors(architecture):
+    """Returns a list of (error_code, msg) tuples for the top-level
+    structure of the architecture."""
+    if not isinstance(architecture, dict):
+        return [_type_error(architecture, "dictionary")]
+
+    errors = []
     owner = architecture.get("owner", None)
     if not owner:
-        response["error_code"] = MISSING_ATTRIBUTE_ERROR
-        response["msg"] = MISSING_ATTRIBUTE_ERROR_MSG.format("owner", architecture)
-        return False, response
+        errors.append(
+            (
+                MISSING_ATTRIBUTE_ERROR,
+                MISSING_ATTRIBUTE_ERROR_MSG.format("owner", "architecture"),
+            )
+        )
 
     images = architecture.get("images", None)
     if not images:
-        response["error_code"] = MISSING_ATTRIBUTE_ERROR
-        response["msg"] = MISSING_ATTRIBUTE_ERROR_MSG.format("images", architecture)
-        return False, response
+        errors.append(
+            (
+                MISSING_ATTRIBUTE_ERROR,
+                MISSING_ATTRIBUTE_ERROR_MSG.format("images", "architecture"),
+            )
+        )
+    elif not isinstance(images, dict):
+        errors.append(_type_error(images, "dictionary"))
+
+    if "bandwidth_limit" in architecture:
+        errors.extend(bandwidth_errors(architecture["bandwidth_limit"]))
+    return errors
+
+
+def bandwidth_errors(bandwidth_limit):
+    """Returns a list of (error_code, msg) tuples for a bandwidth limit."""
+    if parse_bandwidth(bandwidth_limit) is None:
+        return [_type_error(bandwidth_limit, "bandwidth such as 10M or 50MiB")]
+    return []
 
-    required_attributes = ["name", "size"]
-    for image_name, image_data in images.items():
-        for attribute in required_attributes:
-            if attribute not in image_data:
-                response["error_code"] = MISSING_ATTRIBUTE_ERROR
-                response["msg"] = MISSING_ATTRIBUTE_ERROR_MSG.format(
-                    attribute, image_name
+
+def image_errors(image_name, image_data):
+    """Returns a list of (error_code, msg) tuples for a single image entry."""
+    if not isinstance(image_data, dict):
+        return [_type_error(image_data, "dictionary")]
+
+    errors = []
+    for attribute in ["name", "size"]:
+        if attribute not in image_data:
+            errors.append(
+                (
+                    MISSING_ATTRIBUTE_ERROR,
+                    MISSING_ATTRIBUTE_ERROR_MSG.format(attribute, image_name),
                 )
-                return False, response
-    return True, response
+            )
+        elif not isinstance(image_data[attribute], str):
+            errors.append(_type_error(image_data[attribute], "string"))
 
+    if "format" in image_data and not isinstance(image_data["format"], str):
+        errors.append(_type_error(image_data["format"], "string"))
 
-def validate_input(input_data):
-    response = {}
+    if "version" in image_data and not isinstance(
+        image_data["version"], (str, int, float)
+    ):
+        errors.append(_type_error(image_data["version"], "string or number"))
+
+    if "compact" in image_data and not isinstance(image_data["compact"], bool):
+        errors.append(_type_error(image_data["compact"], "boolean"))
+
+    input_data = image_data.get("input", None)
+    if input_data:
+        errors.extend(input_errors(input_data))
+    return errors
+
+
+def input_errors(input_data):
+    """Returns a list of (error_code, msg) tuples for an image input section."""
     if not isinstance(input_data, str) and not isinstance(input_data, dict):
-        response["error_code"] = INVALID_ATTRIBUTE_TYPE_ERROR
-        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-            type(input_data),
-            input_data,
-            "image input must be a string or dictionary",
-        )
-        return False, response
+        return [
+            (
+                INVALID_ATTRIBUTE_TYPE_ERROR,
+                INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                    type(input_data),
+                    input_data,
+                    "image input must be a string or dictionary",
+                ),
+            )
+        ]
 
+    errors = []
     if isinstance(input_data, dict):
-        if "url" not in input_data and "path" not in input_data:
-            response["msg"] = MISSING_ATTRIBUTE_ERROR_MSG.format(
-                "'url' or 'path' must be in the architecture input section"
+        sources = [source for source in ["url", "urls", "path"] if source in input_data]
+        if not sources:
+            errors.append(
+                (
+                    MISSING_ATTRIBUTE_ERROR,
+                    MISSING_ATTRIBUTE_ERROR_MSG.format(
+                        "'url', 'urls' or 'path'", "the architecture input section"
+                    ),
+                )
             )
 
-        if "url" in input_data and "path" in input_data:
-            response["error_code"] = INVALID_ATTRIBUTE_TYPE_ERROR
-            response["msg"] = (
-                "Both 'url' and 'path' are defined in the architecture input section. Only one can be defined"
+        if len(sources) > 1:
+            errors.append(
+                (
+                    INVALID_ATTRIBUTE_TYPE_ERROR,
+                    "All of {} are defined in the architecture input "
+                    "section. Only one can be defined".format(sources),
+                )
             )
-            return False, response
 
-        if "url" in input_data:
-            if not isinstance(input_data["url"], str):
-                response["error_code"] = INVALID_ATTRIBUTE_TYPE_ERROR
-                response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                    type(input_data["url"]), input_data["url"], "string"
-                )
-                return False, response
+        for attribute in ["url", "path", "format"]:
+            if attribute in input_data and not isinstance(input_data[attribute], str):
+                errors.append(_type_error(input_data[attribute], "string"))
 
-        if "path" in input_data:
-            if not isinstance(input_data["path"], str):
-                response["error_code"] = INVALID_ATTRIBUTE_TYPE_ERROR
-                response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                    type(input_data["path"]), input_data["path"], "string"
-                )
-                return False, response
+        if "urls" in input_data:
+            urls = input_data["urls"]
+            if (
+                not isinstance(urls, list)
+                or not urls
+                or not all(isinstance(url, str) for url in urls)
+            ):
+                errors.append(_type_error(urls, "non-empty list of url strings"))
 
-        if "format" in input_data:
-            vm_input_format = input_data["format"]
-            if not isinstance(vm_input_format, str):
-                response["error_code"] = INVALID_ATTRIBUTE_TYPE_ERROR
-                response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                    type(vm_input_format), vm_input_format, "string"
-                )
-                return False, response
+        if "cache_ttl" in input_data and (
+            isinstance(input_data["cache_ttl"], bool)
+            or not isinstance(input_data["cache_ttl"], (int, float))
+        ):
+            errors.append(_type_error(input_data["cache_ttl"], "number"))
+
+        if "bandwidth_limit" in input_data:
+            errors.extend(bandwidth_errors(input_data["bandwidth_limit"]))
 
         # If a checksum is present, then validate that it is correctly structured
         if "checksum" in input_data:
-            if not isinstance(input_data["checksum"], dict):
-                response["error_code"] = INVALID_ATTRIBUTE_TYPE_ERROR
-                response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                    type(input_data["checksum"]),
-                    input_data["checksum"],
-                    "dictionary",
+            errors.extend(checksum_errors(input_data["checksum"]))
+    return errors
+
+
+def checksum_errors(checksum):
+    if not isinstance(checksum, dict):
+        return [_type_error(checksum, "dictionary")]
+
+    errors = []
+    if "type" not in checksum:
+        errors.append(
+            (
+                MISSING_ATTRIBUTE_ERROR,
+                MISSING_ATTRIBUTE_ERROR_MSG.format("type", checksum),
+            )
+        )
+
+    # The value is either given or looked up in the manifest at the url
+    sources = [source for source in ["value", "url"] if source in checksum]
+    if not sources:
+        errors.append(
+            (
+                MISSING_ATTRIBUTE_ERROR,
+                MISSING_ATTRIBUTE_ERROR_MSG.format("'value' or 'url'", checksum),
+            )
+        )
+    if len(sources) > 1:
+        errors.append(
+            (
+                INVALID_ATTRIBUTE_TYPE_ERROR,
+                "Both of {} are defined in the checksum: {}. "
+                "Only one can be defined".format(sources, checksum),
+            )
+        )
+
+    for attr in ["type", "value", "url"]:
+        if attr in checksum and not isinstance(checksum[attr], str):
+            errors.append(_type_error(checksum[attr], "string"))
+
+    for attr in ["decompressed", "force"]:
+        if attr in checksum and not isinstance(checksum[attr], bool):
+            errors.append(_type_error(checksum[attr], "bool"))
+    return errors
+
+
+def _first_error_response(errors):
+    error_code, msg = errors[0]
+    return {"error_code": error_code, "msg": msg}
+
+
+def correct_architecture_structure(architecture):
+    errors = architecture_errors(architecture)
+    if not errors:
+        for image_name, image_data in architecture["images"].items():
+            errors.extend(image_errors(image_name, image_data))
+    if errors:
+        return False, _first_error_response(errors)
+    return True, {}
+
+
+def validate_input(input_data):
+    errors = input_errors(input_data)
+    if errors:
+        return False, _first_error_response(errors)
+    return True, {}
+
+
+def _merge(base, override):
+    """Returns a deep merge of the override dictionary into base."""
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key, None), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _substitute(value, variables):
+    """Replaces every '{<variable>}' placeholder in the string values of value."""
+    if isinstance(value, str):
+        for key, variable in variables.items():
+            value = value.replace("{" + key + "}", str(variable))
+        return value
+    if isinstance(value, dict):
+        return {key: _substitute(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_substitute(item, variables) for item in value]
+    return value
+
+
+def matrix_errors(matrix):
+    if not isinstance(matrix, dict):
+        return [_type_error(matrix, "dictionary")]
+
+    errors = []
+    for axis, values in matrix.items():
+        if axis == MATRIX_EXCLUDE:
+            if not isinstance(values, list) or not all(
+                isinstance(exclude, dict) for exclude in values
+            ):
+                errors.append(_type_error(values, "list of dictionaries"))
+            continue
+        if not isinstance(values, list) or not values:
+            errors.append(_type_error(values, "non-empty list"))
+        elif not all(isinstance(value, (str, int, float)) for value in values):
+            errors.append(_type_error(values, "list of strings or numbers"))
+    return errors
+
+
+def expand_image(image_name, image_data):
+    """Expands the matrix of an image into every combination of its values.
+    Returns a dictionary of the expanded images keyed by their unique names."""
+    matrix = image_data.get(MATRIX, None)
+    if not matrix:
+        return {image_name: image_data}
+
+    image = {key: value for key, value in image_data.items() if key != MATRIX}
+    excludes = matrix.get(MATRIX_EXCLUDE, [])
+    axes = [axis for axis in matrix if axis != MATRIX_EXCLUDE]
+
+    expanded = {}
+    for values in itertools.product(*[matrix[axis] for axis in axes]):
+        variables = dict(zip(axes, values))
+        if any(
+            all(variables.get(key, None) == value for key, value in exclude.items())
+            for exclude in excludes
+        ):
+            continue
+
+        variant = _substitute(image, variables)
+        for axis, value in variables.items():
+            if axis in MATRIX_IMAGE_ATTRIBUTES:
+                variant[axis] = value
+        variant_name = "{}-{}".format(image_name, "-".join(map(str, values)))
+        expanded[variant_name] = variant
+    return expanded
+
+
+def expand_architecture(architecture):
+    """Applies the architecture 'defaults' to every image and expands
+    each image 'matrix'. Returns a list of (error_code, msg) tuples and
+    the expanded images."""
+    errors = []
+    defaults = architecture.get(DEFAULTS, None)
+    if defaults is not None and not isinstance(defaults, dict):
+        return [_type_error(defaults, "dictionary")], {}
+
+    images = {}
+    for image_name, image_data in architecture["images"].items():
+        if not isinstance(image_data, dict):
+            images[image_name] = image_data
+            continue
+        if defaults:
+            image_data = _merge(defaults, image_data)
+
+        if MATRIX in image_data:
+            image_matrix_errors = matrix_errors(image_data[MATRIX])
+            if image_matrix_errors:
+                errors.extend(
+                    (error_code, "image '{}': {}".format(image_name, msg))
+                    for error_code, msg in image_matrix_errors
                 )
-                return False, response
+                continue
 
-            required_checksum_attributes = ["type", "value"]
-            for attr in required_checksum_attributes:
-                if attr not in input_data["checksum"]:
-                    response["error_code"] = MISSING_ATTRIBUTE_ERROR
-                    response["msg"] = MISSING_ATTRIBUTE_ERROR_MSG.format(
-                        attr, input_data["checksum"]
+        for expanded_name, expanded_data in expand_image(
+            image_name, image_data
+        ).items():
+            if expanded_name in images:
+                errors.append(
+                    (
+                        INVALID_ATTRIBUTE_TYPE_ERROR,
+                        "image '{}': the expanded image name is already "
+                        "defined".format(expanded_name),
                     )
-                    return False, response
-                if not isinstance(input_data["checksum"][attr], str):
-                    response["error_code"] = INVALID_ATTRIBUTE_TYPE_ERROR
-                    response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                        type(input_data["checksum"][attr]),
-                        input_data["checksum"][attr],
-                        "string",
+                )
+                continue
+            images[expanded_name] = expanded_data
+    return errors, images
+
+
+def validate_architecture(architecture):
+    """Validates the complete architecture in a single pass before anything
+    is built, such that every error is reported at once.
+    The returned response contains the code of the first error found as
+    'error_code' and every error message in 'errors'. On success, the
+    response contains the 'architecture' with its images expanded."""
+    errors = architecture_errors(architecture)
+    if not errors:
+        errors, images = expand_architecture(architecture)
+        output_paths = {}
+        for image_name, image_data in images.items():
+            image_data_errors = image_errors(image_name, image_data)
+            for error_code, msg in image_data_errors:
+                errors.append((error_code, "image '{}': {}".format(image_name, msg)))
+            if image_data_errors:
+                continue
+
+            # Two images that would be written to the same output path
+            # can't both be generated
+            output_path = image_output_path(
+                image_data["name"],
+                image_data.get("format", "qcow2"),
+                output_directory="",
+                version=image_data.get("version", None),
+            )
+            if output_path in output_paths:
+                errors.append(
+                    (
+                        INVALID_ATTRIBUTE_TYPE_ERROR,
+                        "image '{}': the output image: {} is also generated by "
+                        "image '{}'".format(
+                            image_name, output_path, output_paths[output_path]
+                        ),
                     )
-                    return False, response
-    return True, response
+                )
+            else:
+                output_paths[output_path] = image_name
+
+    if errors:
+        response = _first_error_response(errors)
+        response["errors"] = [msg for _, msg in errors]
+        return False, response
+
+    expanded_architecture = dict(architecture)
+    expanded_architecture.pop(DEFAULTS, None)
+    expanded_architecture["images"] = images
+    return True, {"architecture": expanded_architecture}
 
 
 def prepare_input_kwargs(input_data):
@@ -168,40 +486,603 @@ def prepare_input_kwargs(input_data):
     if checksum:
         input_kwargs["input_checksum_type"] = checksum.get("type", None)
         input_kwargs["input_checksum"] = checksum.get("value", None)
+        input_kwargs["input_checksum_url"] = checksum.get("url", None)
         input_kwargs["input_checksum_buffer_size"] = checksum.get(
             "buffer_size", DEFAULT_BUFFER_SIZE
         )
         input_kwargs["input_checksum_read_bytes"] = checksum.get("read_bytes", None)
+        input_kwargs["input_checksum_decompressed"] = checksum.get(
+            "decompressed", False
+        )
+        input_kwargs["input_checksum_force"] = checksum.get("force", False)
 
     if "path" in input_data:
         input_kwargs["input"] = input_data.get("path", None)
     if "url" in input_data:
         input_kwargs["input"] = input_data.get("url", None)
+    if "urls" in input_data:
+        input_kwargs["input"] = list(input_data.get("urls", []))
     if "format" in input_data:
         input_kwargs["input_format"] = input_data.get("format", None)
+    if "cache_ttl" in input_data:
+        input_kwargs["input_cache_ttl"] = input_data.get("cache_ttl", None)
+    if "bandwidth_limit" in input_data:
+        input_kwargs["input_bandwidth_limit"] = input_data.get("bandwidth_limit", None)
     return input_kwargs
 
 
-async def build_architecture(
-    architecture_path,
+def image_input_kwargs(input_):
+    if isinstance(input_, dict):
+        return prepare_input_kwargs(input_)
+    if input_:
+        return {"input": input_}
+    return {}
+
+
+def input_group_key(input_):
+    """Returns the key that identifies images which share the same input
+    or None if the image has no input."""
+    if not input_:
+        return None
+    return json.dumps(input_, sort_keys=True, default=str)
+
+
+def group_images_by_input(images):
+    groups = {}
+    ungrouped = []
+    for build_data in images.values():
+        key = input_group_key(build_data.get("input", None))
+        if key is None:
+            ungrouped.append([build_data])
+        else:
+            groups.setdefault(key, []).append(build_data)
+    return ungrouped + list(groups.values())
+
+
+async def convert_shared_input(
+    input_path,
+    input_format,
+    output_format,
+    verbose=False,
+    progress=None,
+    scheduler=None,
+    retrier=None,
+):
+    """Converts the shared input image once into output_format such that
+    every image of that format can be derived from the converted image."""
+    response = {}
+    # Identify the converted image by its source, such that inputs with
+    # the same filename don't share the converted image
+    source_id = hashlib.sha1(
+        "{}:{}".format(os.path.realpath(input_path), input_format).encode("utf-8")
+    ).hexdigest()[:12]
+    converted_path = os.path.join(
+        TMP_DIR,
+        "{}.{}.{}".format(
+            os.path.splitext(os.path.basename(input_path))[0],
+            source_id,
+            output_format,
+        ),
+    )
+    # Concurrent builds wait for an in-flight conversion of the same input
+    async with FileLock(converted_path):
+        if exists(converted_path) and os.path.getmtime(
+            converted_path
+        ) >= os.path.getmtime(input_path):
+            response["converted_path"] = converted_path
+            return True, response
+
+        if not exists(TMP_DIR):
+            created = makedirs(TMP_DIR)
+            if not created:
+                response["msg"] = PATH_CREATE_ERROR_MSG.format(
+                    TMP_DIR, "Failed to create the temporary conversion directory"
+                )
+                return False, response
+
+        partial_converted_path = "{}.partial".format(converted_path)
+        estimated_size = 0
+        if scheduler:
+            estimated_size = await estimate_image_size(
+                output_format, path=input_path, image_format=input_format
+            )
+        try:
+            async with scheduled(scheduler, SCHEDULER_CONVERT), reserved(
+                scheduler, partial_converted_path, estimated_size
+            ):
+                with stage(progress, "convert", unit="percent") as outcome:
+                    converted, msg = await convert_image(
+                        input_path,
+                        partial_converted_path,
+                        input_format=input_format,
+                        output_format=output_format,
+                        verbose=verbose,
+                        retrier=retrier,
+                        on_progress=stage_callback(progress, "convert"),
+                    )
+                    outcome["success"] = converted
+        except asyncio.CancelledError:
+            # An interrupted build leaves no partial conversion behind
+            if exists(partial_converted_path):
+                remove(partial_converted_path)
+            raise
+        if not converted:
+            if exists(partial_converted_path):
+                remove(partial_converted_path)
+            response["msg"] = PATH_CREATE_ERROR_MSG.format(converted_path, msg)
+            return False, response
+        os.replace(partial_converted_path, converted_path)
+        response["converted_path"] = converted_path
+        return True, response
+
+
+async def prepare_image_group(
+    group,
     output_directory=GENERATED_IMAGE_DIR,
     overwrite=False,
     verbose=False,
+    progress=None,
+    session=None,
+    checksum_manifests=None,
+    scheduler=None,
+    retrier=None,
+    shared_bandwidth=None,
+    intermediate_paths=None,
 ):
+    """Prepares a group of images that share the same input. The input is
+    downloaded and verified once and each output format that is required
+    by more than one image is converted once for the whole group.
+    On success, the response contains the 'builds' as a list of
+    (build_data, prepared_build_data) tuples, where the prepared build data
+    refers to the shared input. The intermediate files of the shared input
+    are added to intermediate_paths, which the caller removes once every
+    image of the group has been built."""
     response = {"verbose_outputs": []}
+    pending = [
+        build_data
+        for build_data in group
+        if overwrite
+        or not exists(
+            image_output_path(
+                build_data["name"],
+                build_data.get("format", "qcow2"),
+                output_directory=output_directory,
+                version=build_data.get("version", None),
+            )
+        )
+    ]
+    if len(pending) < 2:
+        response["builds"] = [(build_data, build_data) for build_data in group]
+        return SUCCESS, response
+
+    if progress:
+        # The shared stages are reported for every image of the group
+        progress = progress.bind(images=[build_data["name"] for build_data in pending])
+
+    input_kwargs = image_input_kwargs(group[0].get("input", None))
+    prepared_code, prepared_response = await prepare_input(
+        input_kwargs.pop("input"),
+        **input_kwargs,
+        verbose=verbose,
+        progress=progress,
+        session=session,
+        checksum_manifests=checksum_manifests,
+        scheduler=scheduler,
+        retrier=retrier,
+        shared_bandwidth=shared_bandwidth,
+        intermediate_paths=intermediate_paths,
+    )
+    response["verbose_outputs"].extend(prepared_response.get("verbose_outputs", []))
+    if prepared_code != SUCCESS:
+        response["msg"] = prepared_response["msg"]
+        return prepared_code, response
+
+    input_path = prepared_response["input_path"]
+    input_format = prepared_response["input_format"]
+    shared_inputs = {}
+    output_formats = [build_data.get("format", "qcow2") for build_data in pending]
+    for output_format in set(output_formats):
+        if output_format == input_format or output_formats.count(output_format) < 2:
+            continue
+        converted, converted_response = await convert_shared_input(
+            input_path,
+            input_format,
+            output_format,
+            verbose=verbose,
+            progress=progress,
+            scheduler=scheduler,
+            retrier=retrier,
+        )
+        if not converted:
+            response["msg"] = converted_response["msg"]
+            return PATH_CREATE_ERROR, response
+        shared_inputs[output_format] = converted_response["converted_path"]
+
+    builds = []
+    for build_data in group:
+        # The prepared input has already been verified
+        prepared_build_data = dict(build_data)
+        output_format = build_data.get("format", "qcow2")
+        if output_format in shared_inputs:
+            prepared_build_data["input"] = {
+                "path": shared_inputs[output_format],
+                "format": output_format,
+            }
+        else:
+            prepared_build_data["input"] = {"path": input_path, "format": input_format}
+        builds.append((build_data, prepared_build_data))
+    response["builds"] = builds
+    return SUCCESS, response
+
+
+async def build_image_group(
+    group,
+    output_directory=GENERATED_IMAGE_DIR,
+    overwrite=False,
+    verbose=False,
+    progress=None,
+    session=None,
+    checksum_manifests=None,
+    output_manifest=None,
+    scheduler=None,
+    retrier=None,
+    shared_bandwidth=None,
+):
+    """Builds a group of images that share the same input, see
+    prepare_image_group for how the input is shared. The checksums of each
+    image are added to the optional OutputManifest as soon as it is built."""
+    # The intermediate files of the shared input are removed once every
+    # image of the group has been built
+    intermediate_paths = []
+    try:
+        prepared_code, response = await prepare_image_group(
+            group,
+            output_directory=output_directory,
+            overwrite=overwrite,
+            verbose=verbose,
+            progress=progress,
+            session=session,
+            checksum_manifests=checksum_manifests,
+            scheduler=scheduler,
+            retrier=retrier,
+            shared_bandwidth=shared_bandwidth,
+            intermediate_paths=intermediate_paths,
+        )
+        # The return code of each image of the group that was attempted
+        response["images"] = []
+        if prepared_code != SUCCESS:
+            response["images"] = [(build_data, prepared_code) for build_data in group]
+            return prepared_code, response
+
+        for group_build_data, build_data in response.pop("builds"):
+            build_return_code, build_response = await build_image(
+                build_data,
+                output_directory=output_directory,
+                overwrite=overwrite,
+                verbose=verbose,
+                progress=progress,
+                session=session,
+                checksum_manifests=checksum_manifests,
+                scheduler=scheduler,
+                retrier=retrier,
+                shared_bandwidth=shared_bandwidth,
+            )
+            response["verbose_outputs"].extend(
+                build_response.get("verbose_outputs", [])
+            )
+            response["images"].append((group_build_data, build_return_code))
+            if build_return_code != SUCCESS:
+                response["msg"] = build_response.get("msg", "")
+                return build_return_code, response
+            if output_manifest:
+                # The image is hashed in the background while the next is built
+                image_progress = progress
+                if progress:
+                    image_progress = progress.bind(
+                        image=build_data["name"],
+                        version=build_data.get("version", None),
+                    )
+                output_manifest.add(
+                    image_output_path(
+                        build_data["name"],
+                        build_data.get("format", "qcow2"),
+                        output_directory=output_directory,
+                        version=build_data.get("version", None),
+                    ),
+                    progress=image_progress,
+                )
+        return SUCCESS, response
+    finally:
+        for path in intermediate_paths:
+            if exists(path):
+                remove(path)
+
+
+async def build_image(
+    build_data,
+    output_directory=GENERATED_IMAGE_DIR,
+    overwrite=False,
+    verbose=False,
+    progress=None,
+    session=None,
+    checksum_manifests=None,
+    scheduler=None,
+    retrier=None,
+    shared_bandwidth=None,
+):
+    generate_image_kwargs = image_input_kwargs(build_data.get("input", None))
+    generate_image_kwargs["output_directory"] = output_directory
+    generate_image_kwargs["output_format"] = build_data.get("format", "qcow2")
+    generate_image_kwargs["version"] = build_data.get("version", None)
+    generate_image_kwargs["overwrite"] = overwrite
+    generate_image_kwargs["compact"] = build_data.get("compact", False)
+
+    return await generate_image(
+        build_data["name"],
+        build_data["size"],
+        **generate_image_kwargs,
+        verbose=verbose,
+        progress=progress,
+        session=session,
+        checksum_manifests=checksum_manifests,
+        scheduler=scheduler,
+        retrier=retrier,
+        shared_bandwidth=shared_bandwidth,
+    )
+
+
+def architecture_groups(architecture_path, shard=None, shard_weighted=False):
+    """Loads and validates the architecture, and returns its images in
+    'groups' that share the same input, optionally only the groups of the
+    'K/N' shard, along with the 'bandwidth_limit' of the architecture.
+    On failure, the response contains the 'error_code'."""
+    response = {}
     # Load the architecture file
     architecture_loaded, architecture_response = load_architecture(architecture_path)
     if not architecture_loaded:
-        response["msg"] = architecture_response["msg"]
-        return architecture_response["error_code"], response
+        return False, architecture_response
 
     architecture = architecture_response["architecture"]
-    correct_architecture, correct_response = correct_architecture_structure(
-        architecture
+    # Validate every image before anything is downloaded or converted
+    valid_architecture, valid_response = validate_architecture(architecture)
+    if not valid_architecture:
+        response["msg"] = ARCHITECTURE_VALIDATION_ERROR_MSG.format(
+            architecture_path, valid_response["errors"]
+        )
+        response["error_code"] = valid_response["error_code"]
+        return False, response
+    architecture = valid_response["architecture"]
+
+    # Images that share the same input are built together such that
+    # the input is only downloaded, verified and converted once.
+    groups = group_images_by_input(architecture["images"])
+    if shard:
+        parsed, shard_response = parse_shard(shard)
+        if not parsed:
+            response["error_code"] = SHARD_ERROR
+            response["msg"] = shard_response["msg"]
+            return False, response
+        groups = plan_shards(groups, shard_response["count"], weighted=shard_weighted)[
+            shard_response["index"] - 1
+        ]
+    response["groups"] = groups
+    response["bandwidth_limit"] = architecture.get("bandwidth_limit", None)
+    return True, response
+
+
+async def plan_architecture(
+    architecture_path,
+    output_directory=GENERATED_IMAGE_DIR,
+    overwrite=False,
+    shard=None,
+    shard_weighted=False,
+    session=None,
+    http_pool_size=DEFAULT_HTTP_POOL_SIZE,
+    http_proxy=None,
+    http_ca_bundle=None,
+):
+    """Returns the 'plan' of building the architecture without building it.
+    The plan contains the operations of every image, whether each input
+    is reused from the cache or downloaded along with the size of the
+    download, the estimated size of every output image, and the 'capacity'
+    that the build requires of the network and of each filesystem, such that
+    an orchestrator can pick a node that can hold the build. Neither the
+    output directory nor the cache is changed."""
+    response = {"verbose_outputs": []}
+    loaded, groups_response = architecture_groups(
+        architecture_path, shard=shard, shard_weighted=shard_weighted
+    )
+    if not loaded:
+        response["msg"] = groups_response["msg"]
+        return groups_response["error_code"], response
+
+    with http_session(
+        session, pool_size=http_pool_size, proxy=http_proxy, ca_bundle=http_ca_bundle
+    ) as session:
+        plan = await plan_groups(
+            groups_response["groups"],
+            output_directory=output_directory,
+            overwrite=overwrite,
+            session=session,
+        )
+    plan["architecture"] = os.path.realpath(architecture_path)
+    plan["shard"] = shard
+    plan["output_directory"] = os.path.realpath(output_directory)
+    response["plan"] = plan
+    response["msg"] = plan
+
+    missing = [
+        input_plan["source"]
+        for input_plan in plan["inputs"]
+        if input_plan["input"] == PLAN_INPUT_MISSING
+    ]
+    if missing:
+        response["msg"] = PATH_NOT_FOUND_ERROR_MSG.format(
+            missing, "the inputs of the planned images do not exist"
+        )
+        return PATH_NOT_FOUND_ERROR, response
+    return SUCCESS, response
+
+
+def new_retrier(
+    retries=DEFAULT_RETRIES, retry_backoff=DEFAULT_RETRY_BACKOFF, retry_policies=None
+):
+    """Validates the retry options and returns the 'retrier' of a build."""
+    response = {}
+    if not isinstance(retries, int) or isinstance(retries, bool) or retries < 0:
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(retries), retries, "a non-negative int for retries"
+        )
+        return False, response
+    if not isinstance(retry_backoff, (int, float)) or retry_backoff < 0:
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(retry_backoff),
+            retry_backoff,
+            "a non-negative number for retry_backoff",
+        )
+        return False, response
+    retry_policies = retry_policies or {}
+    unknown_stages = [stage for stage in retry_policies if stage not in RETRY_STAGES]
+    if unknown_stages:
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(unknown_stages),
+            unknown_stages,
+            "retry policies of the stages: {}".format(RETRY_STAGES),
+        )
+        return False, response
+    try:
+        response["retrier"] = Retrier(
+            policies=retry_policies,
+            default_policy={"retries": retries, "backoff": retry_backoff},
+        )
+    except TypeError as err:
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(retry_policies), retry_policies, "valid retry policies: {}".format(err)
+        )
+        return False, response
+    return True, response
+
+
+async def build_architecture(
+    architecture_path,
+    output_directory=GENERATED_IMAGE_DIR,
+    overwrite=False,
+    verbose=False,
+    # Either a ProgressReporter or one of the PROGRESS_MODES
+    progress=None,
+    progress_fd=DEFAULT_PROGRESS_FD,
+    # A shared requests.Session, otherwise one is created with the http options
+    session=None,
+    http_pool_size=DEFAULT_HTTP_POOL_SIZE,
+    http_proxy=None,
+    http_ca_bundle=None,
+    # The algorithms of the checksum manifests that are written to the
+    # output directory, e.g. ["sha256"] writes SHA256SUMS
+    output_checksum_types=None,
+    # Only build the images of the 'K/N' shard of the architecture
+    shard=None,
+    # Whether the shards are balanced by the size of the images instead of
+    # being assigned by the stable hash of the images, see plan_shards
+    shard_weighted=False,
+    # Only return the images of each of the N shards without building them
+    list_shards=None,
+    # The path that a JSON report of the result of every image is written to
+    report_path=None,
+    # The number of groups of images that are built concurrently, where the
+    # stages of the builds are admitted by a ResourceScheduler
+    jobs=DEFAULT_ARCHITECTURE_JOBS,
+    network_jobs=DEFAULT_NETWORK_JOBS,
+    hash_jobs=DEFAULT_HASH_JOBS,
+    convert_jobs=DEFAULT_CONVERT_JOBS,
+    # The number of times, and the seconds before the first time, that a
+    # stage with a transient failure is retried, e.g. a dropped download
+    retries=DEFAULT_RETRIES,
+    retry_backoff=DEFAULT_RETRY_BACKOFF,
+    # The RetryPolicy of each of the RETRY_STAGES that is retried differently
+    retry_policies=None,
+    # The bytes per second that every download of the build shares, which
+    # overrides the bandwidth_limit of the architecture file
+    bandwidth_limit=None,
+    # Only return the plan of the build without building anything,
+    # see plan_architecture
+    plan=False,
+):
+    if plan:
+        return await plan_architecture(
+            architecture_path,
+            output_directory=output_directory,
+            overwrite=overwrite,
+            shard=shard,
+            shard_weighted=shard_weighted,
+            session=session,
+            http_pool_size=http_pool_size,
+            http_proxy=http_proxy,
+            http_ca_bundle=http_ca_bundle,
+        )
+
+    response = {"verbose_outputs": []}
+    progress = new_progress_reporter(progress, progress_fd=progress_fd)
+    for option, value in [
+        ("jobs", jobs),
+        ("network_jobs", network_jobs),
+        ("hash_jobs", hash_jobs),
+        ("convert_jobs", convert_jobs),
+    ]:
+        if not isinstance(value, int) or value < 1:
+            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(value), value, "a positive int for {}".format(option)
+            )
+            return INVALID_ATTRIBUTE_TYPE_ERROR, response
+    retrier_created, retrier_response = new_retrier(
+        retries=retries, retry_backoff=retry_backoff, retry_policies=retry_policies
     )
-    if not correct_architecture:
-        response["msg"] = correct_response["msg"]
-        return correct_response["error_code"], response
+    if not retrier_created:
+        response["msg"] = retrier_response["msg"]
+        return INVALID_ATTRIBUTE_TYPE_ERROR, response
+    if bandwidth_limit is not None and parse_bandwidth(bandwidth_limit) is None:
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(bandwidth_limit),
+            bandwidth_limit,
+            "a bandwidth_limit such as 10M or 50MiB",
+        )
+        return INVALID_ATTRIBUTE_TYPE_ERROR, response
+    # Transient failures of the builds are retried by the same retrier,
+    # which counts the retries of the whole build
+    retrier = retrier_response["retrier"]
+
+    if list_shards:
+        if not isinstance(list_shards, int) or list_shards < 1:
+            response["msg"] = SHARD_ERROR_MSG.format(
+                list_shards, "the number of shards must be at least 1"
+            )
+            return SHARD_ERROR, response
+        loaded, groups_response = architecture_groups(architecture_path)
+        if not loaded:
+            response["msg"] = groups_response["msg"]
+            return groups_response["error_code"], response
+        response["shards"] = describe_shards(
+            plan_shards(groups_response["groups"], list_shards, weighted=shard_weighted)
+        )
+        response["msg"] = response["shards"]
+        return SUCCESS, response
+
+    loaded, groups_response = architecture_groups(
+        architecture_path, shard=shard, shard_weighted=shard_weighted
+    )
+    if not loaded:
+        response["msg"] = groups_response["msg"]
+        return groups_response["error_code"], response
+    groups = groups_response["groups"]
+    if bandwidth_limit is None:
+        bandwidth_limit = groups_response["bandwidth_limit"]
+    # The downloads of the concurrent builds share the bandwidth limit
+    shared_bandwidth = new_bandwidth(bandwidth_limit)
+    if verbose and shared_bandwidth:
+        response["verbose_outputs"].append(
+            "Limiting the downloads to {} bytes per second".format(
+                int(shared_bandwidth.rate)
+            )
+        )
 
     # Create the destination directory where the images will be saved
     if not exists(output_directory):
@@ -212,50 +1093,130 @@ async def build_architecture(
             )
             return PATH_CREATE_ERROR, response
 
-    if "images" not in architecture:
-        response["msg"] = MISSING_ATTRIBUTE_ERROR_MSG.format("images", architecture)
-        return MISSING_ATTRIBUTE_ERROR, response
-
-    images = architecture.get("images")
-    if not isinstance(images, dict):
-        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-            type(images), images, dict
+    # Every download of the build shares the same connection pool,
+    # and each checksum manifest is only fetched once.
+    checksum_manifests = ChecksumManifests()
+    # The stages of the concurrent builds are admitted such that they
+    # don't exhaust the network, CPU or disk space of the host
+    scheduler = ResourceScheduler(
+        network_jobs=network_jobs, hash_jobs=hash_jobs, convert_jobs=convert_jobs
+    )
+    output_manifest = None
+    if output_checksum_types:
+        output_manifest = OutputManifest(
+            output_directory, output_checksum_types, scheduler=scheduler
         )
-        return INVALID_ATTRIBUTE_TYPE_ERROR, response
+    group_slots = asyncio.Semaphore(jobs)
+    failed = []
 
-    # Generate the image configuration
-    for _, build_data in images.items():
-        generate_image_kwargs = {}
-
-        input_ = build_data.get("input", None)
-        if input_:
-            correct_input, correct_input_response = validate_input(input_)
-            if not correct_input:
-                return (
-                    correct_input_response["error_code"],
-                    correct_input_response["msg"],
-                )
+    async def build_group(group, session):
+        async with group_slots:
+            # No other groups are started once a group has failed
+            if failed:
+                return None
+            group_result = await build_image_group(
+                group,
+                output_directory=output_directory,
+                overwrite=overwrite,
+                verbose=verbose,
+                progress=progress,
+                session=session,
+                checksum_manifests=checksum_manifests,
+                output_manifest=output_manifest,
+                scheduler=scheduler,
+                retrier=retrier,
+                shared_bandwidth=shared_bandwidth,
+            )
+            if group_result[0] != SUCCESS:
+                failed.append(group)
+            return group_result
 
-            if isinstance(input_, dict):
-                generate_image_kwargs.update(**prepare_input_kwargs(input_))
+    return_code = SUCCESS
+    results = []
+    with http_session(
+        session, pool_size=http_pool_size, proxy=http_proxy, ca_bundle=http_ca_bundle
+    ) as session:
+        group_results = await asyncio.gather(
+            *[build_group(group, session) for group in groups]
+        )
+    for group_result in group_results:
+        if group_result is None:
+            continue
+        group_return_code, build_response = group_result
+        results.extend(build_response.get("images", []))
+        if verbose:
+            response["verbose_outputs"].extend(
+                build_response.get("verbose_outputs", [])
+            )
+        if group_return_code != SUCCESS and return_code == SUCCESS:
+            return_code = group_return_code
+            response["verbose_outputs"] = build_response.get("verbose_outputs", [])
+            response["msg"] = build_response.get("msg", "")
+    if retrier.counts:
+        response["retries"] = dict(retrier.counts)
+    if verbose:
+        response["verbose_outputs"].extend(retry_verbose_outputs(retrier))
+        response["verbose_outputs"].extend(priority_verbose_outputs())
+        for path, size, waited in scheduler.delays:
+            response["verbose_outputs"].append(
+                "Delayed writing: {} for {:.1f} seconds until {} bytes of disk "
+                "space were available".format(path, waited, size)
+            )
 
-        generate_image_kwargs["output_directory"] = output_directory
-        generate_image_kwargs["output_format"] = build_data.get("format", "qcow2")
-        generate_image_kwargs["version"] = build_data.get("version", None)
+    output_checksums = {}
+    if output_manifest:
+        # The checksums of the images that were built are kept,
+        # even if a later image of the architecture failed
+        written, manifest_response = await output_manifest.write()
+        output_checksums = manifest_response["output_checksums"]
+        response["output_checksums"] = output_checksums
+        if not written and return_code == SUCCESS:
+            response["msg"] = manifest_response["msg"]
+            return_code = CHECKSUM_ERROR
 
-        build_return_code, build_response = await generate_image(
-            build_data["name"],
-            build_data["size"],
-            **generate_image_kwargs,
-            verbose=verbose,
+    if return_code == SUCCESS:
+        response["msg"] = "Successfully built the images in: {}".format(
+            os.path.realpath(output_directory)
+        )
+    if report_path:
+        report = new_shard_report(architecture_path, shard=shard)
+        report["return_code"] = return_code
+        report["images"] = image_reports(
+            groups, results, output_directory, output_checksums
         )
+        if not write_shard_report(report_path, report) and return_code == SUCCESS:
+            response["msg"] = PATH_CREATE_ERROR_MSG.format(
+                report_path, "Failed to write the build report"
+            )
+            return_code = PATH_CREATE_ERROR
+    return return_code, response
 
-        if build_return_code != SUCCESS:
-            response["verbose_outputs"] = build_response.get("verbose_outputs", [])
-            response["msg"] = build_response.get("msg", "")
-            return build_return_code, response
 
-    response["msg"] = "Successfully built the images in: {}".format(
-        os.path.realpath(output_directory)
-    )
-    return SUCCESS, response
+def image_reports(groups, results, output_directory, output_checksums):
+    """Returns the report of each image of the groups by the filename of the
+    output image, where images that were not attempted have no return code."""
+    return_codes = {id(build_data): code for build_data, code in results}
+    reports = {}
+    for group in groups:
+        for build_data in group:
+            output_path = image_output_path(
+                build_data["name"],
+                build_data.get("format", "qcow2"),
+                output_directory=output_directory,
+                version=build_data.get("version", None),
+            )
+            filename = os.path.basename(output_path)
+            image_report = {
+                "name": build_data["name"],
+                "version": build_data.get("version", None),
+                "output_path": os.path.realpath(output_path),
+                "return_code": return_codes.get(id(build_data), None),
+            }
+            if image_report["return_code"] == SUCCESS and exists(output_path):
+                stat = os.stat(output_path)
+                image_report["size"] = stat.st_size
+                image_report["mtime_ns"] = stat.st_mtime_ns
+            if filename in output_checksums:
+                image_report["checksums"] = output_checksums[filename]
+            reports[filename] = image_report
+    return reports
@@ -0,0 +1,179 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+
+from gen_vm_image.architecture import (
+    build_image,
+    group_images_by_input,
+    image_errors,
+    prepare_image_group,
+)
+from gen_vm_image.common.codes import (
+    INVALID_ATTRIBUTE_TYPE_ERROR,
+    JOB_ERROR,
+    JOB_ERROR_MSG,
+    SUCCESS,
+)
+from gen_vm_image.common.defaults import (
+    DEFAULT_BATCH_CONCURRENCY,
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_PROGRESS_FD,
+    GENERATED_IMAGE_DIR,
+)
+from gen_vm_image.image import image_output_path
+from gen_vm_image.utils.io import exists, remove
+from gen_vm_image.utils.manifest import ChecksumManifests
+from gen_vm_image.utils.net import new_session
+from gen_vm_image.utils.progress import new_progress_reporter
+
+
+async def generate_images(
+    specs,
+    concurrency=DEFAULT_BATCH_CONCURRENCY,
+    output_directory=GENERATED_IMAGE_DIR,
+    overwrite=False,
+    verbose=False,
+    progress=None,
+    progress_fd=DEFAULT_PROGRESS_FD,
+    session=None,
+    http_pool_size=DEFAULT_HTTP_POOL_SIZE,
+    http_proxy=None,
+    http_ca_bundle=None,
+):
+    """Generates every image spec concurrently and yields a
+    (spec, return_code, response) tuple for each of them as soon as it is done.
+    Each spec is a dictionary with the same structure as an image in an
+    architecture file. Unlike build_architecture, a failed image does not
+    stop the remaining images from being generated. Every download shares
+    the given requests.Session, or a session created with the http options.
+
+    Example:
+
+        async for spec, return_code, response in generate_images(specs):
+            ...
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+
+    specs = list(specs)
+    progress = new_progress_reporter(progress, progress_fd=progress_fd)
+    owns_session = session is None
+    if owns_session:
+        session = new_session(
+            pool_size=http_pool_size, proxy=http_proxy, ca_bundle=http_ca_bundle
+        )
+    checksum_manifests = ChecksumManifests()
+    results = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+
+    async def run_build(spec, build_data):
+        try:
+            async with semaphore:
+                return_code, response = await build_image(
+                    build_data,
+                    output_directory=output_directory,
+                    overwrite=overwrite,
+                    verbose=verbose,
+                    progress=progress,
+                    session=session,
+                    checksum_manifests=checksum_manifests,
+                )
+        except Exception as err:
+            return_code = JOB_ERROR
+            response = {"msg": JOB_ERROR_MSG.format(spec["name"], err)}
+        results.put_nowait((spec, return_code, response))
+
+    async def run_group(group):
+        # The intermediate files of the shared input are removed once every
+        # image of the group has been built
+        intermediate_paths = []
+        try:
+            try:
+                async with semaphore:
+                    prepared_code, prepared_response = await prepare_image_group(
+                        group,
+                        output_directory=output_directory,
+                        overwrite=overwrite,
+                        verbose=verbose,
+                        progress=progress,
+                        session=session,
+                        checksum_manifests=checksum_manifests,
+                        intermediate_paths=intermediate_paths,
+                    )
+            except Exception as err:
+                prepared_code = JOB_ERROR
+                prepared_response = {"msg": JOB_ERROR_MSG.format(group[0]["name"], err)}
+            if prepared_code != SUCCESS:
+                for spec in group:
+                    results.put_nowait((spec, prepared_code, prepared_response))
+                return
+            builds = [
+                asyncio.ensure_future(run_build(spec, build_data))
+                for spec, build_data in prepared_response["builds"]
+            ]
+            tasks.extend(builds)
+            await asyncio.gather(*builds)
+        finally:
+            for path in intermediate_paths:
+                if exists(path):
+                    remove(path)
+
+    valid_specs, output_paths = {}, set()
+    for index, spec in enumerate(specs):
+        errors = image_errors(index, spec)
+        if errors:
+            error_code, msg = errors[0]
+            results.put_nowait((spec, error_code, {"msg": msg}))
+            continue
+
+        # Concurrent builds of the same output image would overwrite each other
+        output_path = image_output_path(
+            spec["name"],
+            spec.get("format", "qcow2"),
+            output_directory=output_directory,
+            version=spec.get("version", None),
+        )
+        if output_path in output_paths:
+            results.put_nowait(
+                (
+                    spec,
+                    INVALID_ATTRIBUTE_TYPE_ERROR,
+                    {
+                        "msg": "The output image: {} is already generated by "
+                        "another spec".format(output_path)
+                    },
+                )
+            )
+            continue
+        output_paths.add(output_path)
+        valid_specs[index] = spec
+
+    for group in group_images_by_input(valid_specs):
+        tasks.append(asyncio.ensure_future(run_group(group)))
+
+    try:
+        for _ in range(len(specs)):
+            yield await results.get()
+    finally:
+        # Stop the remaining builds if the caller stops iterating early
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if owns_session:
+            session.close()
@@ -0,0 +1,25 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from gen_vm_image.cli.parsers.merge import merge_group
+from gen_vm_image.common.defaults import MERGE
+
+
+def merge_groups(parser):
+    merge_group(parser)
+
+    argument_groups = [MERGE]
+    return argument_groups
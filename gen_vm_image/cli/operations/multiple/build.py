@@ -15,7 +15,31 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 from gen_vm_image.architecture import build_architecture
+from gen_vm_image.common.codes import INVALID_ATTRIBUTE_TYPE_ERROR
+from gen_vm_image.common.defaults import DEFAULT_JOB_TIMEOUT, DEFAULT_PROCESS_JOBS
+from gen_vm_image.utils.job import (
+    run_until_signalled,
+    set_job_limits,
+    set_job_priority,
+)
+from gen_vm_image.utils.priority import new_process_priority
 
 
-async def multiple_operation(*args, **kwargs):
-    return await build_architecture(*args, **kwargs)
+async def multiple_operation(
+    *args,
+    process_jobs=DEFAULT_PROCESS_JOBS,
+    job_timeout=DEFAULT_JOB_TIMEOUT,
+    nice=None,
+    io_class=None,
+    io_priority=None,
+    cpu_affinity=None,
+    **kwargs
+):
+    created, priority_response = new_process_priority(
+        nice=nice, io_class=io_class, io_priority=io_priority, cpu_affinity=cpu_affinity
+    )
+    if not created:
+        return INVALID_ATTRIBUTE_TYPE_ERROR, priority_response
+    set_job_limits(max_jobs=process_jobs, timeout=job_timeout)
+    set_job_priority(priority_response["priority"])
+    return await run_until_signalled(build_architecture(*args, **kwargs))
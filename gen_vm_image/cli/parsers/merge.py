@@ -0,0 +1,44 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from gen_vm_image.common.defaults import GENERATED_IMAGE_DIR, MERGE
+
+
+def merge_group(parser):
+    merge_shards_group = parser.add_argument_group(
+        title="Merge the reports of the shards of an architecture"
+    )
+
+    merge_shards_group.add_argument(
+        "{}_report_paths".format(MERGE),
+        nargs="+",
+        metavar="report_path",
+        help="The paths to the reports that were written with --report by each shard of the multiple command.",
+    )
+    merge_shards_group.add_argument(
+        "-o",
+        "--output",
+        dest="{}_output_path".format(MERGE),
+        default=None,
+        help="The path that the merged report is written to.",
+    )
+    merge_shards_group.add_argument(
+        "-od",
+        "--output-directory",
+        dest="{}_output_directory".format(MERGE),
+        default=GENERATED_IMAGE_DIR,
+        help="The path to the output directory where the merged checksum manifests of the images are written.",
+    )
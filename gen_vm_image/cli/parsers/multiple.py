@@ -15,7 +15,23 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 from gen_vm_image.cli.parsers.actions import PositionalArgumentsAction
-from gen_vm_image.common.defaults import GENERATED_IMAGE_DIR, MULTIPLE
+from gen_vm_image.common.defaults import (
+    DEFAULT_ARCHITECTURE_JOBS,
+    DEFAULT_CONVERT_JOBS,
+    DEFAULT_HASH_JOBS,
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_JOB_TIMEOUT,
+    DEFAULT_NETWORK_JOBS,
+    DEFAULT_PROCESS_JOBS,
+    DEFAULT_PROGRESS_FD,
+    DEFAULT_RETRIES,
+    DEFAULT_RETRY_BACKOFF,
+    GENERATED_IMAGE_DIR,
+    IO_CLASSES,
+    MULTIPLE,
+    PROGRESS_MODES,
+    PROGRESS_NONE,
+)
 
 
 def multiple_group(parser):
@@ -42,6 +58,173 @@ def multiple_group(parser):
         default=False,
         help="Whether the tool should overwrite existing image disks.",
     )
+    generate_multiple_group.add_argument(
+        "-oct",
+        "--output-checksum-type",
+        dest="{}_output_checksum_types".format(MULTIPLE),
+        action="append",
+        default=None,
+        help="The algorithm of a checksum manifest, e.g. sha256 for SHA256SUMS, that is written to the output directory along with the checksums.json manifest. The images are hashed as soon as they are built. Can be repeated.",
+    )
+    generate_multiple_group.add_argument(
+        "--shard",
+        dest="{}_shard".format(MULTIPLE),
+        default=None,
+        help="Only build the images of shard K out of N shards, given as K/N, such that N build nodes can split the architecture without any coordination.",
+    )
+    generate_multiple_group.add_argument(
+        "--shard-weighted",
+        dest="{}_shard_weighted".format(MULTIPLE),
+        action="store_true",
+        default=False,
+        help="Balance the shards by the size of the images instead of assigning the images by a stable hash of their input.",
+    )
+    generate_multiple_group.add_argument(
+        "--list-shards",
+        dest="{}_list_shards".format(MULTIPLE),
+        type=int,
+        default=None,
+        metavar="N",
+        help="List the images of each of N shards without building them.",
+    )
+    generate_multiple_group.add_argument(
+        "--report",
+        dest="{}_report_path".format(MULTIPLE),
+        default=None,
+        help="The path that a JSON report of the result of every image is written to. The reports of the shards can be combined with the merge command.",
+    )
+    generate_multiple_group.add_argument(
+        "--plan",
+        dest="{}_plan".format(MULTIPLE),
+        action="store_true",
+        default=False,
+        help="Print the plan of the build as JSON without building anything, i.e. the operations of every image, which inputs are cached or downloaded and their sizes, the estimated size of every output image, and the disk space that is required on each filesystem.",
+    )
+    generate_multiple_group.add_argument(
+        "-j",
+        "--jobs",
+        dest="{}_jobs".format(MULTIPLE),
+        type=int,
+        default=DEFAULT_ARCHITECTURE_JOBS,
+        help="The number of images, or groups of images that share an input, that are built concurrently.",
+    )
+    generate_multiple_group.add_argument(
+        "--network-jobs",
+        dest="{}_network_jobs".format(MULTIPLE),
+        type=int,
+        default=DEFAULT_NETWORK_JOBS,
+        help="The maximum number of concurrent downloads.",
+    )
+    generate_multiple_group.add_argument(
+        "--hash-jobs",
+        dest="{}_hash_jobs".format(MULTIPLE),
+        type=int,
+        default=DEFAULT_HASH_JOBS,
+        help="The maximum number of images that are hashed concurrently, by default the number of CPUs.",
+    )
+    generate_multiple_group.add_argument(
+        "--convert-jobs",
+        dest="{}_convert_jobs".format(MULTIPLE),
+        type=int,
+        default=DEFAULT_CONVERT_JOBS,
+        help="The maximum number of concurrent image conversions, decompressions and creations.",
+    )
+    generate_multiple_group.add_argument(
+        "--http-pool-size",
+        dest="{}_http_pool_size".format(MULTIPLE),
+        type=int,
+        default=DEFAULT_HTTP_POOL_SIZE,
+        help="The number of connections per host that are kept alive and reused across the downloads of the images.",
+    )
+    generate_multiple_group.add_argument(
+        "--http-proxy",
+        dest="{}_http_proxy".format(MULTIPLE),
+        default=None,
+        help="The proxy url that is used for http and https requests. By default the proxy environment variables are used.",
+    )
+    generate_multiple_group.add_argument(
+        "--http-ca-bundle",
+        dest="{}_http_ca_bundle".format(MULTIPLE),
+        default=None,
+        help="The path to a CA certificate bundle that is used to verify https connections.",
+    )
+    generate_multiple_group.add_argument(
+        "--retries",
+        dest="{}_retries".format(MULTIPLE),
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="The number of times that a download or qemu-img command is retried if it fails with a transient error, e.g. a reset connection, an HTTP 5xx or 429 response, or an image that is locked by another process.",
+    )
+    generate_multiple_group.add_argument(
+        "--retry-backoff",
+        dest="{}_retry_backoff".format(MULTIPLE),
+        type=float,
+        default=DEFAULT_RETRY_BACKOFF,
+        help="The number of seconds before the first retry, which is doubled for every following retry.",
+    )
+    generate_multiple_group.add_argument(
+        "--bandwidth-limit",
+        dest="{}_bandwidth_limit".format(MULTIPLE),
+        default=None,
+        help="The bytes per second that every download shares, e.g. 10M or 50MiB. Overrides the bandwidth_limit of the architecture file.",
+    )
+    generate_multiple_group.add_argument(
+        "--process-jobs",
+        dest="{}_process_jobs".format(MULTIPLE),
+        type=int,
+        default=DEFAULT_PROCESS_JOBS,
+        help="The maximum number of external commands, e.g. qemu-img, that run concurrently.",
+    )
+    generate_multiple_group.add_argument(
+        "--job-timeout",
+        dest="{}_job_timeout".format(MULTIPLE),
+        type=float,
+        default=DEFAULT_JOB_TIMEOUT,
+        help="The number of seconds after which an external command, e.g. a qemu-img conversion that hangs on an unresponsive mount, is terminated. The qemu-img commands that only read or write the image metadata always have a shorter timeout.",
+    )
+    generate_multiple_group.add_argument(
+        "--nice",
+        dest="{}_nice".format(MULTIPLE),
+        type=int,
+        default=None,
+        help="The nice level, from -20 to 19, that the external commands and the hashing run with. A higher level leaves more CPU time to the other processes of the host.",
+    )
+    generate_multiple_group.add_argument(
+        "--io-class",
+        dest="{}_io_class".format(MULTIPLE),
+        choices=list(IO_CLASSES),
+        default=None,
+        help="The I/O scheduling class, as with ionice, that the external commands and the hashing run with. 'idle' only uses the disks when no other process does.",
+    )
+    generate_multiple_group.add_argument(
+        "--io-priority",
+        dest="{}_io_priority".format(MULTIPLE),
+        type=int,
+        default=None,
+        help="The priority within the --io-class, from 0 (highest) to 7 (lowest).",
+    )
+    generate_multiple_group.add_argument(
+        "--cpu-affinity",
+        dest="{}_cpu_affinity".format(MULTIPLE),
+        default=None,
+        help="The CPUs, e.g. 0-3,6, that the external commands and the hashing are restricted to.",
+    )
+    generate_multiple_group.add_argument(
+        "-p",
+        "--progress",
+        dest="{}_progress".format(MULTIPLE),
+        choices=PROGRESS_MODES,
+        default=PROGRESS_NONE,
+        help="Emit machine-readable progress events while the images are being generated. 'ndjson' emits one JSON object per line.",
+    )
+    generate_multiple_group.add_argument(
+        "-pfd",
+        "--progress-fd",
+        dest="{}_progress_fd".format(MULTIPLE),
+        type=int,
+        default=DEFAULT_PROGRESS_FD,
+        help="The file descriptor that the progress events are written to.",
+    )
     generate_multiple_group.add_argument(
         "--verbose",
         "-v",
@@ -0,0 +1,63 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from gen_vm_image.common.defaults import (
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_SERVER_CONCURRENCY,
+    DEFAULT_SERVER_SOCKET,
+    SERVE,
+)
+
+
+def serve_group(parser):
+    build_server_group = parser.add_argument_group(
+        title="Run a build server that accepts image build jobs"
+    )
+
+    build_server_group.add_argument(
+        "-s",
+        "--socket-path",
+        dest="{}_socket_path".format(SERVE),
+        default=DEFAULT_SERVER_SOCKET,
+        help="The path to the UNIX socket that the server listens on.",
+    )
+    build_server_group.add_argument(
+        "-c",
+        "--concurrency",
+        dest="{}_concurrency".format(SERVE),
+        default=DEFAULT_SERVER_CONCURRENCY,
+        type=int,
+        help="The maximum number of build jobs that are run at the same time.",
+    )
+    build_server_group.add_argument(
+        "--http-pool-size",
+        dest="{}_http_pool_size".format(SERVE),
+        type=int,
+        default=DEFAULT_HTTP_POOL_SIZE,
+        help="The number of connections per host that are kept alive and reused across the downloads of every job.",
+    )
+    build_server_group.add_argument(
+        "--http-proxy",
+        dest="{}_http_proxy".format(SERVE),
+        default=None,
+        help="The proxy url that is used for http and https requests. By default the proxy environment variables are used.",
+    )
+    build_server_group.add_argument(
+        "--http-ca-bundle",
+        dest="{}_http_ca_bundle".format(SERVE),
+        default=None,
+        help="The path to a CA certificate bundle that is used to verify https connections.",
+    )
@@ -17,7 +17,17 @@
 from gen_vm_image.cli.parsers.actions import PositionalArgumentsAction
 from gen_vm_image.common.defaults import (
     DEFAULT_BUFFER_SIZE,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_JOB_TIMEOUT,
+    DEFAULT_PROCESS_JOBS,
+    DEFAULT_PROGRESS_FD,
+    DEFAULT_RETRIES,
+    DEFAULT_RETRY_BACKOFF,
     GENERATED_IMAGE_DIR,
+    IO_CLASSES,
+    PROGRESS_MODES,
+    PROGRESS_NONE,
     SINGLE,
 )
 
@@ -46,6 +56,14 @@ def single_group(parser):
         default=None,
         help="The path or url to the input image that the generated image should be based on.",
     )
+    generate_single_group.add_argument(
+        "-im",
+        "--input-mirror",
+        dest="{}_input_mirrors".format(SINGLE),
+        action="append",
+        default=None,
+        help="An additional mirror url of the --input url. Can be repeated. The image is downloaded from the fastest mirror and the other mirrors are used if it fails.",
+    )
     generate_single_group.add_argument(
         "-if",
         "--input-format",
@@ -67,6 +85,13 @@ def single_group(parser):
         default=None,
         help="The checksum that should be used to validate the input image if set.",
     )
+    generate_single_group.add_argument(
+        "-icu",
+        "--input-checksum-url",
+        dest="{}_input_checksum_url".format(SINGLE),
+        default=None,
+        help="The url of a checksum manifest, such as a SHA256SUMS file, that the checksum of the input image is looked up in by its filename, instead of setting --input-checksum.",
+    )
     generate_single_group.add_argument(
         "-icbs",
         "--input-checksum-buffer-size",
@@ -82,6 +107,43 @@ def single_group(parser):
         type=int,
         help="The amount of bytes that should be read from the input image to be used to calculate the expected checksum value.",
     )
+    generate_single_group.add_argument(
+        "-icd",
+        "--input-checksum-decompressed",
+        dest="{}_input_checksum_decompressed".format(SINGLE),
+        action="store_true",
+        default=False,
+        help="Whether the input checksum applies to the decompressed input image instead of the compressed one.",
+    )
+    generate_single_group.add_argument(
+        "-icf",
+        "--input-checksum-force",
+        dest="{}_input_checksum_force".format(SINGLE),
+        action="store_true",
+        default=False,
+        help="Always calculate the checksum of the input image, instead of reusing the checksum of an unchanged input image that was verified before.",
+    )
+    generate_single_group.add_argument(
+        "-icat",
+        "--input-checksum-additional-type",
+        dest="{}_input_checksum_types".format(SINGLE),
+        action="append",
+        default=None,
+        help="An additional checksum type of the input image that is calculated in the same read as the verified checksum and included in the output. Can be repeated.",
+    )
+    generate_single_group.add_argument(
+        "--input-cache-ttl",
+        dest="{}_input_cache_ttl".format(SINGLE),
+        type=int,
+        default=DEFAULT_CACHE_TTL,
+        help="The number of seconds that a previously downloaded input image is reused without checking whether it has changed upstream. A negative value never checks.",
+    )
+    generate_single_group.add_argument(
+        "--input-bandwidth-limit",
+        dest="{}_input_bandwidth_limit".format(SINGLE),
+        default=None,
+        help="The bytes per second that the download of the input image is limited to, e.g. 10M or 50MiB.",
+    )
     generate_single_group.add_argument(
         "-od",
         "--output-directory",
@@ -96,12 +158,123 @@ def single_group(parser):
         default="qcow2",
         help="The format of the output image.",
     )
+    generate_single_group.add_argument(
+        "--compact",
+        dest="{}_compact".format(SINGLE),
+        action="store_true",
+        default=False,
+        help="Convert an input image that already is in the output format instead of cloning it, which drops its unused clusters.",
+    )
+    generate_single_group.add_argument(
+        "-oct",
+        "--output-checksum-type",
+        dest="{}_output_checksum_types".format(SINGLE),
+        action="append",
+        default=None,
+        help="A checksum type of the generated image that is calculated after it is generated and included in the output. Can be repeated, in which case every checksum is calculated in a single read of the image.",
+    )
     generate_single_group.add_argument(
         "-V",
         "--version",
         dest="{}_version".format(SINGLE),
         help="The version of the image that is generated.",
     )
+    generate_single_group.add_argument(
+        "--http-pool-size",
+        dest="{}_http_pool_size".format(SINGLE),
+        type=int,
+        default=DEFAULT_HTTP_POOL_SIZE,
+        help="The number of connections per host that are kept alive and reused when downloading the input image.",
+    )
+    generate_single_group.add_argument(
+        "--http-proxy",
+        dest="{}_http_proxy".format(SINGLE),
+        default=None,
+        help="The proxy url that is used for http and https requests. By default the proxy environment variables are used.",
+    )
+    generate_single_group.add_argument(
+        "--http-ca-bundle",
+        dest="{}_http_ca_bundle".format(SINGLE),
+        default=None,
+        help="The path to a CA certificate bundle that is used to verify https connections.",
+    )
+    generate_single_group.add_argument(
+        "--retries",
+        dest="{}_retries".format(SINGLE),
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="The number of times that a download or qemu-img command is retried if it fails with a transient error, e.g. a reset connection, an HTTP 5xx or 429 response, or an image that is locked by another process.",
+    )
+    generate_single_group.add_argument(
+        "--retry-backoff",
+        dest="{}_retry_backoff".format(SINGLE),
+        type=float,
+        default=DEFAULT_RETRY_BACKOFF,
+        help="The number of seconds before the first retry, which is doubled for every following retry.",
+    )
+    generate_single_group.add_argument(
+        "--bandwidth-limit",
+        dest="{}_bandwidth_limit".format(SINGLE),
+        default=None,
+        help="The bytes per second that every download shares, e.g. 10M or 50MiB.",
+    )
+    generate_single_group.add_argument(
+        "--process-jobs",
+        dest="{}_process_jobs".format(SINGLE),
+        type=int,
+        default=DEFAULT_PROCESS_JOBS,
+        help="The maximum number of external commands, e.g. qemu-img, that run concurrently.",
+    )
+    generate_single_group.add_argument(
+        "--job-timeout",
+        dest="{}_job_timeout".format(SINGLE),
+        type=float,
+        default=DEFAULT_JOB_TIMEOUT,
+        help="The number of seconds after which an external command, e.g. a qemu-img conversion that hangs on an unresponsive mount, is terminated. The qemu-img commands that only read or write the image metadata always have a shorter timeout.",
+    )
+    generate_single_group.add_argument(
+        "--nice",
+        dest="{}_nice".format(SINGLE),
+        type=int,
+        default=None,
+        help="The nice level, from -20 to 19, that the external commands and the hashing run with. A higher level leaves more CPU time to the other processes of the host.",
+    )
+    generate_single_group.add_argument(
+        "--io-class",
+        dest="{}_io_class".format(SINGLE),
+        choices=list(IO_CLASSES),
+        default=None,
+        help="The I/O scheduling class, as with ionice, that the external commands and the hashing run with. 'idle' only uses the disks when no other process does.",
+    )
+    generate_single_group.add_argument(
+        "--io-priority",
+        dest="{}_io_priority".format(SINGLE),
+        type=int,
+        default=None,
+        help="The priority within the --io-class, from 0 (highest) to 7 (lowest).",
+    )
+    generate_single_group.add_argument(
+        "--cpu-affinity",
+        dest="{}_cpu_affinity".format(SINGLE),
+        default=None,
+        help="The CPUs, e.g. 0-3,6, that the external commands and the hashing are restricted to.",
+    )
+    generate_single_group.add_argument(
+        "-p",
+        "--progress",
+        dest="{}_progress".format(SINGLE),
+        choices=PROGRESS_MODES,
+        default=PROGRESS_NONE,
+        help="Emit machine-readable progress events while the image is being generated. 'ndjson' emits one JSON object per line.",
+    )
+    generate_single_group.add_argument(
+        "-pfd",
+        "--progress-fd",
+        dest="{}_progress_fd".format(SINGLE),
+        type=int,
+        default=DEFAULT_PROGRESS_FD,
+        help="The file descriptor that the progress events are written to.",
+    )
     generate_single_group.add_argument(
         "--verbose",
         "-v",
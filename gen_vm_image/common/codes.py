@@ -38,3 +38,21 @@ JSON_DUMP_ERROR_MSG = "Failed to dump JSON: {}"
 DOWNLOAD_ERROR = 10
 GETSIZE_ERROR = 11
 GETSIZE_ERROR_MSG = "Failed to get the size of path {}"
+DECOMPRESS_ERROR = 12
+DECOMPRESS_ERROR_MSG = "Failed to decompress path: {} - error: {}"
+ARCHITECTURE_VALIDATION_ERROR_MSG = "Invalid architecture file: {} - errors: {}"
+JOB_ERROR = 13
+JOB_ERROR_MSG = "Job: {} failed with an unexpected error: {}"
+JOB_CANCELLED_ERROR = 14
+JOB_CANCELLED_ERROR_MSG = "The job was cancelled"
+JOB_TIMEOUT_ERROR_MSG = "Command: {} timed out after {} seconds"
+SERVER_ERROR = 15
+SERVER_ERROR_MSG = "Failed to start the build server: {}"
+CHECKSUM_MANIFEST_ERROR = 16
+CHECKSUM_MANIFEST_ERROR_MSG = (
+    "Failed to find the checksum of: {} in the manifest: {} - error: {}"
+)
+SHARD_ERROR = 17
+SHARD_ERROR_MSG = "Invalid shard: {} - {}"
+MERGE_ERROR = 18
+MERGE_ERROR_MSG = "Failed to merge the shard reports: {} - error: {}"
@@ -14,6 +14,9 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import errno
+import os
+
 PACKAGE_NAME = "gen-vm-image"
 REPO_NAME = "gen-vm-image"
 GOCD_GROUP = "bare_metal_vm_image"
@@ -25,15 +28,213 @@ IMAGE_CONFIG_DIR = "image-config"
 GENERATED_IMAGE_DIR = "generated-images"
 VM_DISK_DIR = "vmdisks"
 TMP_DIR = "tmp"
+# The directory in the TMP_DIR that checksum manifests are cached in
+CHECKSUM_MANIFEST_DIR = "checksum-manifests"
 CONSITENCY_SUPPPORTED_FORMATS = ["qcow2", "qed", "parallels", "vhdx", "vdi"]
 
 # CLI
 SINGLE = "single"
 MULTIPLE = "multiple"
+SERVE = "serve"
+MERGE = "merge"
 
 GEN_VM_IMAGE_CLI_STRUCTURE = [
     SINGLE,
     MULTIPLE,
+    SERVE,
+    MERGE,
 ]
 
 DEFAULT_BUFFER_SIZE = 65536
+# The buffer size when calculating several digests in a single read
+DEFAULT_HASHSUMS_BUFFER_SIZE = 4 * 1024 * 1024
+# The digests are calculated in parallel threads for buffers of at least this size
+PARALLEL_HASH_MIN_BUFFER_SIZE = 1024 * 1024
+DEFAULT_DECOMPRESS_BUFFER_SIZE = 1024 * 1024
+
+# Architecture
+DEFAULTS = "defaults"
+MATRIX = "matrix"
+MATRIX_EXCLUDE = "exclude"
+MATRIX_IMAGE_ATTRIBUTES = ["name", "version", "size", "format"]
+
+# Server
+DEFAULT_SERVER_SOCKET = "gen-vm-image.sock"
+DEFAULT_SERVER_CONCURRENCY = 1
+DEFAULT_SERVER_HISTORY = 1000
+
+# Batch
+DEFAULT_BATCH_CONCURRENCY = 4
+
+# Progress
+PROGRESS_NONE = "none"
+PROGRESS_NDJSON = "ndjson"
+PROGRESS_MODES = [PROGRESS_NONE, PROGRESS_NDJSON]
+# Write the progress events to stderr by default such that they do not
+# interleave with the JSON result that is printed to stdout
+DEFAULT_PROGRESS_FD = 2
+# The minimum number of seconds between two progress events of the same stage
+DEFAULT_PROGRESS_INTERVAL = 1.0
+
+# Download
+# The read size is adapted between the min and max read size
+DEFAULT_DOWNLOAD_MIN_READ_SIZE = 256 * 1024
+DEFAULT_DOWNLOAD_MAX_READ_SIZE = 8 * 1024 * 1024
+# The read size is grown while reads take less than this number of seconds
+DEFAULT_DOWNLOAD_READ_DURATION = 0.05
+# The minimum number of seconds between two download progress updates
+DEFAULT_DOWNLOAD_PROGRESS_INTERVAL = 0.1
+# The number of seconds of a throttled download that each read covers, which
+# bounds how far the download can burst above its bandwidth limit
+DEFAULT_BANDWIDTH_CHUNK_DURATION = 0.02
+DEFAULT_BANDWIDTH_MIN_CHUNK_SIZE = 16 * 1024
+# The multipliers of the units of a bandwidth limit, e.g. 10M or 50MiB
+BANDWIDTH_UNITS = {
+    "": 1,
+    "K": 1000,
+    "M": 1000**2,
+    "G": 1000**3,
+    "KI": 1024,
+    "MI": 1024**2,
+    "GI": 1024**3,
+}
+# The number of connections per host that are kept alive for reuse
+DEFAULT_HTTP_POOL_SIZE = 10
+
+# Mirrors
+# The number of seconds to wait for a mirror to respond to a probe
+DEFAULT_MIRROR_PROBE_TIMEOUT = 5
+# The file in the TMP_DIR that the mirror statistics are kept in
+DEFAULT_MIRROR_STATS_FILE = "mirror-stats.json"
+# The weight of the latest measurement in the moving averages of the statistics
+MIRROR_STATS_WEIGHT = 0.3
+
+# Cache
+# The number of seconds that a cached download is used without revalidating
+# it with the server, a negative TTL never revalidates the cached download
+DEFAULT_CACHE_TTL = 0
+# The number of seconds to wait for the server to respond to a revalidation
+DEFAULT_CACHE_REVALIDATE_TIMEOUT = 10
+
+# Digests
+# The file in the TMP_DIR that the digests of hashed files are indexed in
+DEFAULT_DIGEST_INDEX_FILE = "digest-index.json"
+# The digests of files that were modified less than this many seconds
+# before they were hashed are only used once the files are unchanged
+# after the window, see DigestIndex
+DIGEST_INDEX_RACY_WINDOW = 2.0
+# The number of images that are hashed at the same time after they are built
+DEFAULT_DIGEST_WORKERS = min(4, os.cpu_count() or 1)
+# The JSON manifest of the checksums of the images in the output directory
+DEFAULT_OUTPUT_MANIFEST_FILE = "checksums.json"
+
+# Output publication
+# The suffix of the hidden files that images are built in before they are
+# published to the output directory, e.g. .image.qcow2.<pid>.staging
+STAGING_SUFFIX = ".staging"
+
+# Locking
+# The suffix of the hidden lock files that coordinate concurrent builds,
+# e.g. .rocky.qcow2.lock
+LOCK_SUFFIX = ".lock"
+# The number of seconds between the attempts to acquire a held lock
+DEFAULT_LOCK_POLL_INTERVAL = 0.1
+
+# Scheduling
+# The number of image groups of an architecture that are built concurrently
+DEFAULT_ARCHITECTURE_JOBS = 1
+# The kinds of stages that have separate concurrency limits
+SCHEDULER_NETWORK = "network"
+SCHEDULER_HASH = "hash"
+SCHEDULER_CONVERT = "convert"
+# The number of concurrent stages of each kind
+DEFAULT_NETWORK_JOBS = 4
+DEFAULT_HASH_JOBS = os.cpu_count() or 1
+DEFAULT_CONVERT_JOBS = 2
+# The number of bytes that are kept free on a filesystem that images are written to
+DEFAULT_DISK_SPACE_MARGIN = 1024 * 1024 * 1024
+# The number of seconds between the checks of the free space for a delayed stage
+DEFAULT_SCHEDULER_POLL_INTERVAL = 5.0
+
+# Subprocesses
+# The maximum number of external commands, e.g. qemu-img, that run concurrently
+DEFAULT_PROCESS_JOBS = 2 * (os.cpu_count() or 1)
+# The number of seconds after which a command is killed, None is no limit
+DEFAULT_JOB_TIMEOUT = None
+# The per command timeouts of the qemu-img actions that only touch the metadata
+# of an image, which are far shorter than those of a conversion or check
+QEMU_IMG_TIMEOUTS = {
+    "amend": 600,
+    "create": 600,
+    "info": 120,
+    "measure": 120,
+    "resize": 600,
+}
+# The number of bytes of the stdout and stderr of a command that are kept
+DEFAULT_JOB_OUTPUT_LIMIT = 1024 * 1024
+# The number of seconds that a terminated command is given before it is killed
+DEFAULT_JOB_KILL_TIMEOUT = 10.0
+# The I/O scheduling classes of ioprio_set(2) by the names that ionice(1) uses
+IO_CLASSES = {"none": 0, "realtime": 1, "best-effort": 2, "idle": 3}
+# The range of the nice levels and of the priorities within an I/O class
+MIN_NICE = -20
+MAX_NICE = 19
+MAX_IO_PRIORITY = 7
+
+# Retries
+# The stages that are retried, i.e. downloads and the qemu-img actions
+RETRY_DOWNLOAD = "download"
+RETRY_STAGES = [RETRY_DOWNLOAD, "amend", "check", "convert", "create", "resize"]
+# The number of times a failed stage is retried if its error is transient
+DEFAULT_RETRIES = 3
+# The number of seconds before the first retry, which is multiplied by
+# the multiplier for every following retry up to the max backoff
+DEFAULT_RETRY_BACKOFF = 2.0
+DEFAULT_RETRY_MULTIPLIER = 2.0
+DEFAULT_RETRY_MAX_BACKOFF = 60.0
+# The fraction of a backoff that is randomly subtracted from it
+DEFAULT_RETRY_JITTER = 0.5
+# The maximum number of seconds of a Retry-After header that is honored
+DEFAULT_RETRY_MAX_RETRY_AFTER = 300.0
+RETRYABLE_HTTP_STATUS_CODES = [408, 425, 429, 500, 502, 503, 504]
+RETRYABLE_ERRNOS = [
+    errno.EAGAIN,
+    errno.ECONNABORTED,
+    errno.ECONNREFUSED,
+    errno.ECONNRESET,
+    errno.EHOSTUNREACH,
+    errno.ENETUNREACH,
+    errno.EPIPE,
+    errno.ETIMEDOUT,
+]
+# The qemu-img errors of an image that is temporarily locked by another process
+QEMU_IMG_RETRYABLE_ERRORS = [
+    'Failed to get "write" lock',
+    'Failed to get shared "write" lock',
+    'Failed to get "consistent read" lock',
+    "Failed to lock byte",
+    "Resource temporarily unavailable",
+]
+
+# Planning
+# How the input of a planned build is obtained
+PLAN_INPUT_CACHED = "cached"
+PLAN_INPUT_DOWNLOAD = "download"
+PLAN_INPUT_LOCAL = "local"
+PLAN_INPUT_MISSING = "missing"
+# What is done with a planned image
+PLAN_IMAGE_BUILD = "build"
+PLAN_IMAGE_OVERWRITE = "overwrite"
+PLAN_IMAGE_SKIP = "skip"
+
+# Cloning
+# The ioctl request that shares the extents of a file with another file
+FICLONE = 0x40049409
+# How an input image was cloned instead of converted
+CLONE_REFLINK = "reflink"
+CLONE_COPY_FILE_RANGE = "copy_file_range"
+# The formats of which an image file can be cloned as is, without
+# the risk of it referring to other files, such as a qcow2 backing file
+CLONE_SUPPORTED_FORMATS = ["raw", "qcow2"]
+# The maximum number of bytes that are copied by each copy_file_range call
+DEFAULT_COPY_FILE_RANGE_SIZE = 1024 * 1024 * 1024
@@ -14,7 +14,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import contextlib
+import hashlib
+import json
 import os
+import re
+import uuid
 
 import validators
 
@@ -22,6 +27,10 @@ from gen_vm_image.common.codes import (
     CHECK_ERROR,
     CHECK_ERROR_MSG,
     CHECKSUM_ERROR,
+    CHECKSUM_MANIFEST_ERROR,
+    CHECKSUM_MANIFEST_ERROR_MSG,
+    DECOMPRESS_ERROR,
+    DECOMPRESS_ERROR_MSG,
     DOWNLOAD_ERROR,
     GETSIZE_ERROR,
     GETSIZE_ERROR_MSG,
@@ -38,55 +47,174 @@ from gen_vm_image.common.codes import (
     SUCCESS,
 )
 from gen_vm_image.common.defaults import (
+    CLONE_SUPPORTED_FORMATS,
     CONSITENCY_SUPPPORTED_FORMATS,
     DEFAULT_BUFFER_SIZE,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_HASHSUMS_BUFFER_SIZE,
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_PROGRESS_FD,
+    DEFAULT_RETRIES,
+    DEFAULT_RETRY_BACKOFF,
     GENERATED_IMAGE_DIR,
+    QEMU_IMG_TIMEOUTS,
+    RETRY_DOWNLOAD,
+    SCHEDULER_CONVERT,
+    SCHEDULER_HASH,
+    SCHEDULER_NETWORK,
     TMP_DIR,
 )
-from gen_vm_image.utils.io import exists, hashsum, makedirs
+from gen_vm_image.utils.cache import (
+    new_cache_metadata,
+    remote_size,
+    revalidate_cache,
+    save_cache_metadata,
+)
+from gen_vm_image.utils.clone import clone_file
+from gen_vm_image.utils.compression import (
+    decompress_file,
+    decompressed_size,
+    detect_compression,
+    strip_compression_extension,
+)
+from gen_vm_image.utils.digests import DigestIndex, index_digest
+from gen_vm_image.utils.headers import read_image_header
+from gen_vm_image.utils.io import (
+    exists,
+    hashsums,
+    makedirs,
+    publish,
+    remove,
+    remove_stale_staging_files,
+)
 from gen_vm_image.utils.io import size as get_size
-from gen_vm_image.utils.job import run
-from gen_vm_image.utils.net import download_file
+from gen_vm_image.utils.io import staging_path
+from gen_vm_image.utils.job import (
+    priority_verbose_outputs,
+    run_async,
+    run_in_worker,
+    run_streaming_async,
+)
+from gen_vm_image.utils.lock import FileLock
+from gen_vm_image.utils.manifest import ChecksumManifests, url_filename
+from gen_vm_image.utils.mirrors import MirrorStats, download_from_mirrors
+from gen_vm_image.utils.net import download_file, http_session
+from gen_vm_image.utils.progress import (
+    IMAGE_COMPLETE,
+    new_progress_reporter,
+    stage,
+    stage_callback,
+)
+from gen_vm_image.utils.retry import (
+    Retrier,
+    retried,
+    retry_verbose_outputs,
+    retryable_qemu_img_error,
+)
+from gen_vm_image.utils.scheduler import reserved, scheduled
+from gen_vm_image.utils.throttle import new_bandwidth, parse_bandwidth
+
+# The progress that qemu-img prints with -p, e.g. '    (42.50/100%)'
+QEMU_IMG_PROGRESS_REGEX = re.compile(r"\((\d+(?:\.\d+)?)/100%\)")
+
+
+async def qemu_img_call(
+    action,
+    args,
+    format_output_str=True,
+    verbose=False,
+    on_progress=None,
+    retrier=None,
+):
+    """If on_progress is set, the action must support the -p option and
+    on_progress is called with the completed percentage as it changes.
+    If retrier is set, the action is retried while the image is locked
+    by another process."""
+    return await retried(
+        retrier,
+        action,
+        _qemu_img_call,
+        action,
+        args,
+        format_output_str=format_output_str,
+        verbose=verbose,
+        on_progress=on_progress,
+        classify=retryable_qemu_img_error,
+    )
 
 
-async def qemu_img_call(action, args, format_output_str=True, verbose=False):
+async def _qemu_img_call(
+    action, args, format_output_str=True, verbose=False, on_progress=None
+):
     command = ["qemu-img", action]
-    if not verbose:
+    if on_progress:
+        # -q would suppress the progress output
+        command.append("-p")
+    elif not verbose:
         command.append("-q")
     command.extend(args)
 
-    result = run(command, format_output_str=format_output_str, capture_output=True)
+    if on_progress:
+
+        def on_output(line):
+            match = QEMU_IMG_PROGRESS_REGEX.search(line)
+            if match:
+                on_progress(float(match.group(1)), 100)
+
+        result = await run_streaming_async(
+            command,
+            on_output,
+            format_output_str=format_output_str,
+            timeout=QEMU_IMG_TIMEOUTS.get(action, None),
+        )
+    else:
+        result = await run_async(
+            command,
+            format_output_str=format_output_str,
+            timeout=QEMU_IMG_TIMEOUTS.get(action, None),
+        )
     if result["returncode"] != "0":
         return False, result["error"]
     return True, result["output"]
 
 
-async def create_image(path, size, image_format="qcow2", verbose=False):
+async def create_image(path, size, image_format="qcow2", verbose=False, retrier=None):
     args = ["-f", image_format, path, size]
-    result, msg = await qemu_img_call("create", args, verbose=verbose)
+    result, msg = await qemu_img_call("create", args, verbose=verbose, retrier=retrier)
     if not result:
         return False, msg
     return True, msg
 
 
 async def convert_image(
-    input_path, output_path, input_format="qcow2", output_format="qcow2", verbose=False
+    input_path,
+    output_path,
+    input_format="qcow2",
+    output_format="qcow2",
+    verbose=False,
+    on_progress=None,
+    retrier=None,
 ):
     args = ["-f", input_format, "-O", output_format, input_path, output_path]
-    result, msg = await qemu_img_call("convert", args, verbose=verbose)
+    result, msg = await qemu_img_call(
+        "convert", args, verbose=verbose, on_progress=on_progress, retrier=retrier
+    )
     if not result:
         return False, msg
     return True, msg
 
 
 async def resize_image(
-    path, size, image_format="qcow2", resize_args=None, verbose=False
+    path, size, image_format="qcow2", resize_args=None, verbose=False, retrier=None
 ):
     if not resize_args:
         resize_args = []
 
     result, msg = await qemu_img_call(
-        "resize", [*resize_args, "-f", image_format, path, size], verbose=verbose
+        "resize",
+        [*resize_args, "-f", image_format, path, size],
+        verbose=verbose,
+        retrier=retrier,
     )
     if not result:
         return False, msg
@@ -99,28 +227,125 @@ async def info_image(path, info_args=None, format_output_str=True):
 
     # The info call does not support verbosity/the -q option
     command = ["qemu-img", "info", *info_args, path]
-    result = run(command, format_output_str=format_output_str, capture_output=True)
+    result = await run_async(
+        command,
+        format_output_str=format_output_str,
+        timeout=QEMU_IMG_TIMEOUTS["info"],
+    )
     if result["returncode"] != "0":
         return False, result["error"]
     return True, result["output"]
 
 
-async def amend_image(path, options, image_format="qcow2", verbose=False):
+async def measure_image(output_format, path=None, image_format=None, size=None):
+    """Returns the number of bytes that an output_format image requires when
+    it is converted from the image at path, or is created with size, or
+    False if it could not be measured."""
+    command = ["qemu-img", "measure", "--output=json", "-O", output_format]
+    if path:
+        if image_format:
+            command.extend(["-f", image_format])
+        command.append(path)
+    else:
+        command.extend(["--size", str(size)])
+    try:
+        result = await run_async(command, timeout=QEMU_IMG_TIMEOUTS["measure"])
+    except OSError:
+        return False
+    if result["returncode"] != 0:
+        return False
+    try:
+        return int(json.loads(result["output"])["required"])
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+async def estimate_image_size(output_format, path=None, image_format=None, size=None):
+    """Returns the estimated number of bytes that an output_format image
+    takes up on disk, see measure_image. The size of the input image is used
+    if the image could not be measured."""
+    measured = await measure_image(
+        output_format, path=path, image_format=image_format, size=size
+    )
+    if measured is not False:
+        return measured
+    if path and exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+def can_clone_image(path, image_format):
+    """Returns whether the image at path is a standalone image_format file
+    that can be cloned as is, i.e. a qcow2 image without a backing file or
+    an external data file. The header is read in-process since the
+    clone is meant to be cheaper than a call to qemu-img."""
+    if image_format not in CLONE_SUPPORTED_FORMATS:
+        return False
+    if image_format == "raw":
+        return True
+    header = read_image_header(path)
+    return bool(
+        header
+        and header["format"] == image_format
+        and not header["has_backing_file"]
+        and not header["data_file"]
+    )
+
+
+async def detect_image_format(path):
+    """Returns the format of the image at path. The format is read from
+    the header of the image, and qemu-img is only asked if the header is
+    not of a format that is recognised in-process. An image that qemu-img
+    can't identify either is raw."""
+    header = read_image_header(path)
+    if header:
+        return header["format"]
+    try:
+        found, info = await info_image(path, info_args=["--output=json"])
+    except OSError:
+        found = False
+    if found:
+        try:
+            return json.loads(info)["format"]
+        except (ValueError, KeyError, TypeError):
+            pass
+    return "raw"
+
+
+async def image_virtual_size(path):
+    """Returns the size of the disk that the image at path holds, as
+    opposed to the size of the image file."""
+    header = read_image_header(path)
+    if header and header["virtual_size"] is not None:
+        return header["virtual_size"]
+    try:
+        found, info = await info_image(path, info_args=["--output=json"])
+    except OSError:
+        found = False
+    if found:
+        try:
+            return int(json.loads(info)["virtual-size"])
+        except (ValueError, KeyError, TypeError):
+            pass
+    return get_size(path)
+
+
+async def amend_image(path, options, image_format="qcow2", verbose=False, retrier=None):
     args = ["-f", image_format, "-o", options, path]
-    result, msg = await qemu_img_call("amend", args, verbose=verbose)
+    result, msg = await qemu_img_call("amend", args, verbose=verbose, retrier=retrier)
     if not result:
         return False, msg
     return True, msg
 
 
-async def check_image(path, image_format="qcow2", verbose=False):
+async def check_image(path, image_format="qcow2", verbose=False, retrier=None):
     if image_format not in CONSITENCY_SUPPPORTED_FORMATS:
         msg = "format: '{}' not supported for consistency check, only one of: {} is supported".format(
             image_format, CONSITENCY_SUPPPORTED_FORMATS
         )
         return False, msg
     result, msg = await qemu_img_call(
-        "check", ["-f", image_format, path], verbose=verbose
+        "check", ["-f", image_format, path], verbose=verbose, retrier=retrier
     )
     if not result:
         return False, msg
@@ -174,37 +399,699 @@ def expand_byte_magnitude(bytesize):
     return expanded_bytesize
 
 
+def input_cache_path(url):
+    """Returns the path that the input image at url is downloaded to,
+    which is named after the url without its query string."""
+    filename = url_filename(url)
+    if not filename:
+        filename = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(TMP_DIR, filename)
+
+
+def decompressed_input_path(input_path, compression):
+    """Returns the path that the compressed input_path is decompressed to.
+    The path is a staging file in the TMP_DIR that is unique to each call,
+    such that a build never uses, or removes, the decompressed image of
+    another build, and those of builds that were killed are removed by
+    remove_stale_staging_files."""
+    name, extension = os.path.splitext(
+        strip_compression_extension(os.path.basename(input_path), compression)
+    )
+    return staging_path(
+        os.path.join(TMP_DIR, "{}.{}{}".format(name, uuid.uuid4().hex, extension))
+    )
+
+
+def image_output_path(
+    name, output_format, output_directory=GENERATED_IMAGE_DIR, version=None
+):
+    if version:
+        return os.path.join(
+            output_directory,
+            "{}-{}.{}".format(name, version, output_format),
+        )
+    return os.path.join(output_directory, "{}.{}".format(name, output_format))
+
+
+async def prepare_input(
+    input_,
+    input_format=None,
+    input_checksum_type=None,
+    input_checksum=None,
+    input_checksum_url=None,
+    input_checksum_buffer_size=DEFAULT_BUFFER_SIZE,
+    input_checksum_read_bytes=None,
+    input_checksum_decompressed=False,
+    input_checksum_force=False,
+    input_checksum_types=None,
+    input_cache_ttl=DEFAULT_CACHE_TTL,
+    verbose=False,
+    progress=None,
+    session=None,
+    checksum_manifests=None,
+    # The ResourceScheduler that admits the stages of concurrent builds
+    scheduler=None,
+    # The Retrier that retries the stages that failed transiently
+    retrier=None,
+    # The bytes per second that the download of the input is limited to
+    input_bandwidth_limit=None,
+    # The TokenBucket of the bandwidth that the downloads of the build share
+    shared_bandwidth=None,
+    # The list that the intermediate files of the prepared input, i.e. the
+    # decompressed image, are added to, which the caller removes once it
+    # no longer uses the prepared input
+    intermediate_paths=None,
+):
+    """Downloads, decompresses and verifies the input image such that it is
+    ready to be converted. On success, the response contains the local
+    'input_path' and the 'input_format' of the prepared input image.
+    The input_ is either a path, a url or a list of mirror urls of the image.
+    A previously downloaded image is reused if the server reports that it
+    is unchanged, or if it was validated less than input_cache_ttl seconds ago.
+    If input_checksum_url is set instead of input_checksum, the checksum is
+    looked up in the manifest at that url, which is only fetched once for
+    the ChecksumManifests of the build. The checksum of an image that is
+    unchanged since it was last verified is looked up in the DigestIndex,
+    unless input_checksum_force is set. The checksums of any additional
+    input_checksum_types are calculated in the same read as the verified
+    checksum and are returned in 'input_checksums'.
+    The stages are reported to the progress reporter if one is given,
+    and the input is downloaded with the HTTP session if one is given."""
+    response = {}
+    verbose_outputs = []
+
+    mirror_urls = []
+    if isinstance(input_, (list, tuple)):
+        mirror_urls = list(input_)
+        if not mirror_urls or not all(
+            isinstance(url, str) and validators.url(url) for url in mirror_urls
+        ):
+            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(input_), input_, "non-empty list of urls"
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return INVALID_ATTRIBUTE_TYPE_ERROR, response
+        # The image is named after the first mirror
+        input_ = mirror_urls[0]
+
+    if not isinstance(input_, str):
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(input_), input_, "string"
+        )
+        response["verbose_outputs"] = verbose_outputs
+        return INVALID_ATTRIBUTE_TYPE_ERROR, response
+
+    if input_cache_ttl is not None and not isinstance(input_cache_ttl, (int, float)):
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(input_cache_ttl), input_cache_ttl, "number"
+        )
+        response["verbose_outputs"] = verbose_outputs
+        return INVALID_ATTRIBUTE_TYPE_ERROR, response
+
+    # If a checksum is present, then validate that it is correctly structured
+    if input_checksum or input_checksum_url:
+        if input_checksum and not isinstance(input_checksum, str):
+            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(input_checksum),
+                input_checksum,
+                "string",
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return INVALID_ATTRIBUTE_TYPE_ERROR, response
+
+        if not input_checksum_type:
+            response["msg"] = MISSING_ATTRIBUTE_ERROR_MSG.format(
+                "input_checksum_type", input_checksum or input_checksum_url
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return MISSING_ATTRIBUTE_ERROR, response
+
+        if not isinstance(input_checksum_type, str):
+            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(input_checksum_type),
+                input_checksum_type,
+                "string",
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return INVALID_ATTRIBUTE_TYPE_ERROR, response
+
+        if not isinstance(input_checksum_buffer_size, int):
+            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(input_checksum_buffer_size),
+                input_checksum_buffer_size,
+                "int",
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return INVALID_ATTRIBUTE_TYPE_ERROR, response
+
+        if input_checksum_read_bytes and not isinstance(input_checksum_read_bytes, int):
+            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(input_checksum_read_bytes),
+                input_checksum_read_bytes,
+                "int",
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return INVALID_ATTRIBUTE_TYPE_ERROR, response
+
+    if input_checksum_url and not input_checksum:
+        if not isinstance(input_checksum_url, str) or not validators.url(
+            input_checksum_url
+        ):
+            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(input_checksum_url), input_checksum_url, "url"
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return INVALID_ATTRIBUTE_TYPE_ERROR, response
+
+        # The checksum is looked up by the filename of the input image
+        if validators.url(input_):
+            input_filename = url_filename(input_)
+        else:
+            input_filename = os.path.basename(input_)
+        if checksum_manifests is None:
+            checksum_manifests = ChecksumManifests()
+        found, manifest_response = await checksum_manifests.checksum(
+            input_checksum_url,
+            input_filename,
+            input_checksum_type,
+            session=session,
+            ttl=input_cache_ttl,
+        )
+        if not found:
+            response["msg"] = CHECKSUM_MANIFEST_ERROR_MSG.format(
+                input_filename, input_checksum_url, manifest_response["msg"]
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return CHECKSUM_MANIFEST_ERROR, response
+        input_checksum = manifest_response["checksum"]
+        if verbose:
+            verbose_outputs.append(
+                "Found the {} checksum: {} of: {} in the manifest: {}".format(
+                    input_checksum_type,
+                    input_checksum,
+                    input_filename,
+                    input_checksum_url,
+                )
+            )
+
+    if validators.url(input_):
+        input_url = input_
+        # Download the specified url and save it into
+        # a tmp directory.
+        # First prepare the temporary directory
+        # where the downloaded image will be prepared
+        if not exists(TMP_DIR):
+            created = makedirs(TMP_DIR)
+            if not created:
+                response["msg"] = PATH_CREATE_ERROR_MSG.format(
+                    TMP_DIR,
+                    "Failed to create the temporary download directory",
+                )
+                response["verbose_outputs"] = verbose_outputs
+                return PATH_CREATE_ERROR, response
+
+        input_image_path = input_cache_path(input_url)
+        # Concurrent builds wait for an in-flight download of the same
+        # image and reuse it instead of downloading it again
+        async with FileLock(input_image_path), scheduled(scheduler, SCHEDULER_NETWORK):
+            cached = False
+            if exists(input_image_path):
+                cached, cache_response = await revalidate_cache(
+                    mirror_urls or [input_url],
+                    input_image_path,
+                    session=session,
+                    ttl=input_cache_ttl,
+                )
+                if verbose:
+                    verbose_outputs.append(
+                        "The cached image: {} is {}: {}".format(
+                            input_image_path,
+                            cache_response["cache_status"],
+                            cache_response,
+                        )
+                    )
+
+            download_response = None
+            if not cached:
+                # The size of the download is reserved on the filesystem of
+                # the TMP_DIR, such that concurrent downloads don't fill it up
+                download_size = 0
+                if scheduler:
+                    download_size, _ = await remote_size(
+                        mirror_urls or [input_url], session=session
+                    )
+                async with reserved(
+                    scheduler, "{}.partial".format(input_image_path), download_size
+                ):
+                    if len(mirror_urls) > 1:
+                        if verbose:
+                            verbose_outputs.append(
+                                "Downloading image from the fastest of: {}".format(
+                                    mirror_urls
+                                )
+                            )
+                        with stage(progress, "download", urls=mirror_urls) as outcome:
+                            downloaded, download_response = await retried(
+                                retrier,
+                                RETRY_DOWNLOAD,
+                                download_from_mirrors,
+                                mirror_urls,
+                                input_image_path,
+                                session=session,
+                                on_progress=stage_callback(progress, "download"),
+                                stats=MirrorStats(),
+                                bandwidth_limit=input_bandwidth_limit,
+                                shared_bandwidth=shared_bandwidth,
+                            )
+                            outcome["success"] = downloaded
+                        if not downloaded:
+                            response["msg"] = download_response["msg"]
+                            response["verbose_outputs"] = verbose_outputs
+                            return DOWNLOAD_ERROR, response
+                        if verbose:
+                            verbose_outputs.append(
+                                "Download details: {}".format(download_response)
+                            )
+                    else:
+                        if verbose:
+                            verbose_outputs.append(
+                                "Downloading image from: {}".format(input_url)
+                            )
+                        with stage(progress, "download", url=input_url) as outcome:
+                            downloaded, download_response = await retried(
+                                retrier,
+                                RETRY_DOWNLOAD,
+                                download_file,
+                                input_url,
+                                input_image_path,
+                                on_progress=stage_callback(progress, "download"),
+                                session=session,
+                                bandwidth_limit=input_bandwidth_limit,
+                                shared_bandwidth=shared_bandwidth,
+                            )
+                            outcome["success"] = downloaded
+                        if not downloaded:
+                            response["msg"] = download_response["msg"]
+                            response["verbose_outputs"] = verbose_outputs
+                            return DOWNLOAD_ERROR, response
+                        if verbose:
+                            verbose_outputs.append(
+                                "Download details: {}".format(download_response)
+                            )
+            if download_response:
+                save_cache_metadata(
+                    input_image_path,
+                    new_cache_metadata(input_image_path, download_response),
+                )
+    else:
+        # If the input_ is a string, then we assume that it is a path to the image
+        if not exists(input_):
+            response["msg"] = PATH_NOT_FOUND_ERROR_MSG.format(
+                input_, "the defined input_ path to the does not exist"
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return PATH_NOT_FOUND_ERROR, response
+        input_image_path = input_
+
+    # The checksum is calculated as part of the decompression if the
+    # input has to be decompressed, otherwise it is calculated afterwards
+    calculated_checksum = None
+    checksum_path = input_image_path
+    compression = detect_compression(input_image_path)
+    if compression:
+        decompressed_image_path = decompressed_input_path(input_image_path, compression)
+        if intermediate_paths is not None:
+            intermediate_paths.append(decompressed_image_path)
+        if input_checksum_decompressed:
+            checksum_path = decompressed_image_path
+
+        if not exists(TMP_DIR):
+            created = makedirs(TMP_DIR)
+            if not created:
+                response["msg"] = PATH_CREATE_ERROR_MSG.format(
+                    TMP_DIR,
+                    "Failed to create the temporary decompression directory",
+                )
+                response["verbose_outputs"] = verbose_outputs
+                return PATH_CREATE_ERROR, response
+        # The decompressed images of builds that were killed are never used
+        for stale_path in remove_stale_staging_files(TMP_DIR):
+            if verbose:
+                verbose_outputs.append(
+                    "Removed the stale decompressed image: {}".format(stale_path)
+                )
+
+        if verbose:
+            verbose_outputs.append(
+                "Decompressing the {} compressed image: {}".format(
+                    compression, input_image_path
+                )
+            )
+        # The decompressed size is reserved on the filesystem of the TMP_DIR
+        # before the decompression starts, where it is written to a partial
+        # file that is renamed once it is complete
+        estimated_size = 0
+        if scheduler:
+            estimated_size = decompressed_size(input_image_path, compression)
+        async with scheduled(scheduler, SCHEDULER_CONVERT), reserved(
+            scheduler, "{}.partial".format(decompressed_image_path), estimated_size
+        ):
+            with stage(progress, "decompress", compression=compression) as outcome:
+                decompressed, decompress_response = await decompress_file(
+                    input_image_path,
+                    decompressed_image_path,
+                    compression=compression,
+                    checksum_algorithm=(
+                        input_checksum_type if input_checksum else None
+                    ),
+                    checksum_decompressed=input_checksum_decompressed,
+                    checksum_read_bytes=input_checksum_read_bytes,
+                    on_progress=stage_callback(progress, "decompress"),
+                )
+                outcome["success"] = decompressed
+        if not decompressed:
+            response["msg"] = DECOMPRESS_ERROR_MSG.format(
+                input_image_path, decompress_response["msg"]
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return DECOMPRESS_ERROR, response
+        calculated_checksum = decompress_response.get("checksum", None)
+        if calculated_checksum and not input_checksum_decompressed:
+            # Index the checksum of the compressed input, which unlike the
+            # decompressed image is kept, such that it is not calculated again
+            await run_in_worker(
+                index_digest,
+                checksum_path,
+                input_checksum_type,
+                calculated_checksum,
+                read_bytes=input_checksum_read_bytes,
+            )
+        if verbose:
+            verbose_outputs.append(
+                "Decompression details: {}".format(decompress_response)
+            )
+        input_image_path = decompressed_image_path
+
+    if not input_format and input_image_path:
+        # Discover the input_ format from the image itself, since the
+        # extension of the path or url is often missing or misleading
+        input_format = await detect_image_format(input_image_path)
+        if verbose:
+            verbose_outputs.append(
+                "Detected the format: {} of the input image: {}".format(
+                    input_format, input_image_path
+                )
+            )
+
+    if not isinstance(input_format, str):
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(input_format), input_format, "string"
+        )
+        response["verbose_outputs"] = verbose_outputs
+        return INVALID_ATTRIBUTE_TYPE_ERROR, response
+
+    if input_checksum:
+        # The additional checksums are calculated in the same read of the image
+        algorithms = [input_checksum_type] + [
+            algorithm
+            for algorithm in input_checksum_types or []
+            if algorithm != input_checksum_type
+        ]
+        checksums = {}
+        if calculated_checksum:
+            checksums[input_checksum_type] = calculated_checksum
+        # Loading the index parses a JSON file that grows with every image
+        # that is hashed, so it is kept off the event loop
+        digest_index = await run_in_worker(DigestIndex)
+        if not input_checksum_force:
+            for algorithm in algorithms:
+                if algorithm in checksums:
+                    continue
+                digest = digest_index.lookup(
+                    checksum_path, algorithm, read_bytes=input_checksum_read_bytes
+                )
+                if digest:
+                    checksums[algorithm] = digest
+                    if verbose:
+                        verbose_outputs.append(
+                            "Reusing the indexed {} checksum of the unchanged "
+                            "image: {}".format(algorithm, checksum_path)
+                        )
+
+        missing = [algorithm for algorithm in algorithms if algorithm not in checksums]
+        if missing:
+            buffer_size = input_checksum_buffer_size
+            if len(missing) > 1:
+                buffer_size = max(buffer_size, DEFAULT_HASHSUMS_BUFFER_SIZE)
+            async with scheduled(scheduler, SCHEDULER_HASH):
+                with stage(progress, "checksum", algorithms=missing) as outcome:
+                    calculated_checksums = await hashsums(
+                        checksum_path,
+                        missing,
+                        buffer_size=buffer_size,
+                        read_bytes_of_file=input_checksum_read_bytes,
+                        on_progress=stage_callback(progress, "checksum"),
+                        digest_index=digest_index,
+                        # The index has already been consulted
+                        force=True,
+                    )
+                    if calculated_checksums:
+                        checksums.update(calculated_checksums)
+                    outcome["success"] = (
+                        checksums.get(input_checksum_type, None) == input_checksum
+                    )
+        calculated_checksum = checksums.get(input_checksum_type, None)
+        if not calculated_checksum:
+            response["msg"] = "Failed to calculate the checksum of the downloaded image"
+            response["verbose_outputs"] = verbose_outputs
+            return CHECKSUM_ERROR, response
+
+        if calculated_checksum != input_checksum:
+            response["msg"] = (
+                "The checksum of the downloaded image: {} does not match the expected checksum: {}".format(
+                    calculated_checksum, input_checksum
+                )
+            )
+            response["verbose_outputs"] = verbose_outputs
+            return CHECKSUM_ERROR, response
+        if verbose:
+            verbose_outputs.append(
+                "The calculated checksum: {} matches the defined checksum: {}".format(
+                    calculated_checksum, input_checksum
+                )
+            )
+        response["input_checksums"] = checksums
+
+    response["input_path"] = input_image_path
+    response["input_format"] = input_format
+    response["verbose_outputs"] = verbose_outputs
+    return SUCCESS, response
+
+
 async def generate_image(
     name,
     size,
+    # A path, a url or a list of mirror urls of the input image
     input=None,
-    input_format="qcow2",
+    # The format of the input image, which is detected if it is not given
+    input_format=None,
     input_checksum_type=None,
     input_checksum=None,
+    input_checksum_url=None,
     input_checksum_buffer_size=DEFAULT_BUFFER_SIZE,
     input_checksum_read_bytes=None,
+    input_checksum_decompressed=False,
+    input_checksum_force=False,
+    input_checksum_types=None,
+    input_cache_ttl=DEFAULT_CACHE_TTL,
+    # The bytes per second that the download of the input is limited to,
+    # either a number or a string such as '10M' or '50MiB'
+    input_bandwidth_limit=None,
     output_format="qcow2",
     output_directory=GENERATED_IMAGE_DIR,
+    # The algorithms of the checksums that are returned in 'output_checksums'
+    output_checksum_types=None,
     overwrite=False,
     verbose=False,
     # Optional version attribute for each image configuration
     version=None,
+    # Either a ProgressReporter or one of the PROGRESS_MODES
+    progress=None,
+    progress_fd=DEFAULT_PROGRESS_FD,
+    # A shared requests.Session, otherwise one is created with the http options
+    session=None,
+    http_pool_size=DEFAULT_HTTP_POOL_SIZE,
+    http_proxy=None,
+    http_ca_bundle=None,
+    # The ChecksumManifests of the build that the image is part of
+    checksum_manifests=None,
+    # The ResourceScheduler that admits the stages of concurrent builds
+    scheduler=None,
+    # The Retrier of the build that the image is part of, otherwise one is
+    # created with the retry options
+    retrier=None,
+    retries=DEFAULT_RETRIES,
+    retry_backoff=DEFAULT_RETRY_BACKOFF,
+    # The RetryPolicy of each of the RETRY_STAGES that is retried differently
+    retry_policies=None,
+    # Whether an input in the output format is converted, which drops its
+    # unused clusters, instead of being cloned
+    compact=False,
+    # The TokenBucket of the bandwidth that the downloads of the build that
+    # the image is part of share, otherwise one is created with bandwidth_limit
+    shared_bandwidth=None,
+    # The bytes per second that every download of the image shares
+    bandwidth_limit=None,
 ):
-    response = {}
-    verbose_outputs = []
-
-    # rename the special input variable to input_
-    input_ = input
+    for option, value in [
+        ("input_bandwidth_limit", input_bandwidth_limit),
+        ("bandwidth_limit", bandwidth_limit),
+    ]:
+        if value is not None and parse_bandwidth(value) is None:
+            return INVALID_ATTRIBUTE_TYPE_ERROR, {
+                "msg": INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                    type(value), value, "a {} such as 10M or 50MiB".format(option)
+                )
+            }
+    if shared_bandwidth is None:
+        shared_bandwidth = new_bandwidth(bandwidth_limit)
+    progress = new_progress_reporter(progress, progress_fd=progress_fd)
+    if progress:
+        progress = progress.bind(image=name, version=version)
+    # The retries are only reported by the build that created the retrier
+    owns_retrier = retrier is None
+    if owns_retrier:
+        retrier = Retrier(
+            policies=retry_policies,
+            default_policy={"retries": retries, "backoff": retry_backoff},
+        )
 
-    if version:
-        vm_output_path = os.path.join(
-            output_directory,
-            "{}-{}.{}".format(name, version, output_format),
+    output_path = image_output_path(
+        name, output_format, output_directory=output_directory, version=version
+    )
+    # Concurrent builds of the same output image wait for each other,
+    # such that the later build finds and reuses the published image
+    output_lock = FileLock(output_path)
+    with http_session(
+        session, pool_size=http_pool_size, proxy=http_proxy, ca_bundle=http_ca_bundle
+    ) as session:
+        async with output_lock:
+            return_code, response = await _generate_image(
+                name,
+                size,
+                input_=input,
+                input_format=input_format,
+                input_checksum_type=input_checksum_type,
+                input_checksum=input_checksum,
+                input_checksum_url=input_checksum_url,
+                input_checksum_buffer_size=input_checksum_buffer_size,
+                input_checksum_read_bytes=input_checksum_read_bytes,
+                input_checksum_decompressed=input_checksum_decompressed,
+                input_checksum_force=input_checksum_force,
+                input_checksum_types=input_checksum_types,
+                input_cache_ttl=input_cache_ttl,
+                input_bandwidth_limit=input_bandwidth_limit,
+                shared_bandwidth=shared_bandwidth,
+                output_format=output_format,
+                output_directory=output_directory,
+                overwrite=overwrite,
+                verbose=verbose,
+                version=version,
+                progress=progress,
+                session=session,
+                checksum_manifests=checksum_manifests,
+                scheduler=scheduler,
+                retrier=retrier,
+                compact=compact,
+            )
+    if verbose and output_lock.waited:
+        response.setdefault("verbose_outputs", []).insert(
+            0, "Waited for another build of the image: {}".format(output_path)
         )
-    else:
-        vm_output_path = os.path.join(
-            output_directory, "{}.{}".format(name, output_format)
+    if owns_retrier and retrier.counts:
+        response["retries"] = dict(retrier.counts)
+        if verbose:
+            response.setdefault("verbose_outputs", []).extend(
+                retry_verbose_outputs(retrier)
+            )
+    # Like the retries, the job priority is reported once by the architecture
+    # that the image is part of instead of by every image
+    if verbose and owns_retrier:
+        response.setdefault("verbose_outputs", []).extend(priority_verbose_outputs())
+    if return_code == SUCCESS and output_checksum_types:
+        async with scheduled(scheduler, SCHEDULER_HASH):
+            output_checksums = await image_checksums(
+                output_path, output_checksum_types, progress=progress
+            )
+        if output_checksums:
+            response["output_checksums"] = output_checksums
+        else:
+            return_code = CHECKSUM_ERROR
+            response["msg"] = (
+                "Failed to calculate the {} checksums of the image: {}".format(
+                    output_checksum_types, output_path
+                )
+            )
+    if progress:
+        progress.emit(
+            IMAGE_COMPLETE,
+            return_code=return_code,
+            success=return_code == SUCCESS,
+            output_path=output_path,
         )
+    return return_code, response
+
+
+async def image_checksums(path, algorithms, progress=None):
+    """Returns a dictionary of the checksum of the image at path for each
+    of the algorithms, which are calculated in a single read of the image,
+    or False if they could not be calculated."""
+    digest_index = await run_in_worker(DigestIndex)
+    with stage(progress, "digest", algorithms=list(algorithms)) as outcome:
+        checksums = await hashsums(
+            path,
+            algorithms,
+            on_progress=stage_callback(progress, "digest"),
+            digest_index=digest_index,
+        )
+        outcome["success"] = bool(checksums)
+    return checksums
+
+
+async def _generate_image(
+    name,
+    size,
+    input_=None,
+    input_format=None,
+    input_checksum_type=None,
+    input_checksum=None,
+    input_checksum_url=None,
+    input_checksum_buffer_size=DEFAULT_BUFFER_SIZE,
+    input_checksum_read_bytes=None,
+    input_checksum_decompressed=False,
+    input_checksum_force=False,
+    input_checksum_types=None,
+    input_cache_ttl=DEFAULT_CACHE_TTL,
+    input_bandwidth_limit=None,
+    shared_bandwidth=None,
+    output_format="qcow2",
+    output_directory=GENERATED_IMAGE_DIR,
+    overwrite=False,
+    verbose=False,
+    version=None,
+    progress=None,
+    session=None,
+    checksum_manifests=None,
+    scheduler=None,
+    retrier=None,
+    compact=False,
+):
+    response = {}
+    verbose_outputs = []
+
+    vm_output_path = image_output_path(
+        name, output_format, output_directory=output_directory, version=version
+    )
 
     # Create the destination directory where the images will be saved
     if not exists(output_directory):
@@ -215,6 +1102,13 @@ async def generate_image(
             )
             return PATH_CREATE_ERROR, response
 
+    # Staging files of builds that were killed are never published
+    for stale_path in remove_stale_staging_files(output_directory):
+        if verbose:
+            verbose_outputs.append(
+                "Removed the stale staging file: {}".format(stale_path)
+            )
+
     if exists(vm_output_path):
         if verbose:
             verbose_outputs.append(
@@ -233,219 +1127,192 @@ async def generate_image(
                     "Overwriting the existing image: {}".format(vm_output_path)
                 )
 
-    if input_:
-        if not isinstance(input_, str):
-            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                type(input_), input_, "string"
+    # The image is built in a staging file that is only published to the
+    # output path once it has been checked, such that an existing output
+    # image is always complete and can be skipped by later builds
+    staged_output_path = staging_path(vm_output_path)
+    # The conversion slot and the disk space of the image are held by the
+    # scheduler until the image is published
+    resources = contextlib.AsyncExitStack()
+    # The intermediate files of the input are removed once the image is built
+    intermediate_paths = []
+    try:
+        if input_:
+            prepared_code, prepared_response = await prepare_input(
+                input_,
+                input_format=input_format,
+                input_checksum_type=input_checksum_type,
+                input_checksum=input_checksum,
+                input_checksum_url=input_checksum_url,
+                input_checksum_buffer_size=input_checksum_buffer_size,
+                input_checksum_read_bytes=input_checksum_read_bytes,
+                input_checksum_decompressed=input_checksum_decompressed,
+                input_checksum_force=input_checksum_force,
+                input_checksum_types=input_checksum_types,
+                input_cache_ttl=input_cache_ttl,
+                verbose=verbose,
+                progress=progress,
+                session=session,
+                checksum_manifests=checksum_manifests,
+                scheduler=scheduler,
+                retrier=retrier,
+                input_bandwidth_limit=input_bandwidth_limit,
+                shared_bandwidth=shared_bandwidth,
+                intermediate_paths=intermediate_paths,
             )
-            response["verbose_outputs"] = verbose_outputs
-            return INVALID_ATTRIBUTE_TYPE_ERROR, response
-
-        # If a checksum is present, then validate that it is correctly structured
-        if input_checksum:
-            if not isinstance(input_checksum, str):
-                response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                    type(input_checksum),
-                    input_checksum,
-                    "string",
-                )
+            verbose_outputs.extend(prepared_response.get("verbose_outputs", []))
+            if prepared_code != SUCCESS:
+                response["msg"] = prepared_response["msg"]
                 response["verbose_outputs"] = verbose_outputs
-                return INVALID_ATTRIBUTE_TYPE_ERROR, response
+                return prepared_code, response
+            input_image_path = prepared_response["input_path"]
+            input_format = prepared_response["input_format"]
+            if "input_checksums" in prepared_response:
+                response["input_checksums"] = prepared_response["input_checksums"]
 
-            if not input_checksum_type:
-                response["msg"] = MISSING_ATTRIBUTE_ERROR_MSG.format(
-                    "input_checksum_type", input_checksum
-                )
-                response["verbose_outputs"] = verbose_outputs
-                return MISSING_ATTRIBUTE_ERROR, response
-
-            if not isinstance(input_checksum_type, str):
-                response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                    type(input_checksum_type),
-                    input_checksum_type,
-                    "string",
+            if scheduler:
+                await resources.enter_async_context(scheduler.slot(SCHEDULER_CONVERT))
+                estimated_size = await estimate_image_size(
+                    output_format, path=input_image_path, image_format=input_format
                 )
-                response["verbose_outputs"] = verbose_outputs
-                return INVALID_ATTRIBUTE_TYPE_ERROR, response
-
-            if not isinstance(input_checksum_buffer_size, int):
-                response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                    type(input_checksum_buffer_size),
-                    input_checksum_buffer_size,
-                    "int",
+                await resources.enter_async_context(
+                    scheduler.reserve(staged_output_path, estimated_size)
                 )
-                response["verbose_outputs"] = verbose_outputs
-                return INVALID_ATTRIBUTE_TYPE_ERROR, response
-
-            if input_checksum_read_bytes and not isinstance(
-                input_checksum_read_bytes, int
+            # An input that already is in the output format is cloned
+            # instead of converted, unless it should be compacted
+            cloned = False
+            if (
+                not compact
+                and input_format == output_format
+                and can_clone_image(input_image_path, input_format)
             ):
-                response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                    type(input_checksum_read_bytes),
-                    input_checksum_read_bytes,
-                    "int",
-                )
-                response["verbose_outputs"] = verbose_outputs
-                return INVALID_ATTRIBUTE_TYPE_ERROR, response
+                with stage(progress, "clone") as outcome:
+                    cloned, clone_response = await clone_file(
+                        input_image_path, staged_output_path
+                    )
+                    outcome["success"] = cloned
+                    outcome["method"] = clone_response.get("method", None)
+                if verbose and cloned:
+                    verbose_outputs.append(
+                        "Cloned the input image: {} with {}".format(
+                            input_image_path, clone_response["method"]
+                        )
+                    )
+                elif verbose:
+                    verbose_outputs.append(
+                        "{}, converting it instead".format(clone_response["msg"])
+                    )
 
-        if validators.url(input_):
-            input_url = input_
-            # Download the specified url and save it into
-            # a tmp directory.
-            # First prepare the temporary directory
-            # where the downloaded image will be prepared
-            if not exists(TMP_DIR):
-                created = makedirs(TMP_DIR)
-                if not created:
+            if not cloned:
+                with stage(progress, "convert", unit="percent") as outcome:
+                    converted_result, msg = await convert_image(
+                        input_image_path,
+                        staged_output_path,
+                        input_format=input_format,
+                        output_format=output_format,
+                        verbose=verbose,
+                        retrier=retrier,
+                        on_progress=stage_callback(progress, "convert"),
+                    )
+                    outcome["success"] = converted_result
+                if not converted_result:
                     response["msg"] = PATH_CREATE_ERROR_MSG.format(
-                        TMP_DIR,
-                        "Failed to create the temporary download directory",
+                        input_image_path, msg
                     )
                     response["verbose_outputs"] = verbose_outputs
                     return PATH_CREATE_ERROR, response
 
-            input_url_filename = input_url.split("/")[-1]
-            input_image_path = os.path.join(TMP_DIR, input_url_filename)
-            if not exists(input_image_path):
-                if verbose:
-                    verbose_outputs.append(
-                        "Downloading image from: {}".format(input_url)
-                    )
-                downloaded, download_response = await download_file(
-                    input_url, input_image_path
-                )
-                if not downloaded:
-                    response["msg"] = download_response["msg"]
-                    response["verbose_outputs"] = verbose_outputs
-                    return DOWNLOAD_ERROR, response
-                if verbose:
-                    verbose_outputs.append(
-                        "Download details: {}".format(download_response)
-                    )
-        else:
-            # If the input_ is a string, then we assume that it is a path to the image
-            if not exists(input_):
-                response["msg"] = PATH_NOT_FOUND_ERROR_MSG.format(
-                    input_, "the defined input_ path to the does not exist"
-                )
+            input_size = await image_virtual_size(input_image_path)
+            if not input_size:
+                response["msg"] = GETSIZE_ERROR_MSG.format(input_image_path)
                 response["verbose_outputs"] = verbose_outputs
-                return PATH_NOT_FOUND_ERROR, response
-            input_image_path = input_
+                return GETSIZE_ERROR, response
 
-        if not input_format and input_image_path:
-            # Try to discover the input_ format since we have
-            # only been given a string value
-            input_format = input_image_path.split(".")[-1]
+            expected_resize_size = expand_byte_magnitude(size)
+            resize_args = []
+            if expected_resize_size < input_size:
+                resize_args = ["--shrink"]
 
-        if not isinstance(input_format, str):
-            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
-                type(input_format), input_format, "string"
-            )
-            response["verbose_outputs"] = verbose_outputs
-            return INVALID_ATTRIBUTE_TYPE_ERROR, response
-
-        if input_checksum:
-            calculated_checksum = await hashsum(
-                input_image_path,
-                algorithm=input_checksum_type,
-                buffer_size=input_checksum_buffer_size,
-                read_bytes_of_file=input_checksum_read_bytes,
-            )
-            if not calculated_checksum:
-                response["msg"] = (
-                    "Failed to calculate the checksum of the downloaded image"
+            # Resize the vm disk image
+            with stage(progress, "resize", size=size) as outcome:
+                resized_result, resized_msg = await resize_image(
+                    staged_output_path,
+                    size,
+                    image_format=output_format,
+                    resize_args=resize_args,
+                    verbose=verbose,
+                    retrier=retrier,
                 )
+                outcome["success"] = resized_result
+            if not resized_result:
+                response["msg"] = RESIZE_ERROR_MSG.format(vm_output_path, resized_msg)
                 response["verbose_outputs"] = verbose_outputs
-                return CHECKSUM_ERROR, response
-
-            if calculated_checksum != input_checksum:
-                response["msg"] = (
-                    "The checksum of the downloaded image: {} does not match the expected checksum: {}".format(
-                        calculated_checksum, input_checksum
-                    )
+                return RESIZE_ERROR, response
+        else:
+            # If no input_ is specified, then we assume that we are creating a new disc image
+            if scheduler:
+                await resources.enter_async_context(scheduler.slot(SCHEDULER_CONVERT))
+                estimated_size = await estimate_image_size(output_format, size=size)
+                await resources.enter_async_context(
+                    scheduler.reserve(staged_output_path, estimated_size)
+                )
+            with stage(progress, "create", size=size) as outcome:
+                create_image_result, msg = await create_image(
+                    staged_output_path,
+                    size,
+                    image_format=output_format,
+                    verbose=verbose,
+                    retrier=retrier,
                 )
+                outcome["success"] = create_image_result
+            if not create_image_result:
+                response["msg"] = PATH_CREATE_ERROR_MSG.format(vm_output_path, msg)
                 response["verbose_outputs"] = verbose_outputs
-                return CHECKSUM_ERROR, response
-            if verbose:
+                return PATH_CREATE_ERROR, response
+
+        # Amend to qcow2 version 3 which is required in RHEL 9 if the output format is
+        # qcow2
+        # TODO, validate that the image is a rhel based image
+        if output_format == "qcow2":
+            with stage(progress, "amend") as outcome:
+                amend_result, amend_msg = await amend_image(
+                    staged_output_path, "compat=v3", verbose=verbose, retrier=retrier
+                )
+                outcome["success"] = amend_result
+            if not amend_result:
                 verbose_outputs.append(
-                    "The calculated checksum: {} matches the defined checksum: {}".format(
-                        calculated_checksum, input_checksum
-                    )
+                    PATH_CREATE_ERROR_MSG.format(vm_output_path, amend_msg)
                 )
 
-        converted_result, msg = await convert_image(
-            input_image_path,
-            vm_output_path,
-            input_format=input_format,
-            output_format=output_format,
-            verbose=verbose,
-        )
-        if not converted_result:
-            response["msg"] = PATH_CREATE_ERROR_MSG.format(input_image_path, msg)
-            response["verbose_outputs"] = verbose_outputs
-            return PATH_CREATE_ERROR, response
-
-        input_size = get_size(input_image_path)
-        if not input_size:
-            response["msg"] = GETSIZE_ERROR_MSG.format(input_image_path)
-            response["verbose_outputs"] = verbose_outputs
-            return GETSIZE_ERROR, response
-
-        expected_resize_size = expand_byte_magnitude(size)
-        resize_args = []
-        if expected_resize_size < input_size:
-            resize_args = ["--shrink"]
-
-        # Resize the vm disk image
-        resized_result, resized_msg = await resize_image(
-            vm_output_path,
-            size,
-            image_format=output_format,
-            resize_args=resize_args,
-            verbose=verbose,
-        )
-        if not resized_result:
-            response["msg"] = RESIZE_ERROR_MSG.format(vm_output_path, resized_msg)
-            response["verbose_outputs"] = verbose_outputs
-            return RESIZE_ERROR, response
-    else:
-        # If no input_ is specified, then we assume that we are creating a new disc image
-        create_image_result, msg = await create_image(
-            vm_output_path,
-            size,
-            image_format=output_format,
-            verbose=verbose,
-        )
-        if not create_image_result:
-            response["msg"] = PATH_CREATE_ERROR_MSG.format(vm_output_path, msg)
-            response["verbose_outputs"] = verbose_outputs
-            return PATH_CREATE_ERROR, response
-        else:
-            if verbose:
-                verbose_outputs.append(
-                    "Generated image at: {}".format(os.path.realpath(vm_output_path))
+        if output_format in CONSITENCY_SUPPPORTED_FORMATS:
+            with stage(progress, "check") as outcome:
+                check_result, check_msg = await check_image(
+                    staged_output_path,
+                    image_format=output_format,
+                    verbose=verbose,
+                    retrier=retrier,
                 )
+                outcome["success"] = check_result
+            if not check_result:
+                response["msg"] = CHECK_ERROR_MSG.format(check_msg)
+                response["verbose_outputs"] = verbose_outputs
+                return CHECK_ERROR, response
 
-    # Amend to qcow2 version 3 which is required in RHEL 9 if the output format is
-    # qcow2
-    # TODO, validate that the image is a rhel based image
-    if output_format == "qcow2":
-        amend_result, amend_msg = await amend_image(
-            vm_output_path, "compat=v3", verbose=verbose
-        )
-        if not amend_result:
-            verbose_outputs.append(
-                PATH_CREATE_ERROR_MSG.format(vm_output_path, amend_msg)
+        if not publish(staged_output_path, vm_output_path):
+            response["msg"] = PATH_CREATE_ERROR_MSG.format(
+                vm_output_path, "Failed to publish the staged image"
             )
+            response["verbose_outputs"] = verbose_outputs
+            return PATH_CREATE_ERROR, response
+    finally:
+        for path in [staged_output_path] + intermediate_paths:
+            if exists(path):
+                remove(path)
+        await resources.aclose()
 
-    if output_format in CONSITENCY_SUPPPORTED_FORMATS:
-        check_result, check_msg = await check_image(
-            vm_output_path,
-            image_format=output_format,
-            verbose=verbose,
+    if verbose:
+        verbose_outputs.append(
+            "Generated image at: {}".format(os.path.realpath(vm_output_path))
         )
-        if not check_result:
-            response["msg"] = CHECK_ERROR_MSG.format(check_msg)
-            response["verbose_outputs"] = verbose_outputs
-            return CHECK_ERROR, response
+        response["verbose_outputs"] = verbose_outputs
     return SUCCESS, response
@@ -0,0 +1,287 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+
+import validators
+
+from gen_vm_image.common.defaults import (
+    DEFAULT_CACHE_TTL,
+    DEFAULT_DISK_SPACE_MARGIN,
+    GENERATED_IMAGE_DIR,
+    PLAN_IMAGE_BUILD,
+    PLAN_IMAGE_OVERWRITE,
+    PLAN_IMAGE_SKIP,
+    PLAN_INPUT_CACHED,
+    PLAN_INPUT_DOWNLOAD,
+    PLAN_INPUT_LOCAL,
+    PLAN_INPUT_MISSING,
+    TMP_DIR,
+)
+from gen_vm_image.image import (
+    expand_byte_magnitude,
+    image_output_path,
+    input_cache_path,
+    measure_image,
+)
+from gen_vm_image.utils.cache import remote_size, revalidate_cache
+from gen_vm_image.utils.compression import (
+    COMPRESSION_MAGIC,
+    detect_compression,
+)
+from gen_vm_image.utils.headers import raw_header, read_image_header
+from gen_vm_image.utils.io import exists
+from gen_vm_image.utils.scheduler import filesystem_id, free_space
+
+
+def _url_compression(url):
+    """Returns the compression of the image at url based on its extension."""
+    for compression in COMPRESSION_MAGIC:
+        if url.split("?")[0].endswith(".{}".format(compression)):
+            return compression
+    return None
+
+
+async def plan_input(input_, session=None):
+    """Returns the plan of how the input of a group of images is prepared,
+    i.e. whether it is downloaded or reused from the cache, without
+    downloading, decompressing or updating the validators of the cache.
+    The 'measure_path' of the plan is the local image that the outputs
+    can be measured from, or None if it is not available yet."""
+    input_data = input_ if isinstance(input_, dict) else {"path": input_}
+    source = input_data.get("urls", None) or input_data.get(
+        "url", input_data.get("path", None)
+    )
+    urls = list(source) if isinstance(source, (list, tuple)) else [source]
+    plan = {
+        "source": source,
+        "operations": [],
+        "download_size": 0,
+        "measure_path": None,
+        "format": input_data.get("format", None),
+    }
+
+    input_path = None
+    compression = None
+    if isinstance(urls[0], str) and validators.url(urls[0]):
+        input_path = input_cache_path(urls[0])
+        plan["cache_path"] = input_path
+        cached = False
+        if exists(input_path):
+            cached, cache_response = await revalidate_cache(
+                urls,
+                input_path,
+                session=session,
+                ttl=input_data.get("cache_ttl", DEFAULT_CACHE_TTL),
+                save=False,
+            )
+            plan["cache_status"] = cache_response["cache_status"]
+        if cached:
+            plan["input"] = PLAN_INPUT_CACHED
+        else:
+            plan["input"] = PLAN_INPUT_DOWNLOAD
+            plan["operations"].append("download")
+            size, size_response = await remote_size(urls, session=session)
+            # None if the servers don't report the size of the image
+            plan["download_size"] = size
+            if size_response["errors"]:
+                plan["errors"] = size_response["errors"]
+            compression = _url_compression(urls[0])
+            input_path = None
+    elif isinstance(source, str) and exists(source):
+        plan["input"] = PLAN_INPUT_LOCAL
+        input_path = source
+    else:
+        plan["input"] = PLAN_INPUT_MISSING
+        return plan
+
+    if input_path:
+        compression = detect_compression(input_path)
+    if compression:
+        # The build decompresses the input into a file of its own, so the
+        # decompressed image is never available before the build
+        plan["operations"].append("decompress")
+    elif input_path:
+        plan["measure_path"] = input_path
+
+    if plan["measure_path"]:
+        # The header of the local input describes it without qemu-img
+        header = read_image_header(plan["measure_path"])
+        if header is None and plan["format"] in (None, "raw"):
+            header = raw_header(plan["measure_path"])
+        if header:
+            if not plan["format"]:
+                plan["format"] = header["format"]
+            plan["virtual_size"] = header["virtual_size"]
+            plan["backing_file"] = header["backing_file"]
+    if input_data.get("checksum", None):
+        plan["operations"].append("verify")
+    return plan
+
+
+async def estimate_output_size(build_data, input_plan=None):
+    """Returns the (size, method) of the estimated number of bytes that the
+    output image takes up on disk. The size is measured with qemu-img if the
+    input is available locally, and otherwise falls back to the size of
+    the input, the size of its download, or the virtual size of the image."""
+    output_format = build_data.get("format", "qcow2")
+    virtual_size = expand_byte_magnitude(str(build_data["size"]))
+    if input_plan is None:
+        measured = await measure_image(output_format, size=virtual_size)
+        if measured is not False:
+            return measured, "measured"
+        return virtual_size, "virtual_size"
+
+    measure_path = input_plan["measure_path"]
+    if measure_path:
+        measured = await measure_image(
+            output_format, path=measure_path, image_format=input_plan["format"]
+        )
+        if measured is not False:
+            return measured, "measured"
+        return os.path.getsize(measure_path), "input_size"
+    if input_plan["download_size"] and "decompress" not in input_plan["operations"]:
+        return input_plan["download_size"], "download_size"
+    # A compressed download may expand to anything up to the virtual size
+    return virtual_size, "virtual_size"
+
+
+async def plan_image(
+    build_data, input_plan=None, output_directory=GENERATED_IMAGE_DIR, overwrite=False
+):
+    """Returns the plan of building a single image."""
+    output_path = image_output_path(
+        build_data["name"],
+        build_data.get("format", "qcow2"),
+        output_directory=output_directory,
+        version=build_data.get("version", None),
+    )
+    plan = {
+        "name": build_data["name"],
+        "version": build_data.get("version", None),
+        "format": build_data.get("format", "qcow2"),
+        "output_path": os.path.realpath(output_path),
+        "virtual_size": expand_byte_magnitude(str(build_data["size"])),
+        "operations": [],
+        "estimated_size": 0,
+    }
+    if exists(output_path) and not overwrite:
+        plan["action"] = PLAN_IMAGE_SKIP
+        return plan
+
+    plan["action"] = PLAN_IMAGE_OVERWRITE if exists(output_path) else PLAN_IMAGE_BUILD
+    if input_plan is None:
+        plan["operations"] = ["create"]
+    else:
+        plan["operations"] = input_plan["operations"] + ["convert", "resize"]
+    plan["estimated_size"], plan["estimate"] = await estimate_output_size(
+        build_data, input_plan=input_plan
+    )
+    return plan
+
+
+def plan_capacity(
+    input_plans,
+    image_plans,
+    output_directory=GENERATED_IMAGE_DIR,
+    disk_space_margin=DEFAULT_DISK_SPACE_MARGIN,
+):
+    """Returns the total network transfer and the disk space that is
+    required on each filesystem, where the downloads are written to the
+    temporary directory and the images to the output directory."""
+    download_bytes = 0
+    unknown_downloads = []
+    for input_plan in input_plans:
+        if input_plan.get("input", None) != PLAN_INPUT_DOWNLOAD:
+            continue
+        if input_plan["download_size"] is None:
+            unknown_downloads.append(input_plan["source"])
+        else:
+            download_bytes += input_plan["download_size"]
+    output_bytes = sum(image_plan["estimated_size"] for image_plan in image_plans)
+
+    filesystems = {}
+    for path, required in [(TMP_DIR, download_bytes), (output_directory, output_bytes)]:
+        filesystem = filesystems.setdefault(
+            filesystem_id(path),
+            {"paths": [], "free": free_space(path), "required": 0},
+        )
+        filesystem["paths"].append(os.path.realpath(path))
+        filesystem["required"] += required
+    for filesystem in filesystems.values():
+        filesystem["fits"] = (
+            filesystem["free"] - disk_space_margin >= filesystem["required"]
+        )
+
+    return {
+        "download_bytes": download_bytes,
+        "unknown_download_sizes": unknown_downloads,
+        "output_bytes": output_bytes,
+        "disk_space_margin": disk_space_margin,
+        "filesystems": list(filesystems.values()),
+        "fits": all(filesystem["fits"] for filesystem in filesystems.values()),
+    }
+
+
+async def plan_groups(
+    groups, output_directory=GENERATED_IMAGE_DIR, overwrite=False, session=None
+):
+    """Returns the plan of building the groups of images that share an input,
+    see group_images_by_input. Nothing is downloaded, converted or written,
+    only the cache of each input is revalidated and the size of each
+    download is requested from its servers."""
+    input_plans = []
+    image_plans = []
+    for group in groups:
+        pending = [
+            build_data
+            for build_data in group
+            if overwrite
+            or not exists(
+                image_output_path(
+                    build_data["name"],
+                    build_data.get("format", "qcow2"),
+                    output_directory=output_directory,
+                    version=build_data.get("version", None),
+                )
+            )
+        ]
+        # The input is only planned if any image of the group is built
+        input_plan = None
+        input_ = group[0].get("input", None)
+        if input_ and pending:
+            input_plan = await plan_input(input_, session=session)
+            input_plan["images"] = [build_data["name"] for build_data in pending]
+            input_plans.append(input_plan)
+        for build_data in group:
+            image_plans.append(
+                await plan_image(
+                    build_data,
+                    input_plan=input_plan,
+                    output_directory=output_directory,
+                    overwrite=overwrite,
+                )
+            )
+
+    for input_plan in input_plans:
+        input_plan.pop("measure_path", None)
+    return {
+        "inputs": input_plans,
+        "images": image_plans,
+        "capacity": plan_capacity(
+            input_plans, image_plans, output_directory=output_directory
+        ),
+    }
@@ -0,0 +1,470 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import functools
+import itertools
+import json
+import os
+import signal
+import time
+import uuid
+from collections import OrderedDict
+
+from gen_vm_image.architecture import build_architecture
+from gen_vm_image.cli.common import to_str
+from gen_vm_image.common.codes import (
+    INVALID_ATTRIBUTE_TYPE_ERROR_MSG,
+    JOB_CANCELLED_ERROR,
+    JOB_CANCELLED_ERROR_MSG,
+    JOB_ERROR,
+    JOB_ERROR_MSG,
+    SERVER_ERROR,
+    SERVER_ERROR_MSG,
+    SUCCESS,
+)
+from gen_vm_image.common.defaults import (
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_SERVER_CONCURRENCY,
+    DEFAULT_SERVER_HISTORY,
+    DEFAULT_SERVER_SOCKET,
+    MULTIPLE,
+    SINGLE,
+)
+from gen_vm_image.image import generate_image
+from gen_vm_image.utils.io import exists, remove
+from gen_vm_image.utils.net import new_session
+from gen_vm_image.utils.progress import PROGRESS, ProgressReporter
+
+# The states that a job can be in
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = [SUCCEEDED, FAILED, CANCELLED]
+
+# Jobs that define any of these options get their own HTTP session
+# instead of the session that is shared by the jobs of the server
+JOB_HTTP_OPTIONS = ["http_pool_size", "http_proxy", "http_ca_bundle"]
+
+JOB_FUNCTIONS = {
+    SINGLE: generate_image,
+    MULTIPLE: build_architecture,
+}
+
+
+class Job:
+    def __init__(self, kind, args=None, kwargs=None, priority=0):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.args = args or []
+        self.kwargs = kwargs or {}
+        self.priority = priority
+        self.status = QUEUED
+        self.return_code = None
+        self.result = None
+        self.events = []
+        self.watchers = []
+        self.task = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def publish(self, event, store=True, **fields):
+        """Sends the event to the watchers of the job. Only the stored
+        events are replayed to watchers that start watching later on."""
+        event = {"job_id": self.id, "event": event, "time": time.time(), **fields}
+        if store:
+            self.events.append(event)
+        for watcher in self.watchers:
+            watcher.put_nowait(event)
+
+    def asdict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "args": self.args,
+            "kwargs": self.kwargs,
+            "priority": self.priority,
+            "status": self.status,
+            "return_code": self.return_code,
+            "result": self.result,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class BuildServer:
+    """Queues and runs image build jobs that are submitted over a UNIX socket.
+    Jobs with a higher priority are started first and at most concurrency
+    jobs are running at the same time. The downloads of every job share
+    the connection pool of a single HTTP session."""
+
+    def __init__(
+        self,
+        concurrency=DEFAULT_SERVER_CONCURRENCY,
+        history=DEFAULT_SERVER_HISTORY,
+        http_pool_size=DEFAULT_HTTP_POOL_SIZE,
+        http_proxy=None,
+        http_ca_bundle=None,
+    ):
+        self.concurrency = concurrency
+        self.history = history
+        self.http_options = {
+            "pool_size": http_pool_size,
+            "proxy": http_proxy,
+            "ca_bundle": http_ca_bundle,
+        }
+        self.session = None
+        self.jobs = OrderedDict()
+        self.queue = asyncio.PriorityQueue()
+        self.workers = []
+        self.servers = []
+        self._sequence = itertools.count()
+
+    def submit(self, kind, args=None, kwargs=None, priority=0):
+        if kind not in JOB_FUNCTIONS:
+            raise ValueError(
+                "Unknown job kind: {}, must be one of: {}".format(
+                    kind, list(JOB_FUNCTIONS.keys())
+                )
+            )
+        # The request is validated before the job is registered, such that
+        # an invalid request never leaves a job behind that can't be run
+        if args is not None and not isinstance(args, list):
+            raise ValueError(
+                INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(type(args), args, "a list")
+            )
+        if kwargs is not None and (
+            not isinstance(kwargs, dict)
+            or not all(isinstance(key, str) for key in kwargs)
+        ):
+            raise ValueError(
+                INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                    type(kwargs), kwargs, "a dictionary with string keys"
+                )
+            )
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise ValueError(
+                INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                    type(priority), priority, "an int"
+                )
+            )
+        job = Job(kind, args=args, kwargs=kwargs, priority=priority)
+        self.jobs[job.id] = job
+        # The queue returns the lowest entry first, so the priority is negated
+        # and the sequence number ensures that equal priorities are FIFO
+        self.queue.put_nowait((-priority, next(self._sequence), job))
+        job.publish(QUEUED)
+        self._prune_history()
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id, None)
+        if not job or job.finished:
+            return False
+        if job.task:
+            job.task.cancel()
+        else:
+            self._finish(job, CANCELLED, JOB_CANCELLED_ERROR, JOB_CANCELLED_ERROR_MSG)
+        return True
+
+    def queued_jobs(self):
+        return sorted(
+            (job for job in self.jobs.values() if job.status == QUEUED),
+            key=lambda job: -job.priority,
+        )
+
+    def _prune_history(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def _finish(self, job, status, return_code, result):
+        job.status = status
+        job.return_code = return_code
+        job.result = result
+        job.finished_at = time.time()
+        job.publish(status, return_code=return_code, result=result)
+        for watcher in job.watchers:
+            watcher.put_nowait(None)
+
+    def _progress_reporter(self, job):
+        """Returns a reporter that publishes the progress of job as job events.
+        The reporter can be called from the threads that the builds run in."""
+        loop = asyncio.get_running_loop()
+
+        def sink(message):
+            message = dict(message)
+            event = message.pop("event")
+            publish = functools.partial(
+                job.publish, event, store=event != PROGRESS, **message
+            )
+            try:
+                running_loop = asyncio.get_running_loop()
+            except RuntimeError:
+                running_loop = None
+            # Publish directly when called from the loop, such that the event
+            # is not delayed until after the job has been finished
+            if running_loop is loop:
+                publish()
+            else:
+                loop.call_soon_threadsafe(publish)
+
+        return ProgressReporter(sink)
+
+    async def _run_job(self, job):
+        job.status = RUNNING
+        job.started_at = time.time()
+        job.publish(RUNNING)
+        try:
+            kwargs = dict(job.kwargs)
+            kwargs.pop("progress_fd", None)
+            kwargs["progress"] = self._progress_reporter(job)
+            kwargs.pop("session", None)
+            if self.session and not any(
+                option in kwargs for option in JOB_HTTP_OPTIONS
+            ):
+                kwargs["session"] = self.session
+            return_code, response = await JOB_FUNCTIONS[job.kind](*job.args, **kwargs)
+        except asyncio.CancelledError:
+            self._finish(job, CANCELLED, JOB_CANCELLED_ERROR, JOB_CANCELLED_ERROR_MSG)
+            return
+        except Exception as err:
+            self._finish(job, FAILED, JOB_ERROR, JOB_ERROR_MSG.format(job.id, err))
+            return
+
+        status = SUCCEEDED if return_code == SUCCESS else FAILED
+        self._finish(job, status, return_code, response)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            try:
+                if job.status != QUEUED:
+                    continue
+                job.task = asyncio.ensure_future(self._run_job(job))
+                try:
+                    await asyncio.shield(job.task)
+                except asyncio.CancelledError:
+                    # Only the job was cancelled if the task has finished,
+                    # otherwise the worker itself is being stopped
+                    if not job.task.done():
+                        job.task.cancel()
+                        raise
+            except Exception as err:
+                # A failing job must never stop the worker that runs it,
+                # since the queue would otherwise stall once every worker
+                # has stopped
+                if not job.finished:
+                    self._finish(
+                        job, FAILED, JOB_ERROR, JOB_ERROR_MSG.format(job.id, err)
+                    )
+            finally:
+                self.queue.task_done()
+
+    def start_workers(self):
+        if not self.session:
+            self.session = new_session(**self.http_options)
+        for _ in range(self.concurrency):
+            self.workers.append(asyncio.ensure_future(self._worker()))
+
+    async def start(self, socket_path):
+        # The server does not authenticate its clients, which is why it only
+        # listens on a UNIX socket that the file permissions protect
+        if exists(socket_path):
+            remove(socket_path)
+        # Only the owner of the server may submit jobs to it, where the
+        # socket is created with these permissions since there would
+        # otherwise be a window in which anyone could connect to it.
+        # The workers are started afterwards such that no build creates
+        # files while the umask is changed
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(
+                self.handle_connection, path=socket_path
+            )
+        finally:
+            os.umask(umask)
+        self.servers.append(server)
+        self.start_workers()
+
+    async def stop(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        for job in self.jobs.values():
+            if not job.finished:
+                self.cancel(job.id)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.servers = []
+        if self.session:
+            self.session.close()
+            self.session = None
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("The request must be a JSON object")
+                    async for response in self.handle_request(request):
+                        await self._write(writer, response)
+                except Exception as err:
+                    await self._write(writer, {"status": "error", "msg": str(err)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _write(self, writer, message):
+        writer.write(json.dumps(message, default=to_str).encode("utf-8") + b"\n")
+        await writer.drain()
+
+    async def handle_request(self, request):
+        """Handles a single request and yields the responses to it.
+        A 'watch' request yields every event of the job until it is finished."""
+        action = request.get("action", None)
+        if action == "submit":
+            job = self.submit(
+                request.get("kind", None),
+                args=request.get("args", []),
+                kwargs=request.get("kwargs", {}),
+                priority=request.get("priority", 0),
+            )
+            yield {"status": "ok", "job": job.asdict()}
+            if request.get("watch", False):
+                async for event in self.watch(job.id):
+                    yield event
+        elif action == "status":
+            job = self._get_job(request)
+            yield {"status": "ok", "job": job.asdict()}
+        elif action == "list":
+            yield {
+                "status": "ok",
+                "jobs": [job.asdict() for job in self.jobs.values()],
+            }
+        elif action == "cancel":
+            job = self._get_job(request)
+            yield {"status": "ok", "cancelled": self.cancel(job.id)}
+        elif action == "watch":
+            self._get_job(request)
+            async for event in self.watch(request["job_id"]):
+                yield event
+        else:
+            raise ValueError("Unknown action: {}".format(action))
+
+    def _get_job(self, request):
+        job_id = request.get("job_id", None)
+        if job_id not in self.jobs:
+            raise ValueError("Unknown job: {}".format(job_id))
+        return self.jobs[job_id]
+
+    async def watch(self, job_id):
+        job = self.jobs[job_id]
+        # Replay the events that have already happened before following
+        # the job until it is finished
+        for event in list(job.events):
+            yield event
+        if job.finished:
+            return
+
+        watcher = asyncio.Queue()
+        job.watchers.append(watcher)
+        try:
+            while True:
+                event = await watcher.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            job.watchers.remove(watcher)
+
+
+async def client_request(request, socket_path=DEFAULT_SERVER_SOCKET):
+    """Sends a single request to a running build server and yields
+    every response that it returns."""
+    reader, writer = await asyncio.open_unix_connection(path=socket_path)
+    try:
+        writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await writer.drain()
+        streaming = request.get("action", None) == "watch" or request.get(
+            "watch", False
+        )
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            yield response
+            if not streaming or response.get("event", None) in FINISHED_STATES:
+                break
+            if response.get("status", None) == "error":
+                break
+    finally:
+        writer.close()
+
+
+async def serve(
+    socket_path=DEFAULT_SERVER_SOCKET,
+    concurrency=DEFAULT_SERVER_CONCURRENCY,
+    http_pool_size=DEFAULT_HTTP_POOL_SIZE,
+    http_proxy=None,
+    http_ca_bundle=None,
+):
+    """Runs the build server until it receives SIGINT or SIGTERM."""
+    response = {}
+    server = BuildServer(
+        concurrency=concurrency,
+        http_pool_size=http_pool_size,
+        http_proxy=http_proxy,
+        http_ca_bundle=http_ca_bundle,
+    )
+    try:
+        await server.start(socket_path)
+    except Exception as err:
+        await server.stop()
+        response["msg"] = SERVER_ERROR_MSG.format(err)
+        return SERVER_ERROR, response
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        await server.stop()
+        if exists(socket_path):
+            remove(socket_path)
+
+    response["msg"] = "The build server was stopped"
+    return SUCCESS, response
@@ -0,0 +1,256 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import hashlib
+import json
+import os
+import re
+
+from gen_vm_image.common.codes import (
+    MERGE_ERROR,
+    MERGE_ERROR_MSG,
+    PATH_CREATE_ERROR,
+    PATH_CREATE_ERROR_MSG,
+    SHARD_ERROR_MSG,
+    SUCCESS,
+)
+from gen_vm_image.common.defaults import GENERATED_IMAGE_DIR
+from gen_vm_image.image import expand_byte_magnitude
+from gen_vm_image.utils.io import exists, load, makedirs, write_atomic
+from gen_vm_image.utils.manifest import write_checksum_manifests
+
+SHARD_FORMAT = re.compile(r"^\s*(?P<index>[0-9]+)\s*/\s*(?P<count>[0-9]+)\s*$")
+
+
+def parse_shard(shard):
+    """Parses a 'K/N' shard, where K is the 1-based index of the shard out
+    of N shards. Returns (parsed, response) where the response contains
+    the 'index' and 'count' of the shard."""
+    match = SHARD_FORMAT.match(str(shard))
+    if not match:
+        return False, {"msg": SHARD_ERROR_MSG.format(shard, "expected K/N")}
+    index, count = int(match.group("index")), int(match.group("count"))
+    if count < 1 or not 1 <= index <= count:
+        return False, {
+            "msg": SHARD_ERROR_MSG.format(shard, "K must be between 1 and N")
+        }
+    return True, {"index": index, "count": count}
+
+
+def shard_key(group):
+    """Returns the stable key of a group of images. Images that share an
+    input are keyed by the input, such that they are always assigned to
+    the same shard and the input is only downloaded by that shard."""
+    input_ = group[0].get("input", None)
+    if input_:
+        return json.dumps(input_, sort_keys=True, default=str)
+    return group[0]["name"]
+
+
+def shard_weight(group):
+    """Returns the expected cost of building a group of images, which is
+    the sum of their sizes."""
+    weight = 0
+    for build_data in group:
+        try:
+            weight += expand_byte_magnitude(str(build_data["size"]))
+        except (KeyError, TypeError, ValueError):
+            weight += 1
+    return weight
+
+
+def plan_shards(groups, count, weighted=False):
+    """Assigns every group of images to one of count shards, without any
+    coordination between the nodes that build the shards.
+
+    By default a group is assigned by the hash of its key, such that
+    adding or removing an image never moves the other images to another
+    shard. If weighted, the groups are instead assigned from the largest to
+    the smallest to the shard with the least weight so far, which balances
+    the shards but may move images when the architecture changes.
+    Returns a list of count shards, each a list of groups."""
+    shards = [[] for _ in range(count)]
+    if not weighted:
+        for group in groups:
+            digest = hashlib.sha256(shard_key(group).encode("utf-8")).hexdigest()
+            shards[int(digest, 16) % count].append(group)
+        return shards
+
+    weights = [0] * count
+    for group in sorted(
+        groups, key=lambda group: (-shard_weight(group), shard_key(group))
+    ):
+        index = weights.index(min(weights))
+        shards[index].append(group)
+        weights[index] += shard_weight(group)
+    return shards
+
+
+def describe_shards(shards):
+    """Returns a description of each shard, such as for --list-shards."""
+    return [
+        {
+            "shard": "{}/{}".format(index + 1, len(shards)),
+            "images": [build_data["name"] for group in groups for build_data in group],
+            "weight": sum(shard_weight(group) for group in groups),
+        }
+        for index, groups in enumerate(shards)
+    ]
+
+
+def new_shard_report(architecture_path, shard=None):
+    return {
+        "architecture": os.path.realpath(architecture_path),
+        "shard": shard,
+        "return_code": None,
+        "images": {},
+    }
+
+
+def write_shard_report(report_path, report):
+    directory = os.path.dirname(report_path)
+    if directory and not exists(directory) and not makedirs(directory):
+        return False
+    return write_atomic(report_path, json.dumps(report, indent=4, sort_keys=True))
+
+
+def merge_shard_reports(
+    report_paths, output_path=None, output_directory=GENERATED_IMAGE_DIR
+):
+    """Combines the reports of the shards of an architecture into a single
+    report, and writes the checksum manifests of every image of every shard
+    to output_directory. The report is written to output_path if it is
+    given, and is otherwise returned as the 'report' of the response."""
+    response = {}
+    reports = []
+    for report_path in report_paths:
+        content = load(report_path)
+        try:
+            report = json.loads(content) if content is not False else None
+        except ValueError:
+            report = None
+        if not isinstance(report, dict) or not isinstance(
+            report.get("images", None), dict
+        ):
+            response["msg"] = MERGE_ERROR_MSG.format(report_path, "not a shard report")
+            return MERGE_ERROR, response
+        reports.append(report)
+
+    merged = {
+        "architecture": None,
+        "shards": [],
+        "return_code": SUCCESS,
+        "images": {},
+    }
+    for report_path, report in zip(report_paths, reports):
+        if merged["architecture"] is None:
+            merged["architecture"] = report.get("architecture", None)
+        merged["shards"].append(report.get("shard", None))
+        if report.get("return_code", None) != SUCCESS:
+            merged["return_code"] = report.get("return_code", None)
+        for filename, image in report["images"].items():
+            if filename in merged["images"]:
+                response["msg"] = MERGE_ERROR_MSG.format(
+                    report_path,
+                    "the image: {} is part of several shards".format(filename),
+                )
+                return MERGE_ERROR, response
+            merged["images"][filename] = image
+
+    shard_counts = {
+        parse_shard(shard)[1]["count"]
+        for shard in merged["shards"]
+        if shard and parse_shard(shard)[0]
+    }
+    if len(shard_counts) > 1:
+        response["msg"] = MERGE_ERROR_MSG.format(
+            report_paths, "the reports are of different numbers of shards"
+        )
+        return MERGE_ERROR, response
+    missing = missing_shards(merged["shards"])
+    if missing:
+        merged["missing_shards"] = missing
+        if merged["return_code"] == SUCCESS:
+            merged["return_code"] = MERGE_ERROR
+
+    entries = {
+        filename: {
+            "size": image.get("size", None),
+            "mtime_ns": image.get("mtime_ns", None),
+            "checksums": image["checksums"],
+        }
+        for filename, image in merged["images"].items()
+        if image.get("checksums", None)
+    }
+    if entries:
+        if not exists(output_directory) and not makedirs(output_directory):
+            response["msg"] = PATH_CREATE_ERROR_MSG.format(
+                output_directory, "Failed to create the output directory"
+            )
+            return PATH_CREATE_ERROR, response
+        algorithms = sorted(
+            {
+                algorithm
+                for entry in entries.values()
+                for algorithm in entry["checksums"]
+            }
+        )
+        written, written_response = write_checksum_manifests(
+            output_directory, entries, algorithms
+        )
+        if not written:
+            response["msg"] = MERGE_ERROR_MSG.format(
+                written_response["errors"], "failed to write the checksum manifests"
+            )
+            return MERGE_ERROR, response
+        merged["manifests"] = written_response["manifests"]
+
+    if output_path and not write_shard_report(output_path, merged):
+        response["msg"] = PATH_CREATE_ERROR_MSG.format(
+            output_path, "Failed to write the merged report"
+        )
+        return PATH_CREATE_ERROR, response
+
+    response["report"] = merged
+    if merged["return_code"] != SUCCESS:
+        response["msg"] = MERGE_ERROR_MSG.format(
+            report_paths,
+            "not every shard succeeded, missing shards: {}".format(missing),
+        )
+        return MERGE_ERROR, response
+    response["msg"] = "Merged the reports of {} shards with {} images".format(
+        len(reports), len(merged["images"])
+    )
+    return SUCCESS, response
+
+
+def missing_shards(shards):
+    """Returns the 'K/N' shards that are missing from the list of shards."""
+    counts = set()
+    indexes = set()
+    for shard in shards:
+        parsed, parsed_response = parse_shard(shard)
+        if parsed:
+            counts.add(parsed_response["count"])
+            indexes.add(parsed_response["index"])
+    if len(counts) != 1:
+        return []
+    count = counts.pop()
+    return [
+        "{}/{}".format(index, count)
+        for index in range(1, count + 1)
+        if index not in indexes
+    ]
@@ -0,0 +1,224 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import json
+import os
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from gen_vm_image.common.defaults import (
+    DEFAULT_CACHE_REVALIDATE_TIMEOUT,
+    DEFAULT_CACHE_TTL,
+)
+from gen_vm_image.utils.job import run_in_thread
+
+# The outcomes of revalidating a cached download
+CACHE_FRESH = "fresh"
+CACHE_NOT_MODIFIED = "not_modified"
+CACHE_MODIFIED = "modified"
+CACHE_UNVALIDATED = "unvalidated"
+
+
+def cache_metadata_path(path):
+    """Returns the path of the sidecar file that the validators of the
+    cached download at path are kept in."""
+    return "{}.cache.json".format(path)
+
+
+def load_cache_metadata(path):
+    """Returns the metadata of the cached download at path,
+    or None if it has none, e.g. if it was cached by an older version."""
+    try:
+        with open(cache_metadata_path(path), "r") as fh:
+            metadata = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(metadata, dict):
+        return None
+    return metadata
+
+
+def save_cache_metadata(path, metadata):
+    metadata_path = cache_metadata_path(path)
+    tmp_path = "{}.{}.tmp".format(metadata_path, os.getpid())
+    try:
+        with open(tmp_path, "w") as fh:
+            json.dump(metadata, fh, indent=4, sort_keys=True)
+        os.replace(tmp_path, metadata_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+
+def new_cache_metadata(path, download_response):
+    """Returns the metadata of a completed download of path."""
+    return {
+        "url": download_response["download_src"],
+        "etag": download_response.get("download_etag", None),
+        "last_modified": download_response.get("download_last_modified", None),
+        "size": os.path.getsize(path),
+        "validated": time.time(),
+    }
+
+
+def _timestamp(http_date):
+    try:
+        return parsedate_to_datetime(http_date).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _content_length(headers):
+    length = headers.get("content-length", "")
+    if headers.get("content-encoding", "identity") != "identity":
+        return None
+    return int(length) if length.isdigit() else None
+
+
+def _conditional_request(url, headers, session=None, timeout=None):
+    """Returns the response to a conditional HEAD request. Servers that
+    reject HEAD requests are asked with a GET request instead, of which
+    the body is never read."""
+    requester = session or requests
+    r = requester.head(url, headers=headers, allow_redirects=True, timeout=timeout)
+    r.close()
+    if r.status_code in (403, 405, 501):
+        r = requester.get(url, headers=headers, stream=True, timeout=timeout)
+        r.close()
+    if r.status_code != 304:
+        r.raise_for_status()
+    return r
+
+
+def _is_modified(path, metadata, r, compare_etag=True):
+    """Returns whether the server response r describes another version of
+    the file than the one that is cached at path."""
+    if r.status_code == 304:
+        return False
+    size = _content_length(r.headers)
+    if size is not None and size != os.path.getsize(path):
+        return True
+
+    etag = r.headers.get("etag", None)
+    if compare_etag and etag and metadata.get("etag", None):
+        return etag != metadata["etag"]
+
+    last_modified = r.headers.get("last-modified", None)
+    if last_modified and metadata.get("last_modified", None):
+        return last_modified != metadata["last_modified"]
+    if last_modified:
+        # A legacy cache entry without metadata is current if the server's
+        # version is not newer than when the entry was downloaded
+        modified_time = _timestamp(last_modified)
+        return modified_time is None or modified_time > os.path.getmtime(path)
+    # Without any validators, the size is all that can be compared
+    return size is None
+
+
+def _revalidate_cache(
+    urls,
+    path,
+    session=None,
+    ttl=DEFAULT_CACHE_TTL,
+    timeout=DEFAULT_CACHE_REVALIDATE_TIMEOUT,
+    save=True,
+):
+    """Returns whether the download of urls that is cached at path can be
+    reused. Within ttl seconds of the last validation the cache is used
+    as is, afterwards it is revalidated with a conditional request with
+    the ETag and Last-Modified validators that the download responded
+    with, such that the image is only downloaded again if it was changed.
+    If the server can not be reached, the cached download is used.
+    The refreshed validators are only saved if save is set."""
+    response = {"cache_path": path}
+    metadata = load_cache_metadata(path)
+    if metadata and metadata.get("size", None) != os.path.getsize(path):
+        # The cached file was changed since it was downloaded
+        metadata = None
+
+    if metadata and ttl is not None:
+        age = time.time() - metadata.get("validated", 0)
+        if ttl < 0 or age < ttl:
+            response["cache_status"] = CACHE_FRESH
+            return True, response
+
+    url = urls[0]
+    compare_etag = False
+    if metadata and metadata.get("url", None) in urls:
+        # The ETag is only comparable with the mirror that it came from
+        url = metadata["url"]
+        compare_etag = True
+    response["cache_url"] = url
+
+    headers = {}
+    if metadata:
+        if compare_etag and metadata.get("etag", None):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified", None):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+    try:
+        r = _conditional_request(url, headers, session=session, timeout=timeout)
+    except requests.RequestException as err:
+        response["cache_status"] = CACHE_UNVALIDATED
+        response["msg"] = str(err)
+        return True, response
+
+    if _is_modified(path, metadata or {}, r, compare_etag=compare_etag):
+        response["cache_status"] = CACHE_MODIFIED
+        return False, response
+
+    # Refresh the metadata, which also adopts legacy cache entries
+    metadata = metadata or {
+        "url": url,
+        "etag": r.headers.get("etag", None),
+        "last_modified": r.headers.get("last-modified", None),
+        "size": os.path.getsize(path),
+    }
+    metadata["validated"] = time.time()
+    if save:
+        save_cache_metadata(path, metadata)
+    response["cache_status"] = CACHE_NOT_MODIFIED
+    return True, response
+
+
+async def revalidate_cache(urls, path, **kwargs):
+    return await run_in_thread(_revalidate_cache, urls, path, **kwargs)
+
+
+def _remote_size(urls, session=None, timeout=DEFAULT_CACHE_REVALIDATE_TIMEOUT):
+    """Returns the number of bytes that a download of the first of urls
+    that reports it would transfer, without downloading it. The size is
+    None if none of the urls report it."""
+    response = {"errors": {}}
+    for url in urls:
+        try:
+            r = _conditional_request(url, {}, session=session, timeout=timeout)
+        except requests.RequestException as err:
+            response["errors"][url] = str(err)
+            continue
+        size = _content_length(r.headers)
+        if size is not None:
+            response["url"] = url
+            return size, response
+    return None, response
+
+
+async def remote_size(urls, **kwargs):
+    return await run_in_thread(_remote_size, urls, **kwargs)
@@ -0,0 +1,115 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import errno
+import fcntl
+import os
+
+from gen_vm_image.common.defaults import (
+    CLONE_COPY_FILE_RANGE,
+    CLONE_REFLINK,
+    DEFAULT_COPY_FILE_RANGE_SIZE,
+    FICLONE,
+)
+from gen_vm_image.utils.job import run_in_thread
+
+
+def reflink(src_fd, dst_fd):
+    """Shares the extents of src_fd with dst_fd, such that the copy is a
+    metadata operation on filesystems that support it, e.g. Btrfs and XFS."""
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _data_ranges(fd, size):
+    """Yields the (offset, length) of every range of fd that contains data,
+    such that the holes of a sparse image are not copied. Without support
+    for SEEK_DATA, the whole file is a single range."""
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # The rest of the file is a hole
+                return
+            if err.errno == errno.EINVAL and offset == 0:
+                yield 0, size
+                return
+            raise
+        hole = os.lseek(fd, data, os.SEEK_HOLE)
+        yield data, hole - data
+        offset = hole
+
+
+def copy_data_ranges(src_fd, dst_fd, size, chunk_size=DEFAULT_COPY_FILE_RANGE_SIZE):
+    """Copies the data of src_fd to dst_fd within the kernel with
+    copy_file_range, which some filesystems also turn into a reflink or a
+    server-side copy. The holes of src_fd are kept as holes."""
+    for offset, length in _data_ranges(src_fd, size):
+        end = offset + length
+        while offset < end:
+            copied = os.copy_file_range(
+                src_fd,
+                dst_fd,
+                min(chunk_size, end - offset),
+                offset_src=offset,
+                offset_dst=offset,
+            )
+            if copied == 0:
+                raise OSError(errno.EIO, "Unexpected end of file at {}".format(offset))
+            offset += copied
+    os.ftruncate(dst_fd, size)
+
+
+def _clone_file(src_path, dst_path):
+    """Copies src_path to dst_path without reading it into userspace,
+    first by a reflink and otherwise with copy_file_range. The 'method' of
+    the response is how the file was cloned. On failure dst_path is removed
+    such that the caller can fall back to another kind of copy."""
+    response = {}
+    errors = []
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        try:
+            reflink(src.fileno(), dst.fileno())
+            response["method"] = CLONE_REFLINK
+            return True, response
+        except OSError as err:
+            errors.append("{}: {}".format(CLONE_REFLINK, err))
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                copy_data_ranges(
+                    src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size
+                )
+                response["method"] = CLONE_COPY_FILE_RANGE
+                return True, response
+            except OSError as err:
+                errors.append("{}: {}".format(CLONE_COPY_FILE_RANGE, err))
+        else:
+            errors.append("{}: not supported".format(CLONE_COPY_FILE_RANGE))
+    os.remove(dst_path)
+    response["msg"] = "Failed to clone: {} - {}".format(src_path, errors)
+    return False, response
+
+
+async def clone_file(src_path, dst_path):
+    try:
+        return await run_in_thread(_clone_file, src_path, dst_path)
+    except OSError as err:
+        return False, {"msg": "Failed to clone: {} - {}".format(src_path, err)}
@@ -0,0 +1,496 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import struct
+import subprocess
+import threading
+
+from gen_vm_image.common.defaults import DEFAULT_DECOMPRESS_BUFFER_SIZE
+from gen_vm_image.utils.io import which
+from gen_vm_image.utils.job import cancel_event, check_cancelled, run_in_worker
+
+# The magic bytes that the supported compression formats start with
+COMPRESSION_MAGIC = {
+    "xz": b"\xfd7zXZ\x00",
+    "gz": b"\x1f\x8b",
+    "zst": b"\x28\xb5\x2f\xfd",
+    "bz2": b"BZh",
+}
+
+# External decoders, in order of preference. The multi-threaded ones are
+# tried first and the single-threaded ones are used if they are missing.
+EXTERNAL_DECOMPRESSORS = {
+    "xz": [["xz", "-T0", "-d", "-c"]],
+    "gz": [["pigz", "-d", "-c"]],
+    "zst": [["zstd", "-T0", "-d", "-c"], ["zstd", "-d", "-c"]],
+    "bz2": [["lbzip2", "-d", "-c"], ["pbzip2", "-d", "-c"]],
+}
+
+
+def detect_compression(path):
+    """Returns the compression format of path based on its magic bytes
+    or None if the file is not compressed with a supported format."""
+    magic_length = max(len(magic) for magic in COMPRESSION_MAGIC.values())
+    try:
+        with open(path, "rb") as fh:
+            head = fh.read(magic_length)
+    except Exception:
+        # TODO, add logging
+        return None
+
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def _read_varint(data, offset):
+    """Returns the xz variable-length integer at offset of data and the
+    offset after it."""
+    value = 0
+    for index in range(9):
+        byte = data[offset + index]
+        value |= (byte & 0x7F) << (7 * index)
+        if not byte & 0x80:
+            return value, offset + index + 1
+    raise ValueError("Invalid variable-length integer")
+
+
+def _xz_decompressed_size(fh):
+    """Returns the sum of the uncompressed sizes that are recorded in the
+    index of every stream of the xz file, which is read from the end."""
+    end = fh.seek(0, os.SEEK_END)
+    total = 0
+    while end > 0:
+        # Streams may be followed by padding of null bytes
+        fh.seek(end - 4)
+        if fh.read(4) == bytes(4):
+            end -= 4
+            continue
+        fh.seek(end - 12)
+        footer = fh.read(12)
+        if len(footer) != 12 or footer[10:] != b"YZ":
+            return None
+        index_size = (struct.unpack_from("<I", footer, 4)[0] + 1) * 4
+        index_start = end - 12 - index_size
+        if index_start < 12:
+            return None
+        fh.seek(index_start)
+        index = fh.read(index_size)
+        if index[0] != 0:
+            return None
+        records, offset = _read_varint(index, 1)
+        blocks_size = 0
+        for _ in range(records):
+            unpadded_size, offset = _read_varint(index, offset)
+            uncompressed_size, offset = _read_varint(index, offset)
+            # The blocks are padded to a multiple of four bytes
+            blocks_size += (unpadded_size + 3) // 4 * 4
+            total += uncompressed_size
+        end = index_start - blocks_size - 12
+    if end != 0:
+        return None
+    return total
+
+
+def _gz_decompressed_size(fh):
+    """Returns the uncompressed size of the gzip file, which only records
+    it modulo 2^32. The smallest size that is at least the compressed size
+    is returned, which is exact for images of less than 4GiB."""
+    compressed_size = fh.seek(0, os.SEEK_END)
+    if compressed_size < 4:
+        return None
+    fh.seek(compressed_size - 4)
+    size = struct.unpack("<I", fh.read(4))[0]
+    while size < compressed_size:
+        size += 1 << 32
+    return size
+
+
+def _zst_decompressed_size(fh):
+    """Returns the content size that is recorded in the header of the first
+    zstd frame, or None if the compressor did not record it."""
+    head = fh.read(18)
+    if len(head) < 6:
+        return None
+    descriptor = head[4]
+    size_flag = descriptor >> 6
+    single_segment = descriptor & 0x20
+    offset = 5 if single_segment else 6
+    offset += [0, 1, 2, 4][descriptor & 0x03]
+    size_length = [1 if single_segment else 0, 2, 4, 8][size_flag]
+    if not size_length or len(head) < offset + size_length:
+        return None
+    size = int.from_bytes(head[offset : offset + size_length], "little")
+    if size_length == 2:
+        size += 256
+    return size
+
+
+DECOMPRESSED_SIZE_READERS = {
+    "xz": _xz_decompressed_size,
+    "gz": _gz_decompressed_size,
+    "zst": _zst_decompressed_size,
+}
+
+
+def decompressed_size(path, compression):
+    """Returns the size that path is expected to have once it is
+    decompressed, as recorded by the compression format, without
+    decompressing it. The compressed size is returned if the format does
+    not record it, e.g. bz2, or if it can't be read."""
+    try:
+        reader = DECOMPRESSED_SIZE_READERS.get(compression, None)
+        if reader:
+            with open(path, "rb") as fh:
+                size = reader(fh)
+            if size is not None:
+                return size
+        return os.path.getsize(path)
+    except (OSError, ValueError, IndexError, struct.error):
+        # TODO, add logging
+        return None
+
+
+def strip_compression_extension(path, compression):
+    """Returns the path without the compression extension.
+    If path does not end with the extension, '.decompressed' is appended
+    such that the returned path always differs from the input path."""
+    extension = ".{}".format(compression)
+    if path.endswith(extension):
+        return path[: -len(extension)]
+    return "{}.decompressed".format(path)
+
+
+def find_external_decompressor(compression):
+    for command in EXTERNAL_DECOMPRESSORS.get(compression, []):
+        if which(command[0]):
+            return command
+    return None
+
+
+class StreamHasher:
+    """Incrementally hashes a stream, optionally limited to the first
+    read_bytes bytes of it."""
+
+    def __init__(self, algorithm, read_bytes=None):
+        self.hash_algorithm = hashlib.new(algorithm)
+        self.remaining = read_bytes
+
+    def update(self, data):
+        if self.remaining is None:
+            self.hash_algorithm.update(data)
+            return
+        if self.remaining <= 0:
+            return
+        data = data[: self.remaining]
+        self.hash_algorithm.update(data)
+        self.remaining -= len(data)
+
+    def hexdigest(self):
+        return self.hash_algorithm.hexdigest()
+
+
+class _HashingReader:
+    """File object proxy that passes every read chunk to on_read."""
+
+    def __init__(self, fh, on_read=None):
+        self.fh = fh
+        self.on_read = on_read
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        if data and self.on_read:
+            self.on_read(data)
+        return data
+
+    def readinto(self, buffer):
+        read = self.fh.readinto(buffer)
+        if read and self.on_read:
+            self.on_read(memoryview(buffer)[:read])
+        return read
+
+    def readable(self):
+        return True
+
+    def close(self):
+        pass
+
+    @property
+    def closed(self):
+        return self.fh.closed
+
+
+def _open_python_decompressor(compression, fileobj):
+    if compression == "xz":
+        return lzma.LZMAFile(fileobj)
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=fileobj)
+    if compression == "bz2":
+        return bz2.BZ2File(fileobj)
+    if compression == "zst":
+        try:
+            import zstandard
+        except ImportError:
+            return None
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True
+        )
+    return None
+
+
+def _feed_process(input_path, stdin, buffer_size, on_read, errors, cancel_event=None):
+    try:
+        with open(input_path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(buffer_size), b""):
+                check_cancelled(cancel_event)
+                if on_read:
+                    on_read(chunk)
+                stdin.write(chunk)
+    except Exception as err:
+        errors.append(err)
+    finally:
+        try:
+            stdin.close()
+        except Exception:
+            pass
+
+
+def _is_zero_block(buffer, read, zero_block):
+    # Comparing the bytearray itself is a plain memcmp, whereas comparing
+    # memoryviews is done element by element, so only slice when required
+    if read == len(buffer):
+        return buffer == zero_block
+    return bytes(buffer[:read]) == zero_block[:read]
+
+
+def _drain(stream, output_fh, buffer_size, on_output, cancel_event=None):
+    """Writes the stream to output_fh, but seeks over blocks that only contain
+    zeros such that decompressed raw images stay sparse on disk. If the
+    cancel_event is set, it stops before the next read with a
+    JobCancelledError."""
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    zero_block = bytes(buffer_size)
+    total = 0
+    while True:
+        check_cancelled(cancel_event)
+        read = stream.readinto(buffer)
+        if not read:
+            break
+        chunk = view[:read]
+        if on_output:
+            on_output(chunk)
+        if _is_zero_block(buffer, read, zero_block):
+            output_fh.seek(read, os.SEEK_CUR)
+        else:
+            output_fh.write(chunk)
+        total += read
+    # Ensure that trailing zeros that were skipped are reflected in the size
+    output_fh.truncate(total)
+    return total
+
+
+def _progress_callback(on_progress, total, on_read=None):
+    """Returns a read callback that reports the accumulated number
+    of bytes to on_progress before it passes the chunk on to on_read."""
+    done = 0
+
+    def callback(chunk):
+        nonlocal done
+        done += len(chunk)
+        if on_read:
+            on_read(chunk)
+        on_progress(done, total)
+
+    return callback
+
+
+def _decompress_file(
+    input_path,
+    output_path,
+    compression=None,
+    checksum_algorithm=None,
+    checksum_decompressed=False,
+    checksum_read_bytes=None,
+    buffer_size=DEFAULT_DECOMPRESS_BUFFER_SIZE,
+    on_progress=None,
+    cancel_event=None,
+):
+    """Decompresses input_path into output_path in a single streaming pass.
+    If checksum_algorithm is set, the checksum of either the compressed
+    or the decompressed stream (if checksum_decompressed) is calculated
+    while the data is passing through. If on_progress is set, it is called
+    with the number of compressed bytes read and the total compressed size.
+    If the cancel_event is set, the decompression is stopped and its
+    partial output is removed."""
+    response = {}
+    if not compression:
+        compression = detect_compression(input_path)
+    if not compression:
+        response["msg"] = "Unable to detect a supported compression format"
+        return False, response
+    response["compression"] = compression
+
+    hasher = None
+    if checksum_algorithm:
+        try:
+            hasher = StreamHasher(checksum_algorithm, read_bytes=checksum_read_bytes)
+        except Exception as err:
+            response["msg"] = str(err)
+            return False, response
+
+    on_compressed = hasher.update if hasher and not checksum_decompressed else None
+    if on_progress:
+        on_compressed = _progress_callback(
+            on_progress, os.path.getsize(input_path), on_compressed
+        )
+    on_decompressed = hasher.update if hasher and checksum_decompressed else None
+
+    # Write into a partial file first such that an interrupted
+    # decompression is never mistaken for a completed one
+    partial_output_path = "{}.partial".format(output_path)
+    try:
+        with open(partial_output_path, "wb") as output_fh:
+            command = find_external_decompressor(compression)
+            if command:
+                response["decompressor"] = " ".join(command)
+                decompressed_size = _decompress_external(
+                    command,
+                    input_path,
+                    output_fh,
+                    buffer_size,
+                    on_compressed,
+                    on_decompressed,
+                    cancel_event=cancel_event,
+                )
+            else:
+                response["decompressor"] = "python"
+                decompressed_size = _decompress_python(
+                    compression,
+                    input_path,
+                    output_fh,
+                    buffer_size,
+                    on_compressed,
+                    on_decompressed,
+                    cancel_event=cancel_event,
+                )
+        os.replace(partial_output_path, output_path)
+    except Exception as err:
+        if os.path.exists(partial_output_path):
+            os.remove(partial_output_path)
+        response["msg"] = str(err)
+        return False, response
+
+    response["decompressed_path"] = output_path
+    response["decompressed_size"] = decompressed_size
+    if hasher:
+        response["checksum"] = hasher.hexdigest()
+    return True, response
+
+
+async def decompress_file(input_path, output_path, **kwargs):
+    # An external decompressor inherits the priority of the worker thread
+    kwargs.setdefault("cancel_event", cancel_event)
+    return await run_in_worker(_decompress_file, input_path, output_path, **kwargs)
+
+
+def _decompress_external(
+    command,
+    input_path,
+    output_fh,
+    buffer_size,
+    on_compressed,
+    on_decompressed,
+    cancel_event=None,
+):
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    errors, stderr = [], []
+    feeder = threading.Thread(
+        target=_feed_process,
+        args=(input_path, process.stdin, buffer_size, on_compressed, errors),
+        kwargs={"cancel_event": cancel_event},
+        daemon=True,
+    )
+    # Drain stderr in the background such that a full pipe cannot block the process
+    stderr_reader = threading.Thread(
+        target=lambda: stderr.append(process.stderr.read()), daemon=True
+    )
+    feeder.start()
+    stderr_reader.start()
+    try:
+        decompressed_size = _drain(
+            process.stdout,
+            output_fh,
+            buffer_size,
+            on_decompressed,
+            cancel_event=cancel_event,
+        )
+    except BaseException:
+        # Nothing reads the output anymore, so the decompressor is killed
+        # such that the feeder is not blocked writing to it forever
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        feeder.join()
+        stderr_reader.join()
+        process.stderr.close()
+        returncode = process.wait()
+
+    if errors:
+        raise errors[0]
+    if returncode != 0:
+        raise RuntimeError(
+            "'{}' failed with: {}".format(
+                " ".join(command),
+                b"".join(stderr).decode("utf-8", errors="replace"),
+            )
+        )
+    return decompressed_size
+
+
+def _decompress_python(
+    compression,
+    input_path,
+    output_fh,
+    buffer_size,
+    on_compressed,
+    on_decompressed,
+    cancel_event=None,
+):
+    with open(input_path, "rb") as input_fh:
+        reader = _HashingReader(input_fh, on_read=on_compressed)
+        stream = _open_python_decompressor(compression, reader)
+        if not stream:
+            raise RuntimeError(
+                "No decompressor is available for the '{}' format".format(compression)
+            )
+        with stream:
+            return _drain(
+                stream,
+                output_fh,
+                buffer_size,
+                on_decompressed,
+                cancel_event=cancel_event,
+            )
@@ -0,0 +1,174 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import json
+import os
+import threading
+import time
+
+from gen_vm_image.common.defaults import (
+    DEFAULT_DIGEST_INDEX_FILE,
+    DIGEST_INDEX_RACY_WINDOW,
+    TMP_DIR,
+)
+from gen_vm_image.utils.lock import FileLock
+
+
+def file_identity(path, stat=None):
+    """Returns the identity of the file content at path, which changes
+    whenever the content may have changed. The ctime is included since
+    it can not be reset, unlike the mtime."""
+    stat = stat or os.stat(path)
+    return [
+        stat.st_dev,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+    ]
+
+
+def digest_key(algorithm, read_bytes=None):
+    if read_bytes:
+        return "{}:{}".format(algorithm.lower(), read_bytes)
+    return algorithm.lower()
+
+
+def _newest_change(stat):
+    return max(stat.st_mtime, stat.st_ctime)
+
+
+class DigestIndex:
+    """A persistent index of the digests of files, such that an unchanged
+    file is never hashed twice. The digests of a file are keyed by its
+    device, inode, size, mtime and ctime, and are dropped as soon as any
+    of them changes."""
+
+    def __init__(self, path=None, racy_window=DIGEST_INDEX_RACY_WINDOW):
+        self.path = path or os.path.join(TMP_DIR, DEFAULT_DIGEST_INDEX_FILE)
+        # The digests of files that were modified within this many seconds
+        # of being hashed are racy, since a later write within the same
+        # timestamp granularity would not change their identity. They are
+        # only used once a later stat finds the file unchanged after the
+        # window has passed, e.g. when the next build looks them up
+        self.racy_window = racy_window
+        self._lock = threading.Lock()
+        self._changed = set()
+        self.files = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as fh:
+                files = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(files, dict):
+            return {}
+        return files
+
+    def lookup(self, path, algorithm, read_bytes=None):
+        """Returns the indexed digest of path, or None if the file has
+        changed since it was indexed, was never indexed, or is still within
+        the racy window of when its digests were indexed."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        identity = file_identity(path, stat=stat)
+        real_path = os.path.realpath(path)
+        with self._lock:
+            entry = self.files.get(real_path, None)
+            if not entry or entry.get("identity", None) != identity:
+                return None
+            if entry.get("racy", False):
+                if time.time() - _newest_change(stat) < self.racy_window:
+                    return None
+                # The file is still unchanged after the racy window
+                del entry["racy"]
+                self._changed.add(real_path)
+            return entry.get("digests", {}).get(digest_key(algorithm, read_bytes))
+
+    def record(self, path, algorithm, digest, read_bytes=None, stat=None, started=None):
+        """Indexes the digest of path, where stat is the os.stat of path
+        from when it started to be hashed at the started time. The digest
+        is not indexed if the file was changed while it was being hashed,
+        and is indexed as racy if the file was changed shortly before."""
+        try:
+            current_stat = os.stat(path)
+        except OSError:
+            return False
+        identity = file_identity(path, stat=current_stat)
+        if stat is not None and file_identity(path, stat=stat) != identity:
+            return False
+        started = started or time.time()
+        racy = started - _newest_change(current_stat) < self.racy_window
+
+        real_path = os.path.realpath(path)
+        with self._lock:
+            entry = self.files.get(real_path, None)
+            if not entry or entry.get("identity", None) != identity:
+                entry = {"identity": identity, "digests": {}}
+                if racy:
+                    entry["racy"] = True
+                self.files[real_path] = entry
+            elif not racy:
+                entry.pop("racy", None)
+            entry["digests"][digest_key(algorithm, read_bytes)] = digest
+            self._changed.add(real_path)
+        return True
+
+    def save(self):
+        """Merges the changed entries into the index file, such that the
+        entries of concurrent builds are kept, and prunes the entries of
+        files that no longer exist."""
+        with self._lock:
+            if not self._changed:
+                return True
+            changed, self._changed = self._changed, set()
+            entries = {
+                real_path: self.files.get(real_path, None) for real_path in changed
+            }
+
+        tmp_path = "{}.{}.{}.tmp".format(self.path, os.getpid(), threading.get_ident())
+        try:
+            # Concurrent builds merge their entries one at a time
+            with FileLock(self.path):
+                files = self._load()
+                for real_path, entry in entries.items():
+                    if entry:
+                        files[real_path] = entry
+                    else:
+                        files.pop(real_path, None)
+                files = {
+                    path: entry for path, entry in files.items() if os.path.exists(path)
+                }
+                with open(tmp_path, "w") as fh:
+                    fh.write(json.dumps(files, indent=4, sort_keys=True))
+                os.replace(tmp_path, self.path)
+        except OSError:
+            # The index is only an optimization
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+
+def index_digest(path, algorithm, digest, read_bytes=None, index_path=None):
+    """Records the digest of path in the DigestIndex at index_path and saves
+    it, which blocks while the index file is loaded, locked and written."""
+    digest_index = DigestIndex(path=index_path)
+    digest_index.record(path, algorithm, digest, read_bytes=read_bytes)
+    return digest_index.save()
@@ -0,0 +1,239 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import re
+import struct
+import uuid
+
+QCOW2_MAGIC = b"QFI\xfb"
+# The size of a version 2 header, version 3 headers are at least 104 bytes
+QCOW2_HEADER_SIZE = 72
+# The incompatible feature bit of a qcow2 image with an external data file
+QCOW2_INCOMPAT_DATA_FILE = 1 << 2
+QED_MAGIC = b"QED\x00"
+QED_F_BACKING_FILE = 1
+VMDK_SPARSE_MAGIC = b"KDMV"
+VMDK_DESCRIPTOR_MAGIC = b"# Disk DescriptorFile"
+VDI_SIGNATURE = 0xBEDA107F
+VDI_SIGNATURE_OFFSET = 64
+VDI_TYPE_DIFF = 4
+VHDX_MAGIC = b"vhdxfile"
+VHDX_REGION_TABLE_OFFSET = 192 * 1024
+VHDX_METADATA_REGION = uuid.UUID("8b7ca206-4790-4b9a-b8fe-575f050f886e").bytes_le
+VHDX_FILE_PARAMETERS = uuid.UUID("caa16737-fa36-4d43-b3b6-33f0aa44e76b").bytes_le
+VHDX_VIRTUAL_DISK_SIZE = uuid.UUID("2fa54224-cd1b-4876-b211-5dbed83bf4b8").bytes_le
+VHDX_HAS_PARENT = 1 << 1
+SECTOR_SIZE = 512
+# The number of bytes that is read to identify an image
+HEADER_READ_SIZE = 512
+
+VMDK_EXTENT = re.compile(r"^\s*(?:RW|RDONLY|NOACCESS)\s+(?P<sectors>\d+)\s", re.M)
+VMDK_PARENT = re.compile(r'^\s*parentFileNameHint\s*=\s*"(?P<parent>[^"]*)"', re.M)
+VMDK_CREATE_TYPE = re.compile(r'^\s*createType\s*=\s*"(?P<type>[^"]*)"', re.M)
+
+
+def _new_header(image_format, **fields):
+    header = {
+        "format": image_format,
+        "virtual_size": None,
+        "cluster_size": None,
+        "compat": None,
+        "backing_file": None,
+        "has_backing_file": False,
+        "data_file": False,
+    }
+    header.update(fields)
+    return header
+
+
+def _read_at(fh, offset, length):
+    fh.seek(offset)
+    return fh.read(length)
+
+
+def _qcow2_header(fh, head):
+    version, backing_file_offset, backing_file_size, cluster_bits, size = (
+        struct.unpack_from(">IQIIQ", head, 4)
+    )
+    header = _new_header(
+        "qcow2",
+        virtual_size=size,
+        cluster_size=1 << cluster_bits,
+        compat="0.10" if version < 3 else "1.1",
+        version=version,
+        has_backing_file=bool(backing_file_offset),
+    )
+    if version >= 3 and len(head) >= 80:
+        (incompatible_features,) = struct.unpack_from(">Q", head, 72)
+        header["data_file"] = bool(incompatible_features & QCOW2_INCOMPAT_DATA_FILE)
+    if backing_file_offset:
+        header["backing_file"] = _read_at(
+            fh, backing_file_offset, backing_file_size
+        ).decode("utf-8", errors="replace")
+    return header
+
+
+def _qed_header(fh, head):
+    (
+        cluster_size,
+        features,
+        image_size,
+        backing_filename_offset,
+        backing_filename_size,
+    ) = struct.unpack_from("<I8xQ24xQII", head, 4)
+    header = _new_header(
+        "qed",
+        virtual_size=image_size,
+        cluster_size=cluster_size,
+        has_backing_file=bool(features & QED_F_BACKING_FILE),
+    )
+    if header["has_backing_file"]:
+        header["backing_file"] = _read_at(
+            fh, backing_filename_offset, backing_filename_size
+        ).decode("utf-8", errors="replace")
+    return header
+
+
+def _vmdk_descriptor_fields(header, descriptor):
+    """Adds the fields of the text descriptor of a vmdk image to header."""
+    create_type = VMDK_CREATE_TYPE.search(descriptor)
+    if create_type:
+        header["compat"] = create_type.group("type")
+    parent = VMDK_PARENT.search(descriptor)
+    if parent and parent.group("parent"):
+        header["has_backing_file"] = True
+        header["backing_file"] = parent.group("parent")
+    return header
+
+
+def _vmdk_sparse_header(fh, head):
+    version, capacity, grain_size, descriptor_offset, descriptor_size = (
+        struct.unpack_from("<I4xQQQQ", head, 4)
+    )
+    header = _new_header(
+        "vmdk",
+        virtual_size=capacity * SECTOR_SIZE,
+        cluster_size=grain_size * SECTOR_SIZE,
+        version=version,
+    )
+    if descriptor_offset and descriptor_size:
+        descriptor = _read_at(
+            fh, descriptor_offset * SECTOR_SIZE, descriptor_size * SECTOR_SIZE
+        )
+        _vmdk_descriptor_fields(
+            header, descriptor.split(b"\x00", 1)[0].decode("utf-8", errors="replace")
+        )
+    return header
+
+
+def _vmdk_descriptor_header(fh, head):
+    # A descriptor file is small text, that refers to the extent files
+    descriptor = (head + fh.read(64 * 1024)).decode("utf-8", errors="replace")
+    header = _new_header(
+        "vmdk",
+        virtual_size=sum(
+            int(extent.group("sectors")) * SECTOR_SIZE
+            for extent in VMDK_EXTENT.finditer(descriptor)
+        ),
+    )
+    return _vmdk_descriptor_fields(header, descriptor)
+
+
+def _vdi_header(fh, head):
+    version, image_type = struct.unpack_from("<I4xI", head, 68)
+    disk_size, block_size = struct.unpack_from("<QI", head, 368)
+    return _new_header(
+        "vdi",
+        virtual_size=disk_size,
+        cluster_size=block_size,
+        compat="{}.{}".format(version >> 16, version & 0xFFFF),
+        # The parent of a differencing image is only known by its UUID
+        has_backing_file=image_type == VDI_TYPE_DIFF,
+    )
+
+
+def _vhdx_metadata(fh):
+    """Returns the items of the metadata region of a vhdx image by their id."""
+    region_table = _read_at(fh, VHDX_REGION_TABLE_OFFSET, 64 * 1024)
+    if region_table[:4] != b"regi":
+        return {}
+    (entry_count,) = struct.unpack_from("<I", region_table, 8)
+    for index in range(min(entry_count, 2047)):
+        entry = region_table[16 + index * 32 : 16 + (index + 1) * 32]
+        if entry[:16] != VHDX_METADATA_REGION:
+            continue
+        (region_offset,) = struct.unpack_from("<Q", entry, 16)
+        table = _read_at(fh, region_offset, 64 * 1024)
+        if table[:8] != b"metadata":
+            return {}
+        (item_count,) = struct.unpack_from("<H", table, 10)
+        items = {}
+        for item in range(min(item_count, 2047)):
+            item_entry = table[32 + item * 32 : 32 + (item + 1) * 32]
+            item_offset, item_length = struct.unpack_from("<II", item_entry, 16)
+            items[item_entry[:16]] = _read_at(
+                fh, region_offset + item_offset, item_length
+            )
+        return items
+    return {}
+
+
+def _vhdx_header(fh, head):
+    header = _new_header("vhdx")
+    items = _vhdx_metadata(fh)
+    if len(items.get(VHDX_VIRTUAL_DISK_SIZE, b"")) >= 8:
+        (header["virtual_size"],) = struct.unpack_from(
+            "<Q", items[VHDX_VIRTUAL_DISK_SIZE]
+        )
+    if len(items.get(VHDX_FILE_PARAMETERS, b"")) >= 8:
+        block_size, flags = struct.unpack_from("<II", items[VHDX_FILE_PARAMETERS])
+        header["cluster_size"] = block_size
+        header["has_backing_file"] = bool(flags & VHDX_HAS_PARENT)
+    return header
+
+
+def read_image_header(path):
+    """Returns the format, virtual size, cluster size, compat level and
+    backing file of the image at path by reading its header in-process,
+    which is much faster than asking qemu-img. Returns None if the image is
+    not in one of the recognised formats, in which case it is either raw or
+    in a format that only qemu-img knows."""
+    try:
+        with open(path, "rb") as fh:
+            head = fh.read(HEADER_READ_SIZE)
+            if head.startswith(QCOW2_MAGIC) and len(head) >= QCOW2_HEADER_SIZE:
+                return _qcow2_header(fh, head)
+            if head.startswith(QED_MAGIC) and len(head) >= 64:
+                return _qed_header(fh, head)
+            if head.startswith(VMDK_SPARSE_MAGIC) and len(head) >= 44:
+                return _vmdk_sparse_header(fh, head)
+            if head.startswith(VMDK_DESCRIPTOR_MAGIC):
+                return _vmdk_descriptor_header(fh, head)
+            if head.startswith(VHDX_MAGIC):
+                return _vhdx_header(fh, head)
+            if len(head) >= 380 and (
+                struct.unpack_from("<I", head, VDI_SIGNATURE_OFFSET)[0] == VDI_SIGNATURE
+            ):
+                return _vdi_header(fh, head)
+    except (OSError, struct.error):
+        return None
+    return None
+
+
+def raw_header(path):
+    """Returns the header of a raw image, which is only its size."""
+    return _new_header("raw", virtual_size=os.path.getsize(path))
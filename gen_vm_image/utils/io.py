@@ -14,11 +14,25 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import itertools
 import os
 import re
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from gen_vm_image.common.defaults import DEFAULT_BUFFER_SIZE
+from gen_vm_image.common.defaults import (
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_HASHSUMS_BUFFER_SIZE,
+    PARALLEL_HASH_MIN_BUFFER_SIZE,
+    STAGING_SUFFIX,
+)
+from gen_vm_image.utils.job import run_in_worker
+
+STAGING_FILE = re.compile(
+    r"^\.(?P<filename>.+)\.(?P<pid>[0-9]+){}$".format(re.escape(STAGING_SUFFIX))
+)
 
 
 def makedirs(path):
@@ -67,6 +81,70 @@ def write(path, content, mode="w", mkdirs=False, handler=None, **handler_kwargs)
     return False
 
 
+def write_atomic(path, content, mode="w"):
+    """Writes content to a temporary file next to path and then renames it
+    to path, such that readers never see a partially written file."""
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode) as fh:
+            fh.write(content)
+        os.replace(tmp_path, path)
+        return True
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def staging_path(path):
+    """Returns the hidden path next to path that it is built at before it is
+    published, which is unique to the current process."""
+    directory, filename = os.path.split(path)
+    return os.path.join(
+        directory, ".{}.{}{}".format(filename, os.getpid(), STAGING_SUFFIX)
+    )
+
+
+def publish(staged_path, path):
+    """Atomically replaces path with the staged_path, such that path is
+    either the previous or the complete file and never a partial one."""
+    try:
+        os.replace(staged_path, path)
+        return True
+    except OSError:
+        return False
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but is owned by another user
+        return True
+    return True
+
+
+def remove_stale_staging_files(directory):
+    """Removes the staging files in directory that were left behind by
+    processes that no longer run, e.g. because they were killed while
+    building an image. Returns the list of removed paths."""
+    removed = []
+    try:
+        filenames = os.listdir(directory)
+    except OSError:
+        return removed
+    for filename in filenames:
+        match = STAGING_FILE.match(filename)
+        if not match or _pid_alive(int(match.group("pid"))):
+            continue
+        path = os.path.join(directory, filename)
+        if remove(path):
+            removed.append(path)
+    return removed
+
+
 def remove(path, recursive=False):
     try:
         if recursive:
@@ -122,36 +200,124 @@ def copy(original, target):
     return False
 
 
-# Read chunks of a file, default to 64KB
-async def hashsum(
-    path, algorithm="sha1", buffer_size=DEFAULT_BUFFER_SIZE, read_bytes_of_file=None
+def _hashsums(
+    path,
+    algorithms,
+    buffer_size=DEFAULT_HASHSUMS_BUFFER_SIZE,
+    read_bytes_of_file=None,
+    on_progress=None,
+    digest_index=None,
+    force=False,
 ):
+    """Returns a dictionary of the digest of path for each of the algorithms,
+    which are all calculated in a single read of the file. If the buffer is
+    at least PARALLEL_HASH_MIN_BUFFER_SIZE, each algorithm is updated in its
+    own thread while the next buffer is read, since hashlib releases the GIL
+    while it hashes large buffers. If a DigestIndex is given, the digests
+    of a file that is unchanged since it was last hashed are looked up
+    instead of being calculated, unless force is set, and the calculated
+    digests are indexed."""
     try:
         import hashlib
 
-        hash_algorithm = hashlib.new(algorithm)
-        if read_bytes_of_file:
-            bytes_read = 0
-            if buffer_size > read_bytes_of_file:
-                buffer_size = read_bytes_of_file
-
-        with open(path, "rb") as fh:
-            for chunk in iter(lambda: fh.read(buffer_size), b""):
-                hash_algorithm.update(chunk)
-                if read_bytes_of_file:
-                    bytes_read += buffer_size
-                    if (bytes_read + buffer_size) >= read_bytes_of_file:
-                        buffer_size = read_bytes_of_file - bytes_read
-                    if buffer_size == 0:
+        algorithms = list(dict.fromkeys(algorithms))
+        total = read_bytes_of_file or os.path.getsize(path)
+        digests = {}
+        if digest_index is not None and not force:
+            for algorithm in algorithms:
+                digest = digest_index.lookup(
+                    path, algorithm, read_bytes=read_bytes_of_file
+                )
+                if digest:
+                    digests[algorithm] = digest
+
+        missing = [algorithm for algorithm in algorithms if algorithm not in digests]
+        if not missing:
+            if on_progress:
+                on_progress(total, total)
+            return digests
+
+        started, stat = time.time(), os.stat(path)
+        hashes = [hashlib.new(algorithm) for algorithm in missing]
+        parallel = len(hashes) > 1 and buffer_size >= PARALLEL_HASH_MIN_BUFFER_SIZE
+        # Two buffers such that one is read into while the other is hashed
+        buffers = [memoryview(bytearray(buffer_size)) for _ in range(2)]
+        remaining = read_bytes_of_file
+        hashed = 0
+        executor = ThreadPoolExecutor(len(hashes)) if parallel else None
+        try:
+            with open(path, "rb") as fh:
+                pending = []
+                for index in itertools.cycle(range(len(buffers))):
+                    read_size = buffer_size
+                    if remaining is not None:
+                        read_size = min(buffer_size, remaining)
+                    read = fh.readinto(buffers[index][:read_size]) if read_size else 0
+                    for future in pending:
+                        future.result()
+                    if not read:
                         break
 
-        return hash_algorithm.hexdigest()
+                    chunk = buffers[index][:read]
+                    if parallel:
+                        pending = [executor.submit(h.update, chunk) for h in hashes]
+                    else:
+                        for h in hashes:
+                            h.update(chunk)
+                    if remaining is not None:
+                        remaining -= read
+                    if on_progress:
+                        hashed += read
+                        on_progress(hashed, total)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        for algorithm, h in zip(missing, hashes):
+            digests[algorithm] = h.hexdigest()
+            if digest_index is not None:
+                digest_index.record(
+                    path,
+                    algorithm,
+                    digests[algorithm],
+                    read_bytes=read_bytes_of_file,
+                    stat=stat,
+                    started=started,
+                )
+        if digest_index is not None:
+            digest_index.save()
+        return digests
     except Exception:
         # TODO, add logging
         return False
     return False
 
 
+# Read chunks of a file, default to 64KB
+def _hashsum(
+    path,
+    algorithm="sha1",
+    buffer_size=DEFAULT_BUFFER_SIZE,
+    read_bytes_of_file=None,
+    on_progress=None,
+    digest_index=None,
+    force=False,
+):
+    """See _hashsums for how the digest_index and force are used."""
+    digests = _hashsums(
+        path,
+        [algorithm],
+        buffer_size=buffer_size,
+        read_bytes_of_file=read_bytes_of_file,
+        on_progress=on_progress,
+        digest_index=digest_index,
+        force=force,
+    )
+    if not digests:
+        return False
+    return digests[algorithm]
+
+
 def find(directory_path, regex_name):
     found = []
     for root, dirs, files in os.walk(directory_path):
@@ -169,3 +335,45 @@ def size(path):
         # TODO, add logging
         return False
     return False
+
+
+async def hashsum(
+    path,
+    algorithm="sha1",
+    buffer_size=DEFAULT_BUFFER_SIZE,
+    read_bytes_of_file=None,
+    on_progress=None,
+    digest_index=None,
+    force=False,
+):
+    return await run_in_worker(
+        _hashsum,
+        path,
+        algorithm=algorithm,
+        buffer_size=buffer_size,
+        read_bytes_of_file=read_bytes_of_file,
+        on_progress=on_progress,
+        digest_index=digest_index,
+        force=force,
+    )
+
+
+async def hashsums(
+    path,
+    algorithms,
+    buffer_size=DEFAULT_HASHSUMS_BUFFER_SIZE,
+    read_bytes_of_file=None,
+    on_progress=None,
+    digest_index=None,
+    force=False,
+):
+    return await run_in_worker(
+        _hashsums,
+        path,
+        algorithms,
+        buffer_size=buffer_size,
+        read_bytes_of_file=read_bytes_of_file,
+        on_progress=on_progress,
+        digest_index=digest_index,
+        force=force,
+    )
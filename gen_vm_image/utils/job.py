@@ -14,7 +14,41 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import asyncio
+import contextlib
+import functools
+import os
+import re
+import signal
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from gen_vm_image.common.codes import (
+    JOB_CANCELLED_ERROR,
+    JOB_CANCELLED_ERROR_MSG,
+    JOB_TIMEOUT_ERROR_MSG,
+)
+from gen_vm_image.common.defaults import (
+    DEFAULT_JOB_KILL_TIMEOUT,
+    DEFAULT_JOB_OUTPUT_LIMIT,
+    DEFAULT_JOB_TIMEOUT,
+    DEFAULT_PROCESS_JOBS,
+)
+
+# Progress output is commonly redrawn with '\r' instead of a new line
+OUTPUT_SEGMENT_SEPARATOR = re.compile(rb"[\r\n]")
+
+
+class JobCancelledError(Exception):
+    """Raised by the blocking loops that run in executor threads, such as
+    the downloads and decompressions, once their cancel event is set."""
+
+
+def check_cancelled(event):
+    """Raises JobCancelledError if the cancel event is set."""
+    if event is not None and event.is_set():
+        raise JobCancelledError(JOB_CANCELLED_ERROR_MSG)
 
 
 def __format_output__(result, format_output_str=False):
@@ -54,3 +88,302 @@ def check_call(cmd, format_output_str=False, **kwargs):
 def run(cmd, format_output_str=False, **run_kwargs):
     result = subprocess.run(cmd, **run_kwargs)
     return __format_output__(result, format_output_str=format_output_str)
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """Runs the blocking func in the default executor such that
+    the event loop can progress other builds in the meantime."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def run_in_worker(func, *args, **kwargs):
+    """Runs the CPU or I/O heavy func, e.g. hashing an image, in a worker
+    thread that runs with the job priority if one is set, see
+    set_job_priority, otherwise in the default executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _worker_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+class OutputBuffer:
+    """A ring buffer that keeps the last limit bytes of an output stream,
+    such that a command that writes a lot can't exhaust the memory."""
+
+    def __init__(self, limit=DEFAULT_JOB_OUTPUT_LIMIT):
+        self.limit = limit
+        self.data = bytearray()
+        # The number of bytes that were dropped from the start of the output
+        self.dropped = 0
+
+    def write(self, chunk):
+        self.data.extend(chunk)
+        excess = len(self.data) - self.limit
+        if excess > 0:
+            del self.data[:excess]
+            self.dropped += excess
+
+    def getvalue(self):
+        return bytes(self.data)
+
+
+class JobRunner:
+    """Runs external commands, such as qemu-img, as asyncio subprocesses.
+    Each command runs in its own process group, such that a timeout or a
+    cancellation terminates the command along with any of its children,
+    and at most max_jobs commands run at the same time. If a ProcessPriority
+    is given, the process group of each command runs with it."""
+
+    def __init__(
+        self,
+        max_jobs=DEFAULT_PROCESS_JOBS,
+        timeout=DEFAULT_JOB_TIMEOUT,
+        output_limit=DEFAULT_JOB_OUTPUT_LIMIT,
+        kill_timeout=DEFAULT_JOB_KILL_TIMEOUT,
+        priority=None,
+    ):
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.output_limit = output_limit
+        self.kill_timeout = kill_timeout
+        self.priority = priority
+        self.processes = set()
+        self._slots = None
+        self._slots_loop = None
+
+    def _job_slots(self):
+        if not self.max_jobs:
+            return _no_slot()
+        # A semaphore is bound to the event loop that it is first used in
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_jobs)
+            self._slots_loop = loop
+        return self._slots
+
+    async def _read(self, stream, buffer, on_output=None):
+        pending = bytearray()
+        while True:
+            chunk = await stream.read(64 * 1024)
+            if not chunk:
+                break
+            buffer.write(chunk)
+            if not on_output:
+                continue
+            pending.extend(chunk)
+            *segments, rest = OUTPUT_SEGMENT_SEPARATOR.split(pending)
+            pending = bytearray(rest[-self.output_limit :])
+            for segment in segments:
+                if segment:
+                    on_output(segment.decode("utf-8", errors="replace"))
+        if on_output and pending:
+            on_output(pending.decode("utf-8", errors="replace"))
+
+    async def terminate(self, process):
+        """Terminates the process group of process, which is killed if the
+        command has not exited within kill_timeout seconds. The processes of
+        the group that outlive the command, e.g. its children that ignore
+        SIGTERM, are killed as well."""
+        if process.returncode is None:
+            _signal_group(process, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(process.wait(), self.kill_timeout)
+            except asyncio.TimeoutError:
+                pass
+        _signal_group(process, signal.SIGKILL)
+        await process.wait()
+
+    async def terminate_all(self):
+        await asyncio.gather(
+            *[self.terminate(process) for process in list(self.processes)]
+        )
+
+    async def run(self, cmd, timeout=None, on_output=None):
+        """Runs cmd and returns its command, returncode, output, error and
+        whether it timed_out. Only the last output_limit bytes of stdout and
+        stderr are kept, and on_output is called with each line of stdout
+        while the command is running. If the command runs for longer than
+        timeout, or the runner timeout if it is None, it is terminated.
+        If the calling task is cancelled, the command is terminated before
+        the cancellation is propagated."""
+        if timeout is None:
+            timeout = self.timeout
+        async with self._job_slots():
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True,
+            )
+            self.processes.add(process)
+            if self.priority:
+                # The command is in its own process group, which covers
+                # the threads and children that it has started so far,
+                # while those that it starts later inherit the priority
+                self.priority.apply(process.pid, group=True)
+            output = OutputBuffer(self.output_limit)
+            error = OutputBuffer(self.output_limit)
+
+            async def communicate():
+                await asyncio.gather(
+                    self._read(process.stdout, output, on_output=on_output),
+                    self._read(process.stderr, error),
+                )
+                await process.wait()
+
+            timed_out = False
+            try:
+                await asyncio.wait_for(communicate(), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                await self.terminate(process)
+            except asyncio.CancelledError:
+                await self.terminate(process)
+                raise
+            finally:
+                self.processes.discard(process)
+
+        result = subprocess.CompletedProcess(
+            cmd, process.returncode, stdout=output.getvalue(), stderr=error.getvalue()
+        )
+        if timed_out:
+            result.stderr = (
+                "{}\n".format(
+                    JOB_TIMEOUT_ERROR_MSG.format(" ".join(cmd), timeout)
+                ).encode("utf-8")
+                + result.stderr
+            )
+        command_results = __format_output__(result)
+        command_results["timed_out"] = timed_out
+        command_results["output_truncated"] = output.dropped
+        command_results["error_truncated"] = error.dropped
+        return command_results
+
+
+def _signal_group(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+@contextlib.asynccontextmanager
+async def _no_slot():
+    yield
+
+
+# The runner of the external commands of the builds in this process
+job_runner = JobRunner()
+# Set once the builds in this process are cancelled by a signal. A task that
+# is cancelled can't stop the function that it runs in an executor thread,
+# so the download and decompression loops check this between their chunks
+cancel_event = threading.Event()
+# The threads that the hashing of the builds in this process runs in if
+# a job priority is set, see run_in_worker
+_worker_executor = None
+
+
+def set_job_limits(max_jobs=DEFAULT_PROCESS_JOBS, timeout=DEFAULT_JOB_TIMEOUT):
+    """Sets the maximum number of concurrent commands and the default
+    timeout of each command of the builds in this process."""
+    job_runner.max_jobs = max_jobs
+    job_runner.timeout = timeout
+    job_runner._slots = None
+
+
+def set_job_priority(priority):
+    """Sets the ProcessPriority that the external commands and the hashing
+    workers of the builds in this process run with, or removes it if it is
+    None. Since an unprivileged thread can't raise its priority again, the
+    hashing runs in dedicated worker threads that are given the priority
+    when they start, instead of in the shared default executor."""
+    global _worker_executor
+    job_runner.priority = priority
+    if _worker_executor is not None:
+        _worker_executor.shutdown(wait=False)
+        _worker_executor = None
+    if priority:
+        _worker_executor = ThreadPoolExecutor(
+            thread_name_prefix="gen-vm-image-worker", initializer=priority.apply
+        )
+
+
+def priority_verbose_outputs():
+    """Returns the verbose messages of the job priority and of the
+    settings that the last command or worker effectively ran with."""
+    priority = job_runner.priority
+    if not priority:
+        return []
+    outputs = [
+        "Running the external commands and hashing workers with the "
+        "priority: {}".format(priority.settings())
+    ]
+    if priority.effective:
+        outputs.append(
+            "The effective priority of the last command or worker: {}".format(
+                priority.effective
+            )
+        )
+    return outputs
+
+
+async def run_async(cmd, format_output_str=False, timeout=None, runner=None):
+    """Runs cmd with runner, by default the job_runner, where the output
+    and error of the command are bytes."""
+    if not runner:
+        runner = job_runner
+    result = await runner.run(cmd, timeout=timeout)
+    if format_output_str:
+        result["returncode"] = str(result["returncode"])
+    return result
+
+
+async def run_until_signalled(coroutine, signals=(signal.SIGINT, signal.SIGTERM)):
+    """Runs coroutine until it completes or one of signals is received. On
+    a signal the coroutine is cancelled, which terminates its commands and
+    removes its partial outputs, and the JOB_CANCELLED_ERROR is returned.
+    The cancel_event is set as well, such that the downloads and
+    decompressions that run in executor threads stop and remove their
+    partial files instead of running on until the process exits."""
+    loop = asyncio.get_running_loop()
+    cancel_event.clear()
+    task = asyncio.ensure_future(coroutine)
+    received = []
+
+    def on_signal(signum):
+        received.append(signum)
+        cancel_event.set()
+        task.cancel()
+
+    for signum in signals:
+        loop.add_signal_handler(signum, on_signal, signum)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if not received:
+            raise
+        await job_runner.terminate_all()
+        return JOB_CANCELLED_ERROR, {
+            "msg": JOB_CANCELLED_ERROR_MSG,
+            "signal": signal.Signals(received[0]).name,
+        }
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+
+
+async def run_streaming_async(
+    cmd, on_output, format_output_str=False, timeout=None, runner=None
+):
+    """Runs cmd with runner, by default the job_runner, such that it is
+    bounded by its limits, and passes each line of its stdout to on_output
+    while it is running, instead of only once it has finished."""
+    if not runner:
+        runner = job_runner
+    result = await runner.run(cmd, timeout=timeout, on_output=on_output)
+    for key in ("output", "error"):
+        result[key] = result[key].decode("utf-8", errors="replace")
+    if format_output_str:
+        result["returncode"] = str(result["returncode"])
+    return result
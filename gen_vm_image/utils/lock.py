@@ -0,0 +1,128 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import fcntl
+import os
+import time
+
+from gen_vm_image.common.defaults import DEFAULT_LOCK_POLL_INTERVAL, LOCK_SUFFIX
+
+
+def lock_path(path):
+    """Returns the path of the hidden lock file next to path."""
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, ".{}{}".format(filename, LOCK_SUFFIX))
+
+
+class FileLock:
+    """An exclusive lock of path that is shared between processes, such as
+    concurrent builds that use the same temporary or output directory.
+
+    The lock is an flock of a hidden lock file next to path, which the
+    kernel releases as soon as the holding process exits, so a lock is
+    never left stale by a process that crashed or was killed. The lock
+    file is not inherited by subprocesses, and it is never removed since
+    another process may be waiting on it. Separate FileLock instances
+    of the same path also exclude each other within a single process."""
+
+    def __init__(self, path, poll_interval=DEFAULT_LOCK_POLL_INTERVAL):
+        self.path = path
+        self.lock_path = lock_path(path)
+        self.poll_interval = poll_interval
+        # Whether the lock was held by someone else when it was acquired
+        self.waited = False
+        self._fh = None
+
+    @property
+    def locked(self):
+        return self._fh is not None
+
+    def holder(self):
+        """Returns the pid of the process that last acquired the lock,
+        or None if it is unknown."""
+        try:
+            with open(self.lock_path, "r") as fh:
+                return int(fh.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def try_acquire(self):
+        """Acquires the lock without waiting, returns whether it was acquired."""
+        if self._fh is not None:
+            return True
+        directory = os.path.dirname(self.lock_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        fh = open(self.lock_path, "a+")
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fh.close()
+            self.waited = True
+            return False
+        except Exception:
+            fh.close()
+            raise
+        fh.seek(0)
+        fh.truncate()
+        fh.write(str(os.getpid()))
+        fh.flush()
+        self._fh = fh
+        return True
+
+    def acquire(self, timeout=None):
+        """Waits for the lock, or until timeout seconds have passed.
+        Returns whether the lock was acquired."""
+        started = time.monotonic()
+        while not self.try_acquire():
+            if timeout is not None and time.monotonic() - started >= timeout:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    async def acquire_async(self, timeout=None):
+        """Waits for the lock without blocking the event loop, such that
+        the other builds of the process progress in the meantime."""
+        started = time.monotonic()
+        while not self.try_acquire():
+            if timeout is not None and time.monotonic() - started >= timeout:
+                return False
+            await asyncio.sleep(self.poll_interval)
+        return True
+
+    def release(self):
+        if self._fh is None:
+            return
+        try:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,411 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+from urllib.parse import unquote, urlsplit
+
+from gen_vm_image.common.defaults import (
+    CHECKSUM_MANIFEST_DIR,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_DIGEST_WORKERS,
+    DEFAULT_OUTPUT_MANIFEST_FILE,
+    SCHEDULER_HASH,
+    TMP_DIR,
+)
+from gen_vm_image.utils.cache import (
+    new_cache_metadata,
+    revalidate_cache,
+    save_cache_metadata,
+)
+from gen_vm_image.utils.digests import DigestIndex
+from gen_vm_image.utils.io import (
+    exists,
+    hashsums,
+    load,
+    makedirs,
+    remove,
+    write_atomic,
+)
+from gen_vm_image.utils.job import run_in_worker
+from gen_vm_image.utils.lock import FileLock
+from gen_vm_image.utils.net import download_file
+from gen_vm_image.utils.progress import stage, stage_callback
+from gen_vm_image.utils.scheduler import scheduled
+
+# GNU coreutils format, e.g. 'd41d8cd9...  image.qcow2' or 'd41d8cd9... *image.qcow2'
+GNU_CHECKSUM_LINE = re.compile(r"^(?P<digest>[0-9a-fA-F]+) [ *](?P<filename>.+)$")
+# BSD format, e.g. 'SHA256 (image.qcow2) = e3b0c442...'
+BSD_CHECKSUM_LINE = re.compile(
+    r"^(?P<algorithm>[A-Za-z0-9_-]+) ?"
+    r"\((?P<filename>.+)\) ?= ?"
+    r"(?P<digest>[0-9a-fA-F]+)$"
+)
+
+
+def normalize_algorithm(algorithm):
+    """Returns the hashlib name of a checksum algorithm name,
+    e.g. 'SHA256' and 'SHA-256' are both 'sha256'."""
+    algorithm = algorithm.lower()
+    if algorithm.startswith("sha3"):
+        return algorithm.replace("-", "_")
+    return algorithm.replace("-", "")
+
+
+def url_filename(url):
+    """Returns the filename that the url refers to."""
+    return os.path.basename(unquote(urlsplit(url).path))
+
+
+def parse_checksum_manifest(content):
+    """Parses a checksum manifest in either the GNU or BSD format, and
+    returns a dictionary of the filenames and their digests by algorithm.
+    The algorithm of a GNU formatted digest is unknown and kept as None.
+    Other lines, such as comments or signatures, are ignored."""
+    entries = {}
+    for line in content.splitlines():
+        line = line.strip()
+        match = BSD_CHECKSUM_LINE.match(line)
+        if match:
+            algorithm = normalize_algorithm(match.group("algorithm"))
+        else:
+            match = GNU_CHECKSUM_LINE.match(line)
+            if not match:
+                continue
+            algorithm = None
+        filename = os.path.basename(match.group("filename").strip())
+        entries.setdefault(filename, {})[algorithm] = match.group("digest").lower()
+    return entries
+
+
+def manifest_checksum(entries, filename, algorithm):
+    """Returns the digest of filename with algorithm in the parsed manifest
+    entries, or None if the manifest does not contain it."""
+    digests = entries.get(filename, {})
+    algorithm = normalize_algorithm(algorithm)
+    if algorithm in digests:
+        return digests[algorithm]
+    digest = digests.get(None, None)
+    try:
+        digest_length = hashlib.new(algorithm).digest_size * 2
+    except ValueError:
+        return None
+    # A GNU formatted digest is only used if it has the length of the algorithm
+    if digest and len(digest) == digest_length:
+        return digest
+    return None
+
+
+def checksum_manifest_path(url):
+    """Returns the path that the manifest at url is cached at."""
+    url_id = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(
+        TMP_DIR,
+        CHECKSUM_MANIFEST_DIR,
+        "{}-{}".format(url_id, url_filename(url) or "manifest"),
+    )
+
+
+async def fetch_checksum_manifest(url, session=None, ttl=DEFAULT_CACHE_TTL):
+    """Returns the parsed checksum manifest at url. The manifest is cached
+    and revalidated in the same way as the downloaded input images."""
+    response = {}
+    manifest_path = checksum_manifest_path(url)
+    manifest_directory = os.path.dirname(manifest_path)
+    if not exists(manifest_directory) and not makedirs(manifest_directory):
+        response["msg"] = "Failed to create the manifest directory: {}".format(
+            manifest_directory
+        )
+        return False, response
+
+    async with FileLock(manifest_path):
+        cached = False
+        if exists(manifest_path):
+            cached, cache_response = await revalidate_cache(
+                [url], manifest_path, session=session, ttl=ttl
+            )
+            response["cache_status"] = cache_response["cache_status"]
+        if not cached:
+            downloaded, download_response = await download_file(
+                url, manifest_path, session=session
+            )
+            if not downloaded:
+                response["msg"] = download_response["msg"]
+                return False, response
+            save_cache_metadata(
+                manifest_path, new_cache_metadata(manifest_path, download_response)
+            )
+
+    content = load(manifest_path)
+    if content is False:
+        response["msg"] = "Failed to read the manifest: {}".format(manifest_path)
+        return False, response
+    response["entries"] = parse_checksum_manifest(content)
+    return True, response
+
+
+class ChecksumManifests:
+    """The checksum manifests of a build. Each manifest is fetched and
+    parsed once, even if several images of the build refer to it."""
+
+    def __init__(self):
+        self._manifests = {}
+        self._locks = {}
+
+    async def get(self, url, session=None, ttl=DEFAULT_CACHE_TTL):
+        """Returns (fetched, response) where the response contains the
+        'entries' of the parsed manifest at url."""
+        lock = self._locks.setdefault(url, asyncio.Lock())
+        async with lock:
+            if url not in self._manifests:
+                self._manifests[url] = await fetch_checksum_manifest(
+                    url, session=session, ttl=ttl
+                )
+        return self._manifests[url]
+
+    async def checksum(
+        self, url, filename, algorithm, session=None, ttl=DEFAULT_CACHE_TTL
+    ):
+        """Returns (found, response) where the response contains the
+        'checksum' of filename in the manifest at url."""
+        fetched, manifest_response = await self.get(url, session=session, ttl=ttl)
+        if not fetched:
+            return False, {"msg": manifest_response["msg"]}
+        checksum = manifest_checksum(manifest_response["entries"], filename, algorithm)
+        if not checksum:
+            return False, {
+                "msg": "No {} checksum of: {} in the manifest".format(
+                    algorithm, filename
+                )
+            }
+        return True, {"checksum": checksum}
+
+
+def checksum_manifest_filename(algorithm):
+    """Returns the conventional filename of a manifest of algorithm
+    checksums, e.g. SHA256SUMS."""
+    return "{}SUMS".format(normalize_algorithm(algorithm).upper())
+
+
+def format_checksum_manifest(entries, algorithm):
+    """Returns the GNU formatted manifest of the algorithm checksums of the
+    entries, where entries is a dictionary of filenames and their
+    'checksums' by algorithm."""
+    lines = []
+    for filename in sorted(entries):
+        checksum = entries[filename]["checksums"].get(algorithm, None)
+        if checksum:
+            lines.append("{}  {}\n".format(checksum, filename))
+    return "".join(lines)
+
+
+def write_checksum_manifests(output_directory, entries, algorithms):
+    """Writes the JSON manifest of the entries, which is a dictionary of
+    filenames and their 'size', 'mtime_ns' and 'checksums', along with a
+    GNU formatted manifest for each of the algorithms to output_directory.
+    Returns (written, response) where the response contains the paths of
+    the written 'manifests' and of those that failed as 'errors'."""
+    response = {"manifests": [], "errors": []}
+    manifest_paths = {
+        os.path.join(output_directory, DEFAULT_OUTPUT_MANIFEST_FILE): json.dumps(
+            {"images": entries}, indent=4, sort_keys=True
+        )
+    }
+    for algorithm in algorithms:
+        manifest_path = os.path.join(
+            output_directory, checksum_manifest_filename(algorithm)
+        )
+        manifest_paths[manifest_path] = format_checksum_manifest(entries, algorithm)
+    for manifest_path, content in manifest_paths.items():
+        if write_atomic(manifest_path, content):
+            response["manifests"].append(manifest_path)
+        else:
+            response["errors"].append(manifest_path)
+    return not response["errors"], response
+
+
+def _unchanged_entry(entry, stat):
+    return [entry.get("size", None), entry.get("mtime_ns", None)] == [
+        stat.st_size,
+        stat.st_mtime_ns,
+    ]
+
+
+class OutputManifest:
+    """The checksums of the images that are generated in output_directory.
+    The checksums of each image are calculated in the background as soon
+    as it is added, while the image is still in the page cache, by up to
+    workers images at a time, and within the hash slots of the scheduler
+    if there is one. The manifests are written once every image
+    is added, where the entries of images that were generated earlier are
+    kept as long as the images are unchanged."""
+
+    def __init__(
+        self,
+        output_directory,
+        algorithms,
+        workers=DEFAULT_DIGEST_WORKERS,
+        scheduler=None,
+    ):
+        self.output_directory = output_directory
+        self.algorithms = list(dict.fromkeys(algorithms))
+        self.digest_index = DigestIndex()
+        self.scheduler = scheduler
+        self._semaphore = asyncio.Semaphore(workers)
+        self._tasks = {}
+        # The entries of the images that are unchanged since the last build
+        self._entries = self._load_entries()
+
+    @property
+    def json_path(self):
+        return os.path.join(self.output_directory, DEFAULT_OUTPUT_MANIFEST_FILE)
+
+    def add(self, path, progress=None):
+        """Starts to calculate the checksums of the image at path."""
+        filename = os.path.basename(path)
+        if filename not in self._tasks:
+            self._tasks[filename] = asyncio.ensure_future(
+                self._checksums(path, progress=progress)
+            )
+
+    async def _checksums(self, path, progress=None):
+        # An image that is not rebuilt keeps its checksums from the last build
+        entry = self._entries.get(os.path.basename(path), None)
+        try:
+            unchanged = entry and _unchanged_entry(entry, os.stat(path))
+        except OSError:
+            unchanged = False
+        if unchanged and all(
+            algorithm in entry["checksums"] for algorithm in self.algorithms
+        ):
+            return path, {
+                algorithm: entry["checksums"][algorithm]
+                for algorithm in self.algorithms
+            }
+
+        async with self._semaphore, scheduled(self.scheduler, SCHEDULER_HASH):
+            with stage(progress, "digest", algorithms=self.algorithms) as outcome:
+                checksums = await hashsums(
+                    path,
+                    self.algorithms,
+                    on_progress=stage_callback(progress, "digest"),
+                    digest_index=self.digest_index,
+                )
+                outcome["success"] = bool(checksums)
+        return path, checksums
+
+    def _load_manifest(self):
+        """Returns every entry of the existing manifest."""
+        try:
+            with open(self.json_path, "r") as fh:
+                manifest = json.load(fh)
+            return dict(manifest["images"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def _load_entries(self):
+        """Returns the entries of the existing manifest of the images that
+        are unchanged since they were added to it."""
+        unchanged = {}
+        for filename, entry in self._load_manifest().items():
+            try:
+                stat = os.stat(os.path.join(self.output_directory, filename))
+            except OSError:
+                continue
+            if (
+                isinstance(entry, dict)
+                and isinstance(entry.get("checksums", None), dict)
+                and _unchanged_entry(entry, stat)
+            ):
+                unchanged[filename] = entry
+        return unchanged
+
+    async def write(self):
+        """Waits for the checksums of the added images and writes the JSON
+        manifest along with a GNU formatted manifest for each algorithm.
+        Returns (written, response) where the response contains the
+        'output_checksums' of each added image."""
+        response = {"output_checksums": {}, "manifests": []}
+        results = await asyncio.gather(*self._tasks.values())
+        # Concurrent builds into the same output directory update the
+        # manifests one at a time, such that no entries are lost
+        async with FileLock(self.json_path):
+            manifest_filenames = {
+                checksum_manifest_filename(algorithm)
+                for entry in self._load_manifest().values()
+                if isinstance(entry, dict)
+                and isinstance(entry.get("checksums", None), dict)
+                for algorithm in entry["checksums"]
+                if isinstance(algorithm, str)
+            }
+            # Images may have been rebuilt or removed since the build started
+            entries = self._load_entries()
+            errors = []
+            for path, checksums in results:
+                filename = os.path.basename(path)
+                if not checksums:
+                    errors.append(path)
+                    entries.pop(filename, None)
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # The image was removed after it was hashed
+                    errors.append(path)
+                    entries.pop(filename, None)
+                    continue
+                entry_checksums = {}
+                if filename in entries and _unchanged_entry(entries[filename], stat):
+                    entry_checksums.update(entries[filename].get("checksums", {}))
+                entry_checksums.update(checksums)
+                entries[filename] = {
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "checksums": entry_checksums,
+                }
+                response["output_checksums"][filename] = checksums
+
+            # The digest index is only an optimization for later builds
+            await run_in_worker(self.digest_index.save)
+
+            written, written_response = write_checksum_manifests(
+                self.output_directory, entries, self.algorithms
+            )
+            response["manifests"] = written_response["manifests"]
+            if not written:
+                errors.extend(written_response["errors"])
+
+            # The manifests of the algorithms that were written by earlier
+            # builds, but not by this one, would list the outdated checksums
+            # of the images that have been rebuilt since, so they are removed
+            for manifest_filename in sorted(
+                manifest_filenames
+                - {
+                    checksum_manifest_filename(algorithm)
+                    for algorithm in self.algorithms
+                }
+            ):
+                manifest_path = os.path.join(self.output_directory, manifest_filename)
+                if exists(manifest_path) and not remove(manifest_path):
+                    errors.append(manifest_path)
+
+        if errors:
+            response["msg"] = "Failed to write the checksums of: {}".format(errors)
+            return False, response
+        return True, response
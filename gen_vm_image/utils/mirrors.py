@@ -0,0 +1,269 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from gen_vm_image.common.defaults import (
+    DEFAULT_MIRROR_PROBE_TIMEOUT,
+    DEFAULT_MIRROR_STATS_FILE,
+    MIRROR_STATS_WEIGHT,
+    TMP_DIR,
+)
+from gen_vm_image.utils.job import cancel_event, run_in_thread
+from gen_vm_image.utils.net import _download_file
+
+
+def mirror_key(url):
+    """Returns the key that the statistics of the mirror of url are kept under."""
+    split_url = urlsplit(url)
+    return "{}://{}".format(split_url.scheme, split_url.netloc)
+
+
+class MirrorStats:
+    """Keeps the moving average of the latency and throughput of each mirror
+    in a JSON file, such that later builds can prefer the faster mirrors."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(TMP_DIR, DEFAULT_MIRROR_STATS_FILE)
+        self._lock = threading.Lock()
+        self.mirrors = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as fh:
+                mirrors = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(mirrors, dict):
+            return {}
+        return mirrors
+
+    def get(self, url):
+        with self._lock:
+            return dict(self.mirrors.get(mirror_key(url), {}))
+
+    def _average(self, stats, key, value):
+        if stats.get(key, None) is None:
+            stats[key] = value
+        else:
+            stats[key] = (
+                MIRROR_STATS_WEIGHT * value + (1 - MIRROR_STATS_WEIGHT) * stats[key]
+            )
+
+    def record(self, url, latency=None, received=None, duration=None, failed=False):
+        with self._lock:
+            stats = self.mirrors.setdefault(mirror_key(url), {})
+            if latency is not None:
+                self._average(stats, "latency", latency)
+            if received and duration:
+                self._average(stats, "throughput", received / duration)
+            counter = "failures" if failed else "successes"
+            stats[counter] = stats.get(counter, 0) + 1
+            stats["updated"] = time.time()
+
+    def save(self):
+        with self._lock:
+            content = json.dumps(self.mirrors, indent=4, sort_keys=True)
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            # Write atomically such that concurrent builds never read a partial file
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp_path, "w") as fh:
+                fh.write(content)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # The statistics are only an optimization
+            return False
+        return True
+
+
+def probe_mirror(url, session=None, timeout=DEFAULT_MIRROR_PROBE_TIMEOUT):
+    """Returns the (latency, size) of the mirror, where the latency is the
+    number of seconds until the first response byte, or None if the mirror
+    is unreachable. Mirrors that reject HEAD requests are probed with a
+    GET request for the first byte instead."""
+    requester = session or requests
+    started = time.monotonic()
+    try:
+        r = requester.head(url, allow_redirects=True, timeout=timeout)
+        r.close()
+        if r.status_code in (403, 405, 501):
+            r = requester.get(
+                url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout
+            )
+            r.close()
+        r.raise_for_status()
+    except requests.RequestException:
+        return None, None
+    latency = time.monotonic() - started
+
+    size = None
+    if r.status_code == 206:
+        total = r.headers.get("content-range", "").rsplit("/", 1)[-1]
+        if total.isdigit():
+            size = int(total)
+    elif r.headers.get("content-length", "").isdigit():
+        size = int(r.headers["content-length"])
+    return latency, size
+
+
+async def probe_mirrors(urls, session=None, timeout=DEFAULT_MIRROR_PROBE_TIMEOUT):
+    """Probes every mirror concurrently and returns their (latency, size)."""
+    return await asyncio.gather(
+        *[
+            run_in_thread(probe_mirror, url, session=session, timeout=timeout)
+            for url in urls
+        ]
+    )
+
+
+def rank_mirrors(urls, probes, stats=None):
+    """Returns the urls ordered by the expected download time. The time
+    is estimated from the measured throughput of earlier downloads if it is
+    known, otherwise the probed latency is used. Unreachable mirrors are
+    ordered last such that they are still tried as a last resort."""
+
+    def sort_key(indexed_url):
+        index, url = indexed_url
+        latency, size = probes[index]
+        if latency is None:
+            return (1, float("inf"), index)
+        throughput = (stats.get(url) if stats else {}).get("throughput", None)
+        if size and throughput:
+            return (0, latency + size / throughput, index)
+        return (0, latency, index)
+
+    return [url for _, url in sorted(enumerate(urls), key=sort_key)]
+
+
+def _download_from_mirrors(
+    urls,
+    output_path,
+    probes,
+    session=None,
+    on_progress=None,
+    stats=None,
+    bandwidth_limit=None,
+    shared_bandwidth=None,
+    cancel_event=None,
+):
+    """Downloads output_path from the ranked mirrors. If a mirror fails,
+    the download continues from the next mirror with a Range request, such
+    that the bytes that were already received are reused. No other mirror
+    is tried once the cancel_event is set."""
+    response = {"download_mirrors": []}
+    sizes = {size for _, size in probes if size is not None}
+    # Only resume across mirrors if they agree on the size of the file
+    expected_size = sizes.pop() if len(sizes) == 1 else None
+    partial_path = "{}.partial".format(output_path)
+    errors = []
+    # The download is retried if any of the mirrors failed transiently
+    retryable, retry_after = False, None
+    for url in rank_mirrors(urls, probes, stats=stats):
+        started = time.monotonic()
+        downloaded, download_response = _download_file(
+            url,
+            output_path,
+            on_progress=on_progress,
+            session=session,
+            resume=expected_size is not None,
+            keep_partial=expected_size is not None,
+            expected_size=expected_size,
+            bandwidth_limit=bandwidth_limit,
+            shared_bandwidth=shared_bandwidth,
+            cancel_event=cancel_event,
+        )
+        duration = time.monotonic() - started
+        response["download_mirrors"].append(url)
+        if stats:
+            offset = download_response.get("download_resumed_from", 0)
+            if downloaded:
+                received = download_response["download_size"] - offset
+            elif os.path.exists(partial_path):
+                received = max(os.path.getsize(partial_path) - offset, 0)
+            else:
+                received = 0
+            stats.record(
+                url, received=received, duration=duration, failed=not downloaded
+            )
+        if downloaded:
+            response.update(download_response)
+            return True, response
+        errors.append("{}: {}".format(url, download_response["msg"]))
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        if download_response.get("retryable", False):
+            retryable = True
+            if download_response.get("retry_after", None) is not None:
+                retry_after = max(retry_after or 0, download_response["retry_after"])
+
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    response["msg"] = "Failed to download from every mirror: {}".format(errors)
+    response["retryable"], response["retry_after"] = retryable, retry_after
+    return False, response
+
+
+async def download_from_mirrors(
+    urls,
+    output_path,
+    session=None,
+    on_progress=None,
+    stats=None,
+    probe_timeout=DEFAULT_MIRROR_PROBE_TIMEOUT,
+    bandwidth_limit=None,
+    shared_bandwidth=None,
+):
+    """Probes the mirrors concurrently and downloads output_path from the
+    fastest one, failing over to the next mirrors if it fails. The latency
+    and throughput of each mirror are recorded in stats if it is given.
+    The download is throttled to bandwidth_limit and shared_bandwidth."""
+    probes = await probe_mirrors(urls, session=session, timeout=probe_timeout)
+    if stats:
+        for url, (latency, _) in zip(urls, probes):
+            if latency is not None:
+                stats.record(url, latency=latency)
+            else:
+                stats.record(url, failed=True)
+    try:
+        downloaded, response = await run_in_thread(
+            _download_from_mirrors,
+            urls,
+            output_path,
+            probes,
+            session=session,
+            on_progress=on_progress,
+            stats=stats,
+            bandwidth_limit=bandwidth_limit,
+            shared_bandwidth=shared_bandwidth,
+            cancel_event=cancel_event,
+        )
+    finally:
+        if stats:
+            stats.save()
+    response["download_probes"] = {
+        url: latency for url, (latency, _) in zip(urls, probes)
+    }
+    return downloaded, response
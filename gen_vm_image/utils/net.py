@@ -14,34 +14,305 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import errno
+import os
 import time
+from contextlib import contextmanager
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from gen_vm_image.common.defaults import (
+    DEFAULT_DOWNLOAD_MAX_READ_SIZE,
+    DEFAULT_DOWNLOAD_MIN_READ_SIZE,
+    DEFAULT_DOWNLOAD_PROGRESS_INTERVAL,
+    DEFAULT_DOWNLOAD_READ_DURATION,
+    DEFAULT_HTTP_POOL_SIZE,
+)
+from gen_vm_image.utils.job import (
+    JobCancelledError,
+    cancel_event,
+    check_cancelled,
+    run_in_thread,
+)
+from gen_vm_image.utils.retry import TransientError, retryable_error
+from gen_vm_image.utils.throttle import download_buckets, throttle
 
-async def download_file(url, output_path, chunk_size=8192):
-    response = {}
+
+def new_session(pool_size=DEFAULT_HTTP_POOL_SIZE, proxy=None, ca_bundle=None):
+    """Returns a requests session that keeps up to pool_size connections
+    alive per host, such that downloads from the same mirror reuse the
+    established connections instead of paying for a new DNS lookup and
+    TCP/TLS handshake each time. The proxy is used for both http and https,
+    and ca_bundle is the path to the CA certificates to verify with."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if proxy:
+        session.proxies.update({"http": proxy, "https": proxy})
+    if ca_bundle:
+        session.verify = ca_bundle
+    return session
+
+
+@contextmanager
+def http_session(
+    session=None, pool_size=DEFAULT_HTTP_POOL_SIZE, proxy=None, ca_bundle=None
+):
+    """Yields the given session, or a new session that is closed afterwards."""
+    if session is not None:
+        yield session
+        return
+    session = new_session(pool_size=pool_size, proxy=proxy, ca_bundle=ca_bundle)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _content_length(http_response):
+    """Returns the number of bytes that the body will contain,
+    or None if it is unknown, e.g. with chunked or encoded bodies."""
+    if http_response.headers.get("content-encoding", "identity") != "identity":
+        # The Content-Length is the size of the encoded body
+        return None
+    try:
+        length = int(http_response.headers.get("content-length", ""))
+    except ValueError:
+        return None
+    if length < 0:
+        return None
+    return length
+
+
+def _body_reader(http_response):
+    """Returns the object with the most direct readinto for the body.
+    If the body is not content-encoded, the underlying http.client response
+    is read directly, since it reads straight into the given buffer and also
+    handles the chunked transfer encoding itself."""
+    raw = http_response.raw
+    if http_response.headers.get("content-encoding", "identity") == "identity":
+        fp = getattr(raw, "_fp", None)
+        if fp is not None and hasattr(fp, "readinto"):
+            return fp
+    raw.decode_content = True
+    return raw
+
+
+def _preallocate(fh, length):
+    """Reserves length bytes for the file such that the download is not
+    fragmented and fails early if the filesystem is out of space."""
+    if not length or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fh.fileno(), 0, length)
+    except OSError as err:
+        # Not every filesystem supports it, in which case
+        # the file grows as it is written instead
+        if err.errno == errno.ENOSPC:
+            raise
+        return False
+    return True
+
+
+def _content_range(http_response):
+    """Returns the (start, total) of a partial response, where the total
+    is None if the server does not know it."""
+    content_range = http_response.headers.get("content-range", "")
+    try:
+        unit, byte_range = content_range.split(" ", 1)
+        span, total = byte_range.split("/", 1)
+        start = int(span.split("-", 1)[0])
+    except ValueError:
+        raise IOError("Invalid Content-Range: '{}'".format(content_range))
+    if unit != "bytes":
+        raise IOError("Unsupported Content-Range unit: '{}'".format(unit))
+    return start, (None if total == "*" else int(total))
+
+
+def _read_body(
+    reader,
+    fh,
+    on_progress=None,
+    offset=0,
+    total=None,
+    min_read_size=DEFAULT_DOWNLOAD_MIN_READ_SIZE,
+    max_read_size=DEFAULT_DOWNLOAD_MAX_READ_SIZE,
+    read_duration=DEFAULT_DOWNLOAD_READ_DURATION,
+    progress_interval=DEFAULT_DOWNLOAD_PROGRESS_INTERVAL,
+    buckets=None,
+    cancel_event=None,
+):
+    """Reads the body into fh with a single reusable buffer. The read size is
+    doubled while reads complete faster than read_duration and halved when
+    they are slower, which keeps the per-read overhead low on fast links
+    without stalling the progress updates on slow ones. The progress
+    includes the offset of bytes that were already downloaded before.
+
+    If buckets are given, the reads are throttled by the token buckets and
+    are at most the chunk_size of the buckets, such that the download
+    never bursts far above its bandwidth limit.
+
+    If the cancel_event is set, the download is stopped before the
+    next read with a JobCancelledError."""
+    if buckets:
+        chunk_size = min(bucket.chunk_size for bucket in buckets)
+        max_read_size = min(max_read_size, chunk_size)
+        min_read_size = min(min_read_size, max_read_size)
+    buffer = bytearray(max_read_size)
+    view = memoryview(buffer)
+    read_size = min(max(min_read_size, 1), max_read_size)
+    downloaded = 0
+    clock = time.monotonic
+    last_progress = clock()
+    while True:
+        check_cancelled(cancel_event)
+        started = clock()
+        read = reader.readinto(view[:read_size])
+        if not read:
+            break
+        fh.write(view[:read])
+        downloaded += read
+        if buckets:
+            throttle(buckets, read)
+
+        now = clock()
+        if read == read_size:
+            elapsed = now - started
+            if elapsed < read_duration and read_size < max_read_size:
+                read_size = min(read_size * 2, max_read_size)
+            elif elapsed > read_duration * 2 and read_size > min_read_size:
+                read_size = max(read_size // 2, min_read_size)
+
+        if on_progress and now - last_progress >= progress_interval:
+            last_progress = now
+            on_progress(offset + downloaded, total)
+
+    if on_progress:
+        on_progress(offset + downloaded, total)
+    return downloaded
+
+
+def _download_file(
+    url,
+    output_path,
+    chunk_size=DEFAULT_DOWNLOAD_MIN_READ_SIZE,
+    max_chunk_size=DEFAULT_DOWNLOAD_MAX_READ_SIZE,
+    on_progress=None,
+    progress_interval=DEFAULT_DOWNLOAD_PROGRESS_INTERVAL,
+    session=None,
+    resume=False,
+    keep_partial=False,
+    expected_size=None,
+    bandwidth_limit=None,
+    shared_bandwidth=None,
+    cancel_event=None,
+):
+    """Downloads url to output_path. The download is written to a partial
+    file first, such that an interrupted download is never mistaken for
+    a completed one. If on_progress is set, it is called with the number
+    of bytes downloaded and the total size (or None if it is unknown)
+    at most every progress_interval seconds. The download uses the
+    connection pool of session if it is given.
+
+    If resume is set, an existing partial file is continued with a Range
+    request, and if keep_partial is set, the partial file is kept when the
+    download fails such that it can be resumed later on, possibly from
+    another mirror of the same file with the expected_size.
+
+    The download is throttled to bandwidth_limit, e.g. '10M' bytes per
+    second, and to the share that it gets of the shared_bandwidth
+    TokenBucket of the build. If the cancel_event is set, the download is
+    stopped and its partial file is removed, even if keep_partial is set."""
+    response = {"download_src": url, "download_destination": output_path}
+    partial_output_path = "{}.partial".format(output_path)
+    offset = 0
+    if resume and os.path.exists(partial_output_path):
+        offset = os.path.getsize(partial_output_path)
+    headers = {"Range": "bytes={}-".format(offset)} if offset else {}
     try:
-        with open(output_path, "wb") as _file:
-            response["download_destination"] = output_path
-            with requests.get(url, stream=True) as r:
-                response["download_src"] = url
-                r.raise_for_status()
-                total = int(r.headers.get("content-length", 0))
-                downloaded = 0
-                start_time = time.time()
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    downloaded += len(chunk)
-                    percentage_progress = (downloaded / total) * 100
-                    response["download_progress"] = "{:.2f}%".format(
-                        percentage_progress
+        buckets = download_buckets(bandwidth_limit, shared_bandwidth)
+        with (session or requests).get(url, stream=True, headers=headers) as r:
+            r.raise_for_status()
+            if offset and r.status_code == 206:
+                start, total = _content_range(r)
+                if start != offset:
+                    raise IOError(
+                        "Requested the range from byte {}, but got it from {}".format(
+                            offset, start
+                        )
+                    )
+                mode = "r+b"
+            else:
+                # The server ignored the range, so the download starts over
+                offset = 0
+                total = _content_length(r)
+                mode = "wb"
+            if expected_size is not None and total not in (None, expected_size):
+                raise IOError(
+                    "Expected {} bytes from {}, but it has {} bytes".format(
+                        expected_size, url, total
+                    )
+                )
+            response["download_resumed_from"] = offset
+            # The validators that the cached download can be revalidated with
+            response["download_etag"] = r.headers.get("etag", None)
+            response["download_last_modified"] = r.headers.get("last-modified", None)
+            start_time = time.monotonic()
+            reader = _body_reader(r)
+            with open(partial_output_path, mode) as _file:
+                _file.seek(offset)
+                response["preallocated"] = _preallocate(_file, total)
+                try:
+                    _read_body(
+                        reader,
+                        _file,
+                        on_progress=on_progress,
+                        offset=offset,
+                        total=total,
+                        min_read_size=chunk_size,
+                        max_read_size=max(chunk_size, max_chunk_size),
+                        progress_interval=progress_interval,
+                        buckets=buckets,
+                        cancel_event=cancel_event,
                     )
-                    _file.write(chunk)
-                stop_time = time.time()
-                response["download_time"] = "{:.2f} seconds".format(
-                    stop_time - start_time
+                finally:
+                    # Drop any preallocated space that was not written, such
+                    # that the size of the partial file is the resume offset
+                    downloaded = _file.tell()
+                    _file.truncate(downloaded)
+            if reader is not r.raw and reader.isclosed():
+                # urllib3 only returns the connection to the pool when it has
+                # read the body itself, otherwise it is closed with the response
+                r.raw.release_conn()
+            download_time = time.monotonic() - start_time
+        if total is not None and downloaded != total:
+            raise TransientError(
+                "The download was incomplete, received {} of {} bytes".format(
+                    downloaded, total
                 )
+            )
+        os.replace(partial_output_path, output_path)
     except Exception as e:
+        cancelled = isinstance(e, JobCancelledError)
+        if (cancelled or not keep_partial) and os.path.exists(partial_output_path):
+            os.remove(partial_output_path)
         response["msg"] = str(e)
+        # Whether the download is expected to succeed if it is retried
+        response["retryable"], response["retry_after"] = retryable_error(e)
         return False, response
+
+    response["download_size"] = downloaded
+    response["download_progress"] = "100.00%"
+    response["download_time"] = "{:.2f} seconds".format(download_time)
+    if download_time > 0:
+        response["download_throughput"] = "{:.2f} MiB/s".format(
+            (downloaded - offset) / download_time / (1024 * 1024)
+        )
     return True, response
+
+
+async def download_file(url, output_path, **kwargs):
+    kwargs.setdefault("cancel_event", cancel_event)
+    return await run_in_thread(_download_file, url, output_path, **kwargs)
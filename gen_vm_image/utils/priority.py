@@ -0,0 +1,243 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import ctypes
+import os
+import platform
+
+from gen_vm_image.common.codes import INVALID_ATTRIBUTE_TYPE_ERROR_MSG
+from gen_vm_image.common.defaults import (
+    IO_CLASSES,
+    MAX_IO_PRIORITY,
+    MAX_NICE,
+    MIN_NICE,
+)
+
+# The targets of ioprio_set(2), where a process group covers every thread
+# of every process in the group and a process only covers a single thread
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_WHO_PGRP = 2
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_PRIO_MASK = (1 << IOPRIO_CLASS_SHIFT) - 1
+# The system call numbers of ioprio_set and ioprio_get, which glibc has
+# no wrappers for
+IOPRIO_SYSCALLS = {
+    "x86_64": (251, 252),
+    "i386": (289, 290),
+    "i686": (289, 290),
+    "aarch64": (30, 31),
+    "riscv64": (30, 31),
+    "armv7l": (314, 315),
+    "ppc64le": (273, 274),
+    "s390x": (282, 283),
+}
+
+
+def _syscall(number, *args):
+    """Calls the system call number with the int args, and raises an
+    OSError if it fails."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    result = libc.syscall(number, *[ctypes.c_int(arg) for arg in args])
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+def _ioprio_syscalls():
+    syscalls = IOPRIO_SYSCALLS.get(platform.machine(), None)
+    if not syscalls or not platform.system() == "Linux":
+        raise OSError("ioprio_set is not supported on {}".format(platform.machine()))
+    return syscalls
+
+
+def ioprio_set(which, who, io_class, io_priority=0):
+    """Sets the I/O class and the priority within it of who, as ionice(1)."""
+    value = (io_class << IOPRIO_CLASS_SHIFT) | (io_priority & IOPRIO_PRIO_MASK)
+    return _syscall(_ioprio_syscalls()[0], which, who, value)
+
+
+def ioprio_get(which, who):
+    """Returns the (io_class, io_priority) of who."""
+    value = _syscall(_ioprio_syscalls()[1], which, who)
+    return value >> IOPRIO_CLASS_SHIFT, value & IOPRIO_PRIO_MASK
+
+
+def parse_cpu_list(cpus):
+    """Returns the set of CPUs of a cpu list such as '0-3,6', as taskset(1)
+    accepts, or of a list of CPU numbers. Returns None if it is invalid."""
+    if isinstance(cpus, str):
+        parsed = set()
+        for part in cpus.split(","):
+            start, separator, end = part.strip().partition("-")
+            if not start.isdigit() or (separator and not end.isdigit()):
+                return None
+            if end and int(end) < int(start):
+                return None
+            parsed.update(range(int(start), int(end or start) + 1))
+        return parsed
+    if isinstance(cpus, (list, tuple, set)) and cpus:
+        if all(
+            isinstance(cpu, int) and not isinstance(cpu, bool) and cpu >= 0
+            for cpu in cpus
+        ):
+            return set(cpus)
+    return None
+
+
+class ProcessPriority:
+    """The nice level, the I/O class and priority, and the CPU affinity that
+    the external commands and the hashing workers of the builds run with,
+    such that a build does not starve the other workloads of the host.
+    The io_class is one of the IO_CLASSES, whose io_priority is from 0, the
+    highest, to MAX_IO_PRIORITY. Settings that are None are inherited."""
+
+    def __init__(self, nice=None, io_class=None, io_priority=None, cpu_affinity=None):
+        self.nice = nice
+        self.io_class = io_class
+        self.io_priority = io_priority
+        self.cpu_affinity = set(cpu_affinity) if cpu_affinity is not None else None
+        # The effective settings of the last process that they were applied to
+        self.effective = None
+
+    def __bool__(self):
+        return any(
+            setting is not None
+            for setting in (
+                self.nice,
+                self.io_class,
+                self.io_priority,
+                self.cpu_affinity,
+            )
+        )
+
+    def settings(self):
+        return {
+            "nice": self.nice,
+            "io_class": self.io_class,
+            "io_priority": self.io_priority,
+            "cpu_affinity": sorted(self.cpu_affinity) if self.cpu_affinity else None,
+        }
+
+    def apply(self, pid=0, group=False):
+        """Applies the settings to the process group of pid if group is set,
+        otherwise to the thread pid, where 0 is the calling thread. Settings
+        that can't be applied, e.g. a negative nice level without the
+        privilege to raise the priority, are kept as they are. Returns the
+        effective settings along with the 'errors' of the settings that
+        failed."""
+        errors = []
+        if self.nice is not None:
+            try:
+                os.setpriority(
+                    os.PRIO_PGRP if group else os.PRIO_PROCESS, pid, self.nice
+                )
+            except OSError as err:
+                errors.append("nice: {}".format(err))
+        if self.io_class is not None or self.io_priority is not None:
+            io_class = IO_CLASSES[self.io_class or "best-effort"]
+            try:
+                ioprio_set(
+                    IOPRIO_WHO_PGRP if group else IOPRIO_WHO_PROCESS,
+                    pid,
+                    io_class,
+                    self.io_priority or 0,
+                )
+            except OSError as err:
+                errors.append("io_class: {}".format(err))
+        if self.cpu_affinity is not None:
+            try:
+                for tid in _threads(pid) if group else [pid]:
+                    os.sched_setaffinity(tid, self.cpu_affinity)
+            except OSError as err:
+                errors.append("cpu_affinity: {}".format(err))
+        self.effective = effective_priority(pid)
+        self.effective["errors"] = errors
+        return self.effective
+
+
+def _threads(pid):
+    """Returns the threads of the process pid."""
+    try:
+        return [int(tid) for tid in os.listdir("/proc/{}/task".format(pid))]
+    except OSError:
+        return [pid]
+
+
+def effective_priority(pid=0):
+    """Returns the nice level, I/O class and priority, and CPU affinity that
+    the thread pid runs with, where the settings that can't be read are None."""
+    effective = {}
+    try:
+        effective["nice"] = os.getpriority(os.PRIO_PROCESS, pid)
+    except OSError:
+        effective["nice"] = None
+    try:
+        io_class, io_priority = ioprio_get(IOPRIO_WHO_PROCESS, pid)
+        names = {value: name for name, value in IO_CLASSES.items()}
+        effective["io_class"] = names.get(io_class, io_class)
+        effective["io_priority"] = io_priority
+    except OSError:
+        effective["io_class"], effective["io_priority"] = None, None
+    try:
+        effective["cpu_affinity"] = sorted(os.sched_getaffinity(pid))
+    except OSError:
+        effective["cpu_affinity"] = None
+    return effective
+
+
+def new_process_priority(nice=None, io_class=None, io_priority=None, cpu_affinity=None):
+    """Validates the priority settings and returns the 'priority'."""
+    response = {}
+    if nice is not None and (
+        not isinstance(nice, int)
+        or isinstance(nice, bool)
+        or not MIN_NICE <= nice <= MAX_NICE
+    ):
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(nice), nice, "an int from {} to {} for nice".format(MIN_NICE, MAX_NICE)
+        )
+        return False, response
+    if io_class is not None and io_class not in IO_CLASSES:
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(io_class), io_class, "one of {} for io_class".format(list(IO_CLASSES))
+        )
+        return False, response
+    if io_priority is not None and (
+        not isinstance(io_priority, int)
+        or isinstance(io_priority, bool)
+        or not 0 <= io_priority <= MAX_IO_PRIORITY
+    ):
+        response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+            type(io_priority),
+            io_priority,
+            "an int from 0 to {} for io_priority".format(MAX_IO_PRIORITY),
+        )
+        return False, response
+    if cpu_affinity is not None:
+        cpus = parse_cpu_list(cpu_affinity)
+        if not cpus:
+            response["msg"] = INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(cpu_affinity),
+                cpu_affinity,
+                "a cpu list such as 0-3,6 for cpu_affinity",
+            )
+            return False, response
+        cpu_affinity = cpus
+    response["priority"] = ProcessPriority(
+        nice=nice, io_class=io_class, io_priority=io_priority, cpu_affinity=cpu_affinity
+    )
+    return True, response
@@ -0,0 +1,173 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from gen_vm_image.common.defaults import (
+    DEFAULT_PROGRESS_FD,
+    DEFAULT_PROGRESS_INTERVAL,
+    PROGRESS_MODES,
+    PROGRESS_NDJSON,
+    PROGRESS_NONE,
+)
+
+# Event names
+STAGE_START = "stage_start"
+STAGE_END = "stage_end"
+PROGRESS = "progress"
+IMAGE_COMPLETE = "image_complete"
+
+
+class ProgressReporter:
+    """Emits machine-readable progress events to a sink.
+    The progress events of a stage are rate-limited to at most one per
+    interval seconds, whereas the stage and completion events are always
+    emitted. A reporter is safe to use from multiple threads."""
+
+    def __init__(self, sink, interval=DEFAULT_PROGRESS_INTERVAL, fields=None):
+        self.sink = sink
+        self.interval = interval
+        self.fields = fields or {}
+        # Identifies the stages of this reporter in the shared rate-limit state
+        self._key = repr(sorted(self.fields.items()))
+        self._lock = threading.Lock()
+        self._progress = {}
+
+    def bind(self, **fields):
+        """Returns a reporter that adds fields to every event it emits,
+        such as the name of the image that the events are about."""
+        reporter = ProgressReporter(
+            self.sink, interval=self.interval, fields={**self.fields, **fields}
+        )
+        # Share the lock and the rate-limit state with the parent
+        reporter._lock = self._lock
+        reporter._progress = self._progress
+        return reporter
+
+    def emit(self, event, **fields):
+        message = {"time": time.time(), "event": event, **self.fields, **fields}
+        with self._lock:
+            self.sink(message)
+
+    def start(self, stage, total=None, unit="bytes"):
+        key = (self._key, stage)
+        now = time.monotonic()
+        with self._lock:
+            self._progress[key] = {
+                "started": now,
+                "emitted": now,
+                "total": total,
+                "unit": unit,
+            }
+
+    def update(self, stage, done, total=None, force=False):
+        """Reports that done units of the stage have been processed."""
+        key = (self._key, stage)
+        now = time.monotonic()
+        with self._lock:
+            state = self._progress.get(key, None)
+            if state is None:
+                state = {"started": now, "emitted": 0, "total": total, "unit": "bytes"}
+                self._progress[key] = state
+            if not force and now - state["emitted"] < self.interval:
+                return
+            state["emitted"] = now
+            if total is None:
+                total = state["total"]
+
+        elapsed = now - state["started"]
+        fields = {"stage": stage, "done": done, "unit": state["unit"]}
+        if elapsed > 0:
+            fields["throughput"] = round(done / elapsed, 2)
+        if total:
+            fields["total"] = total
+            fields["percent"] = round(done / total * 100, 2)
+            if done > 0:
+                fields["eta"] = round(elapsed * (total - done) / done, 2)
+        self.emit(PROGRESS, **fields)
+
+    @contextmanager
+    def stage(self, stage, total=None, unit="bytes", **fields):
+        """Emits the start and end events around a stage. The yielded
+        dictionary is added to the end event, where 'success' defaults to
+        whether the stage completed without raising an exception."""
+        started = time.monotonic()
+        self.start(stage, total=total, unit=unit)
+        self.emit(STAGE_START, stage=stage, **fields)
+        outcome = {"success": False}
+        try:
+            outcome["success"] = True
+            yield outcome
+        except BaseException:
+            outcome["success"] = False
+            raise
+        finally:
+            self.emit(
+                STAGE_END,
+                stage=stage,
+                duration=round(time.monotonic() - started, 3),
+                **outcome,
+            )
+
+
+def fd_sink(fd):
+    """Returns a sink that writes each event as a JSON line to the fd."""
+    stream = os.fdopen(os.dup(fd), "w", buffering=1)
+
+    def sink(message):
+        stream.write(json.dumps(message, default=str) + "\n")
+
+    return sink
+
+
+def new_progress_reporter(progress=None, progress_fd=DEFAULT_PROGRESS_FD):
+    """Returns the ProgressReporter for the progress argument, which is either
+    a reporter already, one of the PROGRESS_MODES, or None."""
+    if isinstance(progress, ProgressReporter):
+        return progress
+    if not progress or progress == PROGRESS_NONE:
+        return None
+    if progress == PROGRESS_NDJSON:
+        return ProgressReporter(fd_sink(int(progress_fd)))
+    raise ValueError(
+        "Invalid progress mode: {}, must be one of: {}".format(progress, PROGRESS_MODES)
+    )
+
+
+@contextmanager
+def stage(progress, name, total=None, unit="bytes", **fields):
+    """Like ProgressReporter.stage, but does nothing if progress is None."""
+    if progress is None:
+        yield {}
+        return
+    with progress.stage(name, total=total, unit=unit, **fields) as outcome:
+        yield outcome
+
+
+def stage_callback(progress, name):
+    """Returns an on_progress(done, total) callback that reports
+    to the stage of progress, or None if progress is None."""
+    if progress is None:
+        return None
+
+    def on_progress(done, total=None):
+        progress.update(name, done, total=total)
+
+    return on_progress
@@ -0,0 +1,211 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import email.utils
+import http.client
+import random
+import time
+
+import requests
+
+from gen_vm_image.common.defaults import (
+    DEFAULT_RETRIES,
+    DEFAULT_RETRY_BACKOFF,
+    DEFAULT_RETRY_JITTER,
+    DEFAULT_RETRY_MAX_BACKOFF,
+    DEFAULT_RETRY_MAX_RETRY_AFTER,
+    DEFAULT_RETRY_MULTIPLIER,
+    QEMU_IMG_RETRYABLE_ERRORS,
+    RETRYABLE_ERRNOS,
+    RETRYABLE_HTTP_STATUS_CODES,
+)
+
+
+class TransientError(IOError):
+    """An error that is expected to go away when the operation is retried,
+    e.g. a download whose connection was closed before the body was complete."""
+
+
+def retry_after(http_response):
+    """Returns the number of seconds that the Retry-After header of the
+    http_response asks the client to wait, or None if it has none."""
+    value = http_response.headers.get("retry-after", None)
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+def retryable_error(err):
+    """Returns whether the download error err is transient, i.e. a dropped
+    connection or a temporary server error, and the number of seconds that
+    the server asked to wait before the next attempt, or None."""
+    if isinstance(err, requests.HTTPError) and err.response is not None:
+        return (
+            err.response.status_code in RETRYABLE_HTTP_STATUS_CODES,
+            retry_after(err.response),
+        )
+    # A certificate that can't be verified won't be any different on a retry
+    if isinstance(err, requests.exceptions.SSLError):
+        return False, None
+    if isinstance(
+        err,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            http.client.IncompleteRead,
+            TransientError,
+        ),
+    ):
+        return True, None
+    if isinstance(err, OSError) and err.errno in RETRYABLE_ERRNOS:
+        return True, None
+    return False, None
+
+
+def retryable_response(response):
+    """Classifies the response of a failed download, which carries whether
+    its error was 'retryable' and the 'retry_after' of the server."""
+    if not isinstance(response, dict):
+        return False, None
+    return response.get("retryable", False), response.get("retry_after", None)
+
+
+def retryable_qemu_img_error(msg):
+    """Classifies the error output of a failed qemu-img command, where only
+    a lock that is held by another process, e.g. a concurrent qemu-img info,
+    is expected to be released by the time of the next attempt."""
+    if isinstance(msg, bytes):
+        msg = msg.decode("utf-8", errors="replace")
+    return any(error in str(msg) for error in QEMU_IMG_RETRYABLE_ERRORS), None
+
+
+class RetryPolicy:
+    """How a stage is retried. A stage is attempted at most retries + 1
+    times, where the delay before the n'th retry is backoff * multiplier^(n-1)
+    seconds up to max_backoff, of which up to the jitter fraction is randomly
+    subtracted such that concurrent builds don't retry in lockstep.
+    A Retry-After of the server is honored up to max_retry_after seconds."""
+
+    def __init__(
+        self,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_RETRY_BACKOFF,
+        max_backoff=DEFAULT_RETRY_MAX_BACKOFF,
+        multiplier=DEFAULT_RETRY_MULTIPLIER,
+        jitter=DEFAULT_RETRY_JITTER,
+        max_retry_after=DEFAULT_RETRY_MAX_RETRY_AFTER,
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+
+    def delay(self, retry, retry_after=None):
+        """Returns the number of seconds to wait before the retry'th retry."""
+        delay = min(self.max_backoff, self.backoff * self.multiplier ** (retry - 1))
+        delay *= 1 - self.jitter * random.random()
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+
+def new_retry_policy(policy):
+    """Returns the RetryPolicy of policy, which is either a RetryPolicy
+    or a dictionary of its arguments."""
+    if isinstance(policy, RetryPolicy):
+        return policy
+    return RetryPolicy(**policy)
+
+
+class Retrier:
+    """Retries the failed stages of a build by the policy of each stage,
+    e.g. 'download' or a qemu-img action such as 'convert', and keeps the
+    number of 'counts' of the retries of each stage along with the 'retries'
+    themselves. Stages without a policy of their own use the default policy."""
+
+    def __init__(self, policies=None, default_policy=None, sleep=asyncio.sleep):
+        self.default_policy = new_retry_policy(default_policy or {})
+        self.policies = {
+            stage: new_retry_policy(policy)
+            for stage, policy in (policies or {}).items()
+        }
+        self.sleep = sleep
+        self.counts = {}
+        self.retries = []
+
+    def policy(self, stage):
+        return self.policies.get(stage, self.default_policy)
+
+    async def run(self, stage, func, *args, classify=retryable_response, **kwargs):
+        """Runs the coroutine function func, which returns a (success,
+        response) tuple, until it succeeds, its failure is classified as
+        permanent, or the retries of the stage are exhausted. Returns the
+        result of the last attempt."""
+        policy = self.policy(stage)
+        retry = 0
+        while True:
+            succeeded, response = await func(*args, **kwargs)
+            if succeeded or retry >= policy.retries:
+                return succeeded, response
+            retryable, server_delay = classify(response)
+            if not retryable:
+                return succeeded, response
+            retry += 1
+            delay = policy.delay(retry, retry_after=server_delay)
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            self.retries.append(
+                {
+                    "stage": stage,
+                    "retry": retry,
+                    "delay": delay,
+                    "error": str(
+                        response.get("msg", response)
+                        if isinstance(response, dict)
+                        else response
+                    ),
+                }
+            )
+            await self.sleep(delay)
+
+
+async def retried(retrier, stage, func, *args, classify=retryable_response, **kwargs):
+    """Runs func with the retrier, or only once if there is no retrier."""
+    if retrier is None:
+        return await func(*args, **kwargs)
+    return await retrier.run(stage, func, *args, classify=classify, **kwargs)
+
+
+def retry_verbose_outputs(retrier):
+    """Returns a verbose message for each of the retries of the retrier."""
+    return [
+        "Retried the {} stage for the {}. time after {:.1f} seconds: {}".format(
+            retry["stage"], retry["retry"], retry["delay"], retry["error"]
+        )
+        for retry in retrier.retries
+    ]
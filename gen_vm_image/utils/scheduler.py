@@ -0,0 +1,160 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import contextlib
+import os
+import time
+
+from gen_vm_image.common.defaults import (
+    DEFAULT_CONVERT_JOBS,
+    DEFAULT_DISK_SPACE_MARGIN,
+    DEFAULT_HASH_JOBS,
+    DEFAULT_NETWORK_JOBS,
+    DEFAULT_SCHEDULER_POLL_INTERVAL,
+    SCHEDULER_CONVERT,
+    SCHEDULER_HASH,
+    SCHEDULER_NETWORK,
+)
+
+
+def free_space(path):
+    """Returns the number of bytes that are available to unprivileged users
+    on the filesystem of path, or of its nearest existing parent."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def filesystem_id(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def allocated_size(path):
+    """Returns the number of bytes that are allocated on disk for path."""
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+class ResourceScheduler:
+    """Admits the stages of concurrent builds such that they do not exhaust
+    the network, CPU or disk of the host.
+
+    Each kind of stage, i.e. network transfers, hashing and conversions,
+    has its own concurrency limit. A stage that writes an image reserves
+    its estimated size on the filesystem of the image first, and is
+    delayed until the free space, minus what the running stages are still
+    expected to write, can hold it. A stage is never failed by the
+    scheduler, a stage that could not fit even on an otherwise idle
+    filesystem is admitted as soon as no other reservation is pending."""
+
+    def __init__(
+        self,
+        network_jobs=DEFAULT_NETWORK_JOBS,
+        hash_jobs=DEFAULT_HASH_JOBS,
+        convert_jobs=DEFAULT_CONVERT_JOBS,
+        disk_space_margin=DEFAULT_DISK_SPACE_MARGIN,
+        poll_interval=DEFAULT_SCHEDULER_POLL_INTERVAL,
+    ):
+        self._semaphores = {
+            SCHEDULER_NETWORK: asyncio.Semaphore(network_jobs),
+            SCHEDULER_HASH: asyncio.Semaphore(hash_jobs),
+            SCHEDULER_CONVERT: asyncio.Semaphore(convert_jobs),
+        }
+        self.disk_space_margin = disk_space_margin
+        self.poll_interval = poll_interval
+        # The (path, size) reservations of the running stages by filesystem
+        self._reservations = {}
+        self._released = asyncio.Condition()
+        # The (path, size, seconds) of every reservation that was delayed
+        self.delays = []
+
+    @contextlib.asynccontextmanager
+    async def slot(self, kind):
+        """Waits for a free slot of the kind of stage."""
+        async with self._semaphores[kind]:
+            yield
+
+    def _pending(self, device):
+        """Returns the number of bytes that the running stages on the
+        filesystem are still expected to write."""
+        return sum(
+            max(0, size - allocated_size(path))
+            for path, size in self._reservations.get(device, [])
+        )
+
+    def _fits(self, path, size):
+        device = filesystem_id(path)
+        if not self._reservations.get(device, None):
+            # Waiting would not free any space
+            return True
+        available = free_space(path) - self._pending(device)
+        return available - self.disk_space_margin >= size
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, path, size):
+        """Waits until size bytes can be written to path, and reserves
+        them until the stage that writes path is done."""
+        size = max(0, int(size or 0))
+        started = time.monotonic()
+        async with self._released:
+            while not self._fits(path, size):
+                try:
+                    # The free space may also change outside of the scheduler
+                    await asyncio.wait_for(
+                        self._released.wait(), timeout=self.poll_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            device = filesystem_id(path)
+            reservation = (path, size)
+            self._reservations.setdefault(device, []).append(reservation)
+        waited = time.monotonic() - started
+        if waited >= self.poll_interval:
+            self.delays.append((path, size, waited))
+        try:
+            yield
+        finally:
+            async with self._released:
+                self._reservations[device].remove(reservation)
+                self._released.notify_all()
+
+
+@contextlib.asynccontextmanager
+async def scheduled(scheduler, kind):
+    """Waits for a slot of the scheduler if there is one."""
+    if scheduler is None:
+        yield
+    else:
+        async with scheduler.slot(kind):
+            yield
+
+
+@contextlib.asynccontextmanager
+async def reserved(scheduler, path, size):
+    """Reserves size bytes for path with the scheduler if there is one."""
+    if scheduler is None:
+        yield
+    else:
+        async with scheduler.reserve(path, size):
+            yield
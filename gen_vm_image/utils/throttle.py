@@ -0,0 +1,128 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import re
+import threading
+import time
+
+from gen_vm_image.common.codes import INVALID_ATTRIBUTE_TYPE_ERROR_MSG
+from gen_vm_image.common.defaults import (
+    BANDWIDTH_UNITS,
+    DEFAULT_BANDWIDTH_CHUNK_DURATION,
+    DEFAULT_BANDWIDTH_MIN_CHUNK_SIZE,
+)
+
+BANDWIDTH_REGEX = re.compile(
+    r"^\s*(?P<value>\d+(?:\.\d+)?)\s*(?P<unit>[kmg]i?)?b?(?:/s)?\s*$", re.I
+)
+
+
+def parse_bandwidth(bandwidth):
+    """Returns the number of bytes per second of bandwidth, which is either
+    a number of bytes per second or a string such as '10M', '10MB/s' or
+    '50MiB'. Returns None if the bandwidth is invalid."""
+    if isinstance(bandwidth, bool):
+        return None
+    if isinstance(bandwidth, (int, float)):
+        return float(bandwidth) if bandwidth > 0 else None
+    if not isinstance(bandwidth, str):
+        return None
+    match = BANDWIDTH_REGEX.match(bandwidth)
+    if not match:
+        return None
+    rate = (
+        float(match.group("value"))
+        * BANDWIDTH_UNITS[(match.group("unit") or "").upper()]
+    )
+    return rate if rate > 0 else None
+
+
+class TokenBucket:
+    """Limits the bytes that pass through it to rate bytes per second. The
+    bucket holds at most burst bytes of unused bandwidth, and a consumer
+    that takes more than the bucket holds goes into debt that it waits
+    for. Since the debt is paid in the order that the consumers take from
+    the bucket, concurrent downloads with the same chunk_size are served
+    in turn and share the rate equally. The bucket is thread-safe."""
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        # The number of bytes that a consumer should take at a time
+        self.chunk_size = max(
+            int(self.rate * DEFAULT_BANDWIDTH_CHUNK_DURATION),
+            DEFAULT_BANDWIDTH_MIN_CHUNK_SIZE,
+        )
+        self.burst = burst if burst is not None else self.chunk_size
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def reserve(self, amount):
+        """Takes amount bytes from the bucket and returns the number of
+        seconds that the consumer must wait before it may use them."""
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def consume(self, amount):
+        throttle([self], amount)
+
+
+def throttle(buckets, amount):
+    """Waits until amount bytes are available in every one of buckets, e.g.
+    the cap of a download and the budget that it shares with the others."""
+    delay = max([bucket.reserve(amount) for bucket in buckets] + [0.0])
+    if delay > 0:
+        buckets[0].sleep(delay)
+    return delay
+
+
+def new_bandwidth(bandwidth_limit):
+    """Returns the TokenBucket of bandwidth_limit, see parse_bandwidth,
+    or None if it is None. Raises a ValueError if bandwidth_limit is invalid."""
+    if bandwidth_limit is None:
+        return None
+    rate = parse_bandwidth(bandwidth_limit)
+    if rate is None:
+        raise ValueError(
+            INVALID_ATTRIBUTE_TYPE_ERROR_MSG.format(
+                type(bandwidth_limit),
+                bandwidth_limit,
+                "a bandwidth such as 10M or 50MiB",
+            )
+        )
+    return TokenBucket(rate)
+
+
+def download_buckets(bandwidth_limit=None, shared_bandwidth=None):
+    """Returns the token buckets that a download is throttled by, i.e. its
+    own bandwidth_limit and the shared_bandwidth TokenBucket of the build
+    if they are set."""
+    buckets = []
+    if bandwidth_limit is not None:
+        buckets.append(new_bandwidth(bandwidth_limit))
+    if shared_bandwidth is not None:
+        buckets.append(shared_bandwidth)
+    return buckets
@@ -16,8 +16,17 @@
 
 import unittest
 
-from gen_vm_image.architecture import load_architecture
-from gen_vm_image.common.codes import PATH_NOT_FOUND_ERROR
+from gen_vm_image.architecture import (
+    group_images_by_input,
+    load_architecture,
+    validate_architecture,
+    validate_input,
+)
+from gen_vm_image.common.codes import (
+    INVALID_ATTRIBUTE_TYPE_ERROR,
+    MISSING_ATTRIBUTE_ERROR,
+    PATH_NOT_FOUND_ERROR,
+)
 from gen_vm_image.utils.io import join
 
 
@@ -100,3 +109,167 @@ class TestImageArchitecture(unittest.TestCase):
             self.assertIn("size", image_data)
             self.assertIsInstance(image_data["size"], str)
             self.assertGreater(len(image_data["size"]), 0)
+
+    def test_validate_architecture(self):
+        loaded, response = load_architecture(self.architecture_path)
+        self.assertTrue(loaded)
+        valid, valid_response = validate_architecture(response["architecture"])
+        self.assertTrue(valid)
+        self.assertNotIn("errors", valid_response)
+
+    def test_validate_architecture_collects_every_error(self):
+        architecture = {
+            "owner": "the-owner-name",
+            "images": {
+                "image-1": {"name": "image-1", "size": "10G"},
+                "image-2": {"name": "image-2"},
+                "image-3": {
+                    "name": "image-3",
+                    "size": "10G",
+                    "input": {"format": "qcow2"},
+                },
+                "image-4": {
+                    "name": "image-4",
+                    "size": "10G",
+                    "input": {"path": "image.qcow2", "checksum": {"type": 1}},
+                },
+            },
+        }
+        valid, response = validate_architecture(architecture)
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], MISSING_ATTRIBUTE_ERROR)
+        self.assertEqual(len(response["errors"]), 4)
+        self.assertTrue(response["errors"][0].startswith("image 'image-2'"))
+        self.assertTrue(response["errors"][1].startswith("image 'image-3'"))
+        self.assertTrue(response["errors"][2].startswith("image 'image-4'"))
+
+    def test_validate_architecture_missing_structure(self):
+        valid, response = validate_architecture({"images": []})
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], MISSING_ATTRIBUTE_ERROR)
+        self.assertEqual(len(response["errors"]), 2)
+
+    def test_validate_input(self):
+        valid, response = validate_input({"format": "qcow2"})
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], MISSING_ATTRIBUTE_ERROR)
+
+        valid, response = validate_input({"path": "a.qcow2", "url": "b.qcow2"})
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], INVALID_ATTRIBUTE_TYPE_ERROR)
+
+        valid, response = validate_input({"path": "a.qcow2"})
+        self.assertTrue(valid)
+
+        valid, response = validate_input({"urls": []})
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], INVALID_ATTRIBUTE_TYPE_ERROR)
+
+        valid, response = validate_input({"url": "a.qcow2", "urls": ["b.qcow2"]})
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], INVALID_ATTRIBUTE_TYPE_ERROR)
+
+        valid, response = validate_input({"urls": ["a.qcow2", "b.qcow2"]})
+        self.assertTrue(valid)
+
+        valid, response = validate_input({"url": "a.qcow2", "cache_ttl": "1h"})
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], INVALID_ATTRIBUTE_TYPE_ERROR)
+
+    def test_validate_input_checksum(self):
+        valid, response = validate_input(
+            {"url": "a.qcow2", "checksum": {"type": "sha256", "url": "SHA256SUMS"}}
+        )
+        self.assertTrue(valid)
+
+        valid, response = validate_input(
+            {"url": "a.qcow2", "checksum": {"type": "sha256"}}
+        )
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], MISSING_ATTRIBUTE_ERROR)
+
+        valid, response = validate_input(
+            {
+                "url": "a.qcow2",
+                "checksum": {"type": "sha256", "value": "abc", "url": "SHA256SUMS"},
+            }
+        )
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], INVALID_ATTRIBUTE_TYPE_ERROR)
+
+    def test_validate_large_architecture(self):
+        images = {
+            "image-{}".format(i): {
+                "name": "image-{}".format(i),
+                "size": "10G",
+                "input": {"url": "https://example.org/{}.qcow2".format(i)},
+            }
+            for i in range(10000)
+        }
+        images["image-9999"]["input"]["format"] = 2
+        valid, response = validate_architecture(
+            {"owner": "the-owner-name", "images": images}
+        )
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], INVALID_ATTRIBUTE_TYPE_ERROR)
+        self.assertEqual(len(response["errors"]), 1)
+
+    def test_expand_architecture_matrix(self):
+        matrix_architecture_path = join("tests", "res", "matrix_architecture.yml")
+        loaded, response = load_architecture(matrix_architecture_path)
+        self.assertTrue(loaded)
+        valid, valid_response = validate_architecture(response["architecture"])
+        self.assertTrue(valid)
+
+        architecture = valid_response["architecture"]
+        self.assertNotIn("defaults", architecture)
+        images = architecture["images"]
+        self.assertEqual(len(images), 8)
+
+        rocky_images = [name for name in images if name.startswith("rocky-")]
+        self.assertEqual(len(rocky_images), 5)
+        self.assertNotIn("rocky-40G-raw", images)
+        rocky_20g_raw = images["rocky-20G-raw"]
+        self.assertEqual(rocky_20g_raw["name"], "rocky-20G")
+        self.assertEqual(rocky_20g_raw["size"], "20G")
+        self.assertEqual(rocky_20g_raw["format"], "raw")
+        self.assertEqual(rocky_20g_raw["version"], 9.4)
+        self.assertEqual(rocky_20g_raw["input"]["path"], "tests/res/test.qcow2")
+        self.assertNotIn("matrix", rocky_20g_raw)
+
+        debian_12 = images["debian-12"]
+        self.assertEqual(debian_12["name"], "debian-12")
+        self.assertEqual(debian_12["format"], "qcow2")
+        self.assertEqual(debian_12["input"]["format"], "raw")
+        self.assertNotIn("release", debian_12)
+
+        # The images are grouped by their shared input
+        groups = group_images_by_input(images)
+        self.assertEqual(sorted(len(group) for group in groups), [2, 6])
+
+    def test_validate_architecture_duplicate_output(self):
+        architecture = {
+            "owner": "the-owner-name",
+            "images": {
+                "image": {
+                    "name": "image",
+                    "size": "10G",
+                    "matrix": {"size": ["10G", "20G"]},
+                },
+            },
+        }
+        valid, response = validate_architecture(architecture)
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], INVALID_ATTRIBUTE_TYPE_ERROR)
+        self.assertEqual(len(response["errors"]), 1)
+
+    def test_validate_architecture_invalid_matrix(self):
+        architecture = {
+            "owner": "the-owner-name",
+            "images": {
+                "image": {"name": "image", "size": "10G", "matrix": {"size": []}},
+            },
+        }
+        valid, response = validate_architecture(architecture)
+        self.assertFalse(valid)
+        self.assertEqual(response["error_code"], INVALID_ATTRIBUTE_TYPE_ERROR)
@@ -0,0 +1,100 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import random
+import unittest
+
+from gen_vm_image.batch import generate_images
+from gen_vm_image.common.codes import (
+    INVALID_ATTRIBUTE_TYPE_ERROR,
+    MISSING_ATTRIBUTE_ERROR,
+    PATH_NOT_FOUND_ERROR,
+)
+from gen_vm_image.utils.io import exists, join, makedirs, remove
+
+
+class TestBatch(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.seed = str(random.random())[2:10]
+        cls.images_dir = os.path.realpath(join("tests", "tmp", "batch", cls.seed))
+        if not exists(cls.images_dir):
+            assert makedirs(cls.images_dir)
+        cls.missing_input_path = join(cls.images_dir, "missing.qcow2")
+
+    @classmethod
+    def tearDownClass(cls):
+        if exists(cls.images_dir):
+            assert remove(cls.images_dir, recursive=True)
+
+    def missing_input_spec(self, name):
+        return {
+            "name": name,
+            "size": "1G",
+            "input": {"path": "{}-{}".format(self.missing_input_path, name)},
+        }
+
+    async def test_generate_images_yields_every_result(self):
+        specs = [
+            self.missing_input_spec("image-1"),
+            {"name": "image-2"},
+            self.missing_input_spec("image-3"),
+            dict(self.missing_input_spec("image-1")),
+        ]
+        results = {}
+        async for spec, return_code, response in generate_images(
+            specs, concurrency=2, output_directory=self.images_dir
+        ):
+            self.assertIn("msg", response)
+            results.setdefault(spec["name"], []).append(return_code)
+
+        self.assertEqual(
+            sorted(results["image-1"]),
+            sorted([PATH_NOT_FOUND_ERROR, INVALID_ATTRIBUTE_TYPE_ERROR]),
+        )
+        self.assertEqual(results["image-2"], [MISSING_ATTRIBUTE_ERROR])
+        self.assertEqual(results["image-3"], [PATH_NOT_FOUND_ERROR])
+
+    async def test_generate_images_shared_input(self):
+        specs = [
+            {
+                "name": "shared-{}".format(size),
+                "size": size,
+                "input": {"path": self.missing_input_path},
+            }
+            for size in ["1G", "2G", "3G"]
+        ]
+        return_codes = [
+            return_code
+            async for _, return_code, _ in generate_images(
+                specs, output_directory=self.images_dir
+            )
+        ]
+        self.assertEqual(return_codes, [PATH_NOT_FOUND_ERROR] * 3)
+
+    async def test_generate_images_stop_early(self):
+        specs = [self.missing_input_spec("early-{}".format(i)) for i in range(10)]
+        async for _, return_code, _ in generate_images(
+            specs, concurrency=1, output_directory=self.images_dir
+        ):
+            self.assertEqual(return_code, PATH_NOT_FOUND_ERROR)
+            break
+
+    async def test_generate_images_invalid_concurrency(self):
+        with self.assertRaises(ValueError):
+            async for _ in generate_images([], concurrency=0):
+                pass
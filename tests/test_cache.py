@@ -0,0 +1,190 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import hashlib
+import os
+import random
+import time
+import unittest
+from email.utils import formatdate
+
+from gen_vm_image.common.codes import SUCCESS
+from gen_vm_image.common.defaults import TMP_DIR
+from gen_vm_image.image import prepare_input
+from gen_vm_image.utils.cache import (
+    CACHE_FRESH,
+    CACHE_MODIFIED,
+    CACHE_NOT_MODIFIED,
+    CACHE_UNVALIDATED,
+    cache_metadata_path,
+    load_cache_metadata,
+    revalidate_cache,
+)
+from gen_vm_image.utils.io import exists, join, load, remove
+from gen_vm_image.utils.scheduler import ResourceScheduler
+
+from .http_server import LocalHTTPServer, QuietHandler
+
+
+class CacheHandler(QuietHandler):
+    body = b""
+    last_modified = formatdate(usegmt=True)
+    # The (method, conditional headers) of each request
+    requests = []
+
+    def send_validated_headers(self):
+        etag = '"{}"'.format(hashlib.sha1(self.body).hexdigest())
+        self.requests.append(
+            (
+                self.command,
+                self.headers.get("If-None-Match", None),
+                self.headers.get("If-Modified-Since", None),
+            )
+        )
+        if self.headers.get("If-None-Match", None) == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return False
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.last_modified)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        return True
+
+    def do_HEAD(self):
+        self.send_validated_headers()
+
+    def do_GET(self):
+        if self.send_validated_headers():
+            self.wfile.write(self.body)
+
+
+class TestCache(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalHTTPServer(CacheHandler)
+        cls.seed = str(random.random())[2:10]
+        cls.url = "{}/cache-{}.raw".format(cls.server.url, cls.seed)
+        cls.cache_path = join(TMP_DIR, "cache-{}.raw".format(cls.seed))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        CacheHandler.body = os.urandom(64 * 1024)
+        CacheHandler.last_modified = formatdate(usegmt=True)
+        CacheHandler.requests = []
+
+    def tearDown(self):
+        for path in [self.cache_path, cache_metadata_path(self.cache_path)]:
+            if exists(path):
+                remove(path)
+
+    def methods(self):
+        return [method for method, _, _ in CacheHandler.requests]
+
+    async def test_cached_download_is_revalidated(self):
+        return_code, response = await prepare_input(self.url, input_format="raw")
+        self.assertEqual(return_code, SUCCESS, response)
+        self.assertEqual(response["input_path"], self.cache_path)
+        self.assertEqual(self.methods(), ["GET"])
+        metadata = load_cache_metadata(self.cache_path)
+        self.assertEqual(metadata["url"], self.url)
+        self.assertEqual(metadata["size"], len(CacheHandler.body))
+
+        # The unchanged image is revalidated without downloading it again
+        return_code, response = await prepare_input(self.url, input_format="raw")
+        self.assertEqual(return_code, SUCCESS, response)
+        self.assertEqual(self.methods(), ["GET", "HEAD"])
+        self.assertEqual(CacheHandler.requests[-1][1], metadata["etag"])
+        self.assertEqual(CacheHandler.requests[-1][2], metadata["last_modified"])
+
+        # The changed image is downloaded again after it is revalidated
+        CacheHandler.body = os.urandom(64 * 1024)
+        return_code, response = await prepare_input(self.url, input_format="raw")
+        self.assertEqual(return_code, SUCCESS, response)
+        self.assertEqual(self.methods(), ["GET", "HEAD", "HEAD", "GET"])
+        self.assertEqual(load(self.cache_path, mode="rb"), CacheHandler.body)
+
+    async def test_cache_ttl(self):
+        return_code, _ = await prepare_input(self.url, input_format="raw")
+        self.assertEqual(return_code, SUCCESS)
+
+        fresh, response = await revalidate_cache([self.url], self.cache_path, ttl=3600)
+        self.assertTrue(fresh)
+        self.assertEqual(response["cache_status"], CACHE_FRESH)
+        self.assertEqual(self.methods(), ["GET"])
+
+        fresh, response = await revalidate_cache([self.url], self.cache_path, ttl=0)
+        self.assertTrue(fresh)
+        self.assertEqual(response["cache_status"], CACHE_NOT_MODIFIED)
+        self.assertEqual(self.methods(), ["GET", "HEAD"])
+
+    async def test_legacy_cache_entry(self):
+        return_code, _ = await prepare_input(self.url, input_format="raw")
+        self.assertEqual(return_code, SUCCESS)
+        metadata = load_cache_metadata(self.cache_path)
+        remove(cache_metadata_path(self.cache_path))
+
+        # An entry without metadata is adopted if it matches the server
+        fresh, response = await revalidate_cache([self.url], self.cache_path)
+        self.assertTrue(fresh)
+        self.assertEqual(response["cache_status"], CACHE_NOT_MODIFIED)
+        self.assertEqual(CacheHandler.requests[-1], ("HEAD", None, None))
+        self.assertEqual(load_cache_metadata(self.cache_path)["etag"], metadata["etag"])
+
+        # Otherwise it is downloaded again
+        remove(cache_metadata_path(self.cache_path))
+        CacheHandler.last_modified = formatdate(time.time() + 3600, usegmt=True)
+        fresh, response = await revalidate_cache([self.url], self.cache_path)
+        self.assertFalse(fresh)
+        self.assertEqual(response["cache_status"], CACHE_MODIFIED)
+
+    async def test_unreachable_server_uses_cache(self):
+        return_code, _ = await prepare_input(self.url, input_format="raw")
+        self.assertEqual(return_code, SUCCESS)
+        unreachable_url = "http://127.0.0.1:1/cache-{}.raw".format(self.seed)
+        fresh, response = await revalidate_cache([unreachable_url], self.cache_path)
+        self.assertTrue(fresh)
+        self.assertEqual(response["cache_status"], CACHE_UNVALIDATED)
+
+    async def test_download_size_is_reserved(self):
+        reservations = []
+
+        class RecordingScheduler(ResourceScheduler):
+            def reserve(self, path, size):
+                reservations.append((path, size))
+                return super().reserve(path, size)
+
+        scheduler = RecordingScheduler()
+        return_code, _ = await prepare_input(
+            self.url, input_format="raw", scheduler=scheduler
+        )
+        self.assertEqual(return_code, SUCCESS)
+        self.assertEqual(
+            reservations,
+            [("{}.partial".format(self.cache_path), len(CacheHandler.body))],
+        )
+
+        # A cached image is not downloaded again, so nothing is reserved
+        return_code, _ = await prepare_input(
+            self.url, input_format="raw", scheduler=scheduler
+        )
+        self.assertEqual(return_code, SUCCESS)
+        self.assertEqual(len(reservations), 1)
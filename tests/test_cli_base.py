@@ -16,8 +16,10 @@
 
 import unittest
 
+from gen_vm_image.api import api
 from gen_vm_image.cli.cli import main
 from gen_vm_image.common.codes import SUCCESS
+from gen_vm_image.common.defaults import SERVE
 
 
 class TestCLIBase(unittest.TestCase):
@@ -37,3 +39,17 @@ class TestCLIBase(unittest.TestCase):
         except SystemExit as e:
             return_code = e.code
         self.assertEqual(return_code, SUCCESS)
+
+    def test_cli_serve_help(self):
+        return_code = None
+        try:
+            return_code = main([SERVE, "--help"])
+        except SystemExit as e:
+            return_code = e.code
+        self.assertEqual(return_code, SUCCESS)
+
+    def test_api_default_options(self):
+        args, options = api()
+        self.assertEqual(args, ["name", "size"])
+        self.assertIn("input", options)
+        self.assertIn("http_pool_size", options)
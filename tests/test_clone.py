@@ -0,0 +1,97 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import random
+import struct
+import unittest
+
+from gen_vm_image.common.defaults import CLONE_COPY_FILE_RANGE, CLONE_REFLINK
+from gen_vm_image.image import can_clone_image
+from gen_vm_image.utils.clone import clone_file
+from gen_vm_image.utils.headers import QCOW2_INCOMPAT_DATA_FILE, QCOW2_MAGIC
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove, write
+
+
+def qcow2_header(version=3, backing_file_offset=0, incompatible_features=0):
+    header = bytearray(512)
+    header[0:4] = QCOW2_MAGIC
+    struct.pack_into(">IQ", header, 4, version, backing_file_offset)
+    struct.pack_into(">Q", header, 72, incompatible_features)
+    return bytes(header)
+
+
+class TestClone(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = join("tests", "tmp", "clone", self.seed)
+        assert makedirs(self.tmp_dir)
+        self.path = join(self.tmp_dir, "image.qcow2")
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    async def test_clone_keeps_content_and_holes(self):
+        source_path = join(self.tmp_dir, "sparse.raw")
+        data = os.urandom(64 * 1024)
+        with open(source_path, "wb") as fh:
+            fh.write(data)
+            # A 64MiB hole between the data and the end of the image
+            fh.seek(64 * 1024 * 1024)
+            fh.write(data)
+        cloned_path = join(self.tmp_dir, "cloned.raw")
+        cloned, response = await clone_file(source_path, cloned_path)
+        self.assertTrue(cloned, response)
+        self.assertIn(response["method"], [CLONE_REFLINK, CLONE_COPY_FILE_RANGE])
+        self.assertEqual(load(cloned_path, mode="rb"), load(source_path, mode="rb"))
+        # The hole is not allocated in the clone
+        self.assertLess(os.stat(cloned_path).st_blocks * 512, 32 * 1024 * 1024)
+
+    async def test_failed_clone_is_removed(self):
+        cloned, response = await clone_file(
+            join(self.tmp_dir, "missing.raw"), join(self.tmp_dir, "cloned.raw")
+        )
+        self.assertFalse(cloned)
+        self.assertIn("msg", response)
+        self.assertFalse(exists(join(self.tmp_dir, "cloned.raw")))
+
+    def test_can_clone_image(self):
+        assert write(self.path, qcow2_header(), mode="wb")
+        self.assertTrue(can_clone_image(self.path, "qcow2"))
+        self.assertTrue(can_clone_image(self.path, "raw"))
+        self.assertFalse(can_clone_image(self.path, "vmdk"))
+
+        # Images that refer to other files are converted instead
+        assert write(self.path, qcow2_header(backing_file_offset=512), mode="wb")
+        self.assertFalse(can_clone_image(self.path, "qcow2"))
+        assert write(
+            self.path,
+            qcow2_header(incompatible_features=QCOW2_INCOMPAT_DATA_FILE),
+            mode="wb",
+        )
+        self.assertFalse(can_clone_image(self.path, "qcow2"))
+        # The incompatible features are not part of a version 2 header
+        assert write(
+            self.path,
+            qcow2_header(version=2, incompatible_features=QCOW2_INCOMPAT_DATA_FILE),
+            mode="wb",
+        )
+        self.assertTrue(can_clone_image(self.path, "qcow2"))
+
+        # As are images that are not actually in the declared format
+        assert write(self.path, os.urandom(512), mode="wb")
+        self.assertFalse(can_clone_image(self.path, "qcow2"))
@@ -0,0 +1,228 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import bz2
+import errno
+import gzip
+import hashlib
+import lzma
+import os
+import random
+import threading
+import unittest
+
+from gen_vm_image.common.codes import JOB_CANCELLED_ERROR_MSG
+from gen_vm_image.utils.compression import (
+    EXTERNAL_DECOMPRESSORS,
+    _decompress_external,
+    decompress_file,
+    decompressed_size,
+    detect_compression,
+    strip_compression_extension,
+)
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove
+from gen_vm_image.utils.job import run_in_thread
+
+TEST_IMAGE_PATH = join("tests", "res", "test.qcow2")
+
+COMPRESSORS = {
+    "xz": lzma.compress,
+    "gz": gzip.compress,
+    "bz2": bz2.compress,
+}
+
+
+class TestCompression(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.seed = str(random.random())[2:10]
+        cls.tmp_dir = join("tests", "tmp", "compression", cls.seed)
+        if not exists(cls.tmp_dir):
+            assert makedirs(cls.tmp_dir)
+        cls.image_content = load(TEST_IMAGE_PATH, mode="rb")
+        assert cls.image_content
+
+    @classmethod
+    def tearDownClass(cls):
+        if exists(cls.tmp_dir):
+            assert remove(cls.tmp_dir, recursive=True)
+
+    def compressed_image(self, compression):
+        path = join(self.tmp_dir, "test.qcow2.{}".format(compression))
+        with open(path, "wb") as fh:
+            fh.write(COMPRESSORS[compression](self.image_content))
+        return path
+
+    def test_detect_compression(self):
+        for compression in COMPRESSORS:
+            path = self.compressed_image(compression)
+            self.assertEqual(detect_compression(path), compression)
+        self.assertIsNone(detect_compression(TEST_IMAGE_PATH))
+
+    def test_strip_compression_extension(self):
+        self.assertEqual(
+            strip_compression_extension("image.qcow2.xz", "xz"), "image.qcow2"
+        )
+        self.assertEqual(
+            strip_compression_extension("image", "gz"), "image.decompressed"
+        )
+
+    def test_decompressed_size(self):
+        for compression in COMPRESSORS:
+            path = self.compressed_image(compression)
+            expected_size = len(self.image_content)
+            if compression == "bz2":
+                # bz2 does not record the size, so the compressed size is used
+                expected_size = os.path.getsize(path)
+            self.assertEqual(decompressed_size(path, compression), expected_size)
+
+        # Every stream of a multi-stream xz file is counted, and the
+        # padding that follows a stream is skipped
+        path = join(self.tmp_dir, "streams.qcow2.xz")
+        with open(path, "wb") as fh:
+            fh.write(lzma.compress(self.image_content))
+            fh.write(lzma.compress(self.image_content[:1000]) + bytes(8))
+        self.assertEqual(decompressed_size(path, "xz"), len(self.image_content) + 1000)
+
+    async def test_decompress_file(self):
+        for compression in COMPRESSORS:
+            path = self.compressed_image(compression)
+            output_path = strip_compression_extension(path, compression)
+            decompressed, response = await decompress_file(path, output_path)
+            self.assertTrue(decompressed)
+            self.assertEqual(response["compression"], compression)
+            self.assertEqual(response["decompressed_size"], len(self.image_content))
+            self.assertEqual(load(output_path, mode="rb"), self.image_content)
+            self.assertFalse(exists("{}.partial".format(output_path)))
+
+    async def test_decompress_file_python_fallback(self):
+        path = self.compressed_image("xz")
+        output_path = join(self.tmp_dir, "fallback.qcow2")
+        external_decompressors = EXTERNAL_DECOMPRESSORS.pop("xz")
+        try:
+            decompressed, response = await decompress_file(path, output_path)
+        finally:
+            EXTERNAL_DECOMPRESSORS["xz"] = external_decompressors
+        self.assertTrue(decompressed)
+        self.assertEqual(response["decompressor"], "python")
+        self.assertEqual(load(output_path, mode="rb"), self.image_content)
+
+    async def test_decompress_file_checksum(self):
+        path = self.compressed_image("gz")
+        output_path = join(self.tmp_dir, "checksum.qcow2")
+        compressed_checksum = hashlib.sha256(load(path, mode="rb")).hexdigest()
+        decompressed_checksum = hashlib.sha256(self.image_content).hexdigest()
+
+        decompressed, response = await decompress_file(
+            path, output_path, checksum_algorithm="sha256"
+        )
+        self.assertTrue(decompressed)
+        self.assertEqual(response["checksum"], compressed_checksum)
+
+        decompressed, response = await decompress_file(
+            path,
+            output_path,
+            checksum_algorithm="sha256",
+            checksum_decompressed=True,
+        )
+        self.assertTrue(decompressed)
+        self.assertEqual(response["checksum"], decompressed_checksum)
+
+        partial_checksum = hashlib.sha256(self.image_content[:1000]).hexdigest()
+        decompressed, response = await decompress_file(
+            path,
+            output_path,
+            checksum_algorithm="sha256",
+            checksum_decompressed=True,
+            checksum_read_bytes=1000,
+        )
+        self.assertTrue(decompressed)
+        self.assertEqual(response["checksum"], partial_checksum)
+
+    async def test_decompress_file_sparse(self):
+        content = os.urandom(4096) + bytes(8 * 1024 * 1024) + os.urandom(4096)
+        path = join(self.tmp_dir, "sparse.raw.xz")
+        with open(path, "wb") as fh:
+            fh.write(lzma.compress(content))
+        output_path = join(self.tmp_dir, "sparse.raw")
+        decompressed, _ = await decompress_file(path, output_path)
+        self.assertTrue(decompressed)
+        self.assertEqual(load(output_path, mode="rb"), content)
+
+    async def test_decompress_invalid_file(self):
+        output_path = join(self.tmp_dir, "invalid.qcow2")
+        decompressed, response = await decompress_file(TEST_IMAGE_PATH, output_path)
+        self.assertFalse(decompressed)
+        self.assertIn("msg", response)
+        self.assertFalse(exists(output_path))
+
+    async def test_decompress_file_cancelled(self):
+        cancel_event = threading.Event()
+        cancel_event.set()
+        for external in [True, False]:
+            path = self.compressed_image("xz")
+            output_path = join(self.tmp_dir, "cancelled.qcow2")
+            external_decompressors = EXTERNAL_DECOMPRESSORS["xz"]
+            if not external:
+                EXTERNAL_DECOMPRESSORS["xz"] = []
+            try:
+                decompressed, response = await decompress_file(
+                    path, output_path, cancel_event=cancel_event
+                )
+            finally:
+                EXTERNAL_DECOMPRESSORS["xz"] = external_decompressors
+            self.assertFalse(decompressed)
+            self.assertEqual(response["msg"], JOB_CANCELLED_ERROR_MSG)
+            self.assertFalse(exists(output_path))
+            self.assertFalse(exists("{}.partial".format(output_path)))
+
+    async def external_decompress(self, command, output_fh):
+        input_path = join(self.tmp_dir, "external.raw")
+        with open(input_path, "wb") as fh:
+            fh.write(os.urandom(8 * 1024 * 1024))
+        # A hanging decompression fails the test instead of blocking it
+        return await asyncio.wait_for(
+            run_in_thread(
+                _decompress_external,
+                command,
+                input_path,
+                output_fh,
+                64 * 1024,
+                None,
+                None,
+            ),
+            10,
+        )
+
+    async def test_decompress_external_write_error(self):
+        class FullDisk:
+            def write(self, data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+
+            def seek(self, *args):
+                raise OSError(errno.ENOSPC, "No space left on device")
+
+        with self.assertRaises(OSError):
+            await self.external_decompress(["cat"], FullDisk())
+
+    async def test_decompress_external_stderr(self):
+        # More warnings than fit in the stderr pipe
+        command = ["sh", "-c", "head -c 1048576 /dev/zero >&2; cat"]
+        output_path = join(self.tmp_dir, "external.out")
+        with open(output_path, "wb") as output_fh:
+            size = await self.external_decompress(command, output_fh)
+        self.assertEqual(size, 8 * 1024 * 1024)
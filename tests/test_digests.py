@@ -0,0 +1,174 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import hashlib
+import os
+import random
+import time
+import unittest
+
+from gen_vm_image.utils.digests import DigestIndex
+from gen_vm_image.utils.io import (
+    exists,
+    hashsum,
+    hashsums,
+    join,
+    makedirs,
+    remove,
+    write,
+)
+
+FAKE_DIGEST = "0" * 64
+
+
+class TestDigestIndex(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = os.path.realpath(join("tests", "tmp", "digests", self.seed))
+        if not exists(self.tmp_dir):
+            assert makedirs(self.tmp_dir)
+        self.index_path = join(self.tmp_dir, "digest-index.json")
+        self.image_path = join(self.tmp_dir, "image.raw")
+        self.content = os.urandom(128 * 1024)
+        assert write(self.image_path, self.content, mode="wb")
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    async def test_unchanged_file_is_not_hashed(self):
+        index = DigestIndex(path=self.index_path, racy_window=0)
+        digest = await hashsum(self.image_path, algorithm="sha256", digest_index=index)
+        self.assertEqual(digest, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(index.lookup(self.image_path, "sha256"), digest)
+        self.assertIsNone(index.lookup(self.image_path, "sha512"))
+        self.assertIsNone(index.lookup(self.image_path, "sha256", read_bytes=1024))
+
+        # The indexed digest is returned without reading the file
+        index.record(self.image_path, "sha256", FAKE_DIGEST)
+        self.assertEqual(
+            await hashsum(self.image_path, algorithm="sha256", digest_index=index),
+            FAKE_DIGEST,
+        )
+        # Unless the digest is forced to be calculated
+        self.assertEqual(
+            await hashsum(
+                self.image_path, algorithm="sha256", digest_index=index, force=True
+            ),
+            digest,
+        )
+
+    async def test_changed_file_is_hashed(self):
+        index = DigestIndex(path=self.index_path, racy_window=0)
+        await hashsum(self.image_path, algorithm="sha256", digest_index=index)
+
+        # The same size and mtime, but the ctime and content changed.
+        # Wait for the timestamp granularity such that the ctime differs
+        stat = os.stat(self.image_path)
+        time.sleep(0.05)
+        content = os.urandom(len(self.content))
+        assert write(self.image_path, content, mode="wb")
+        os.utime(self.image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIsNone(index.lookup(self.image_path, "sha256"))
+        self.assertEqual(
+            await hashsum(self.image_path, algorithm="sha256", digest_index=index),
+            hashlib.sha256(content).hexdigest(),
+        )
+
+    async def test_recently_modified_file_is_not_indexed(self):
+        index = DigestIndex(path=self.index_path)
+        digest = await hashsum(self.image_path, algorithm="sha256", digest_index=index)
+        self.assertTrue(digest)
+        self.assertIsNone(index.lookup(self.image_path, "sha256"))
+
+    def test_index_is_persisted(self):
+        index = DigestIndex(path=self.index_path, racy_window=0)
+        removed_path = join(self.tmp_dir, "removed.raw")
+        assert write(removed_path, b"removed", mode="wb")
+        self.assertTrue(index.record(self.image_path, "sha256", FAKE_DIGEST))
+        self.assertTrue(index.record(removed_path, "sha256", FAKE_DIGEST))
+        remove(removed_path)
+        self.assertTrue(index.save())
+
+        # Later builds load the index, without the entries of removed files
+        other_index = DigestIndex(path=self.index_path, racy_window=0)
+        self.assertEqual(other_index.lookup(self.image_path, "sha256"), FAKE_DIGEST)
+        self.assertNotIn(os.path.realpath(removed_path), other_index.files)
+        self.assertTrue(
+            index.record(self.image_path, "md5", FAKE_DIGEST[:32], read_bytes=10)
+        )
+        self.assertTrue(index.save())
+        loaded = DigestIndex(path=self.index_path)
+        self.assertEqual(loaded.lookup(self.image_path, "sha256"), FAKE_DIGEST)
+        self.assertEqual(
+            loaded.lookup(self.image_path, "md5", read_bytes=10), FAKE_DIGEST[:32]
+        )
+
+    def test_racy_digest_is_indexed_once_unchanged(self):
+        index = DigestIndex(path=self.index_path, racy_window=0.2)
+        # The file was just written, so its digest is not used yet
+        self.assertTrue(index.record(self.image_path, "sha256", FAKE_DIGEST))
+        self.assertIsNone(index.lookup(self.image_path, "sha256"))
+        self.assertTrue(index.save())
+
+        # But it is once the file is still unchanged after the racy window
+        time.sleep(0.3)
+        other_index = DigestIndex(path=self.index_path, racy_window=0.2)
+        self.assertEqual(other_index.lookup(self.image_path, "sha256"), FAKE_DIGEST)
+        self.assertNotIn("racy", other_index.files[self.image_path])
+
+        # A racy digest of a file that changed again is never used
+        assert write(self.image_path, self.content[:1024], mode="wb")
+        self.assertTrue(index.record(self.image_path, "sha256", FAKE_DIGEST))
+        time.sleep(0.3)
+        assert write(self.image_path, self.content, mode="wb")
+        self.assertIsNone(index.lookup(self.image_path, "sha256"))
+
+    async def test_hashsums_single_pass(self):
+        algorithms = ["sha256", "sha512", "md5"]
+        expected = {
+            algorithm: hashlib.new(algorithm, self.content).hexdigest()
+            for algorithm in algorithms
+        }
+        # Sequentially and in parallel threads
+        for buffer_size in [4096, 1024 * 1024]:
+            progress = []
+            digests = await hashsums(
+                self.image_path,
+                algorithms,
+                buffer_size=buffer_size,
+                on_progress=lambda done, total: progress.append(done),
+            )
+            self.assertEqual(digests, expected)
+            self.assertEqual(progress[-1], len(self.content))
+
+        digests = await hashsums(
+            self.image_path, ["sha256", "md5"], read_bytes_of_file=1000
+        )
+        self.assertEqual(
+            digests["sha256"], hashlib.sha256(self.content[:1000]).hexdigest()
+        )
+        self.assertEqual(digests["md5"], hashlib.md5(self.content[:1000]).hexdigest())
+
+    async def test_hashsums_only_calculate_missing_digests(self):
+        index = DigestIndex(path=self.index_path, racy_window=0)
+        index.record(self.image_path, "sha256", FAKE_DIGEST)
+        digests = await hashsums(
+            self.image_path, ["sha256", "sha512"], digest_index=index
+        )
+        self.assertEqual(digests["sha256"], FAKE_DIGEST)
+        self.assertEqual(digests["sha512"], hashlib.sha512(self.content).hexdigest())
+        self.assertEqual(index.lookup(self.image_path, "sha512"), digests["sha512"])
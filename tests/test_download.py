@@ -0,0 +1,206 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import gzip
+import os
+import random
+import threading
+import time
+import unittest
+
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove
+from gen_vm_image.utils.net import download_file, new_session
+
+from .http_server import LocalHTTPServer, QuietHandler
+
+BODY = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class DownloadHandler(QuietHandler):
+    # The client ports of the connections that requests were received on
+    client_ports = []
+
+    def do_GET(self):
+        self.client_ports.append(self.client_address[1])
+        if self.path == "/image":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+        elif self.path == "/chunked":
+            # No Content-Length, the body is sent with the chunked encoding
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for offset in range(0, len(BODY), 100000):
+                chunk = BODY[offset : offset + 100000]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/gzip":
+            compressed = gzip.compress(BODY)
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(compressed)))
+            self.end_headers()
+            self.wfile.write(compressed)
+        elif self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(BODY[:1000])
+            self.close_connection = True
+        elif self.path == "/slow":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            try:
+                for offset in range(0, len(BODY), 1024):
+                    self.wfile.write(BODY[offset : offset + 1024])
+                    time.sleep(0.01)
+            except ConnectionError:
+                self.close_connection = True
+        else:
+            self.send_error(404)
+
+
+class TestDownload(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalHTTPServer(DownloadHandler)
+        cls.url = cls.server.url
+
+        cls.seed = str(random.random())[2:10]
+        cls.tmp_dir = os.path.realpath(join("tests", "tmp", "download", cls.seed))
+        if not exists(cls.tmp_dir):
+            assert makedirs(cls.tmp_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        if exists(cls.tmp_dir):
+            assert remove(cls.tmp_dir, recursive=True)
+
+    async def test_download_content_length(self):
+        output_path = join(self.tmp_dir, "image")
+        progress = []
+        downloaded, response = await download_file(
+            "{}/image".format(self.url),
+            output_path,
+            on_progress=lambda done, total: progress.append((done, total)),
+        )
+        self.assertTrue(downloaded)
+        self.assertEqual(response["download_size"], len(BODY))
+        self.assertEqual(load(output_path, mode="rb"), BODY)
+        self.assertEqual(progress[-1], (len(BODY), len(BODY)))
+
+    async def test_download_chunked(self):
+        output_path = join(self.tmp_dir, "chunked")
+        progress = []
+        downloaded, response = await download_file(
+            "{}/chunked".format(self.url),
+            output_path,
+            chunk_size=4096,
+            on_progress=lambda done, total: progress.append((done, total)),
+        )
+        self.assertTrue(downloaded)
+        self.assertEqual(load(output_path, mode="rb"), BODY)
+        self.assertEqual(progress[-1], (len(BODY), None))
+
+    async def test_download_content_encoding(self):
+        output_path = join(self.tmp_dir, "gzip")
+        downloaded, _ = await download_file("{}/gzip".format(self.url), output_path)
+        self.assertTrue(downloaded)
+        self.assertEqual(load(output_path, mode="rb"), BODY)
+
+    async def test_download_progress_is_throttled(self):
+        output_path = join(self.tmp_dir, "throttled")
+        progress = []
+        downloaded, _ = await download_file(
+            "{}/image".format(self.url),
+            output_path,
+            chunk_size=1024,
+            max_chunk_size=1024,
+            progress_interval=3600,
+            on_progress=lambda done, total: progress.append(done),
+        )
+        self.assertTrue(downloaded)
+        # Only the final progress is reported
+        self.assertEqual(progress, [len(BODY)])
+
+    async def test_download_session_reuses_connection(self):
+        session = new_session(pool_size=2)
+        try:
+            DownloadHandler.client_ports.clear()
+            for index in range(3):
+                downloaded, _ = await download_file(
+                    "{}/image".format(self.url),
+                    join(self.tmp_dir, "session-{}".format(index)),
+                    session=session,
+                )
+                self.assertTrue(downloaded)
+        finally:
+            session.close()
+        self.assertEqual(len(DownloadHandler.client_ports), 3)
+        self.assertEqual(len(set(DownloadHandler.client_ports)), 1)
+
+    def test_new_session(self):
+        session = new_session(
+            proxy="http://proxy.example.com:3128", ca_bundle="/path/to/ca.pem"
+        )
+        try:
+            self.assertEqual(
+                session.proxies,
+                {
+                    "http": "http://proxy.example.com:3128",
+                    "https": "http://proxy.example.com:3128",
+                },
+            )
+            self.assertEqual(session.verify, "/path/to/ca.pem")
+        finally:
+            session.close()
+
+    async def test_download_failures_leave_no_file(self):
+        for path in ["missing", "truncated"]:
+            output_path = join(self.tmp_dir, path)
+            downloaded, response = await download_file(
+                "{}/{}".format(self.url, path), output_path
+            )
+            self.assertFalse(downloaded)
+            self.assertIn("msg", response)
+            self.assertFalse(exists(output_path))
+            self.assertFalse(exists("{}.partial".format(output_path)))
+
+    async def test_download_cancelled(self):
+        output_path = join(self.tmp_dir, "cancelled")
+        cancel_event = threading.Event()
+        asyncio.get_running_loop().call_later(0.2, cancel_event.set)
+        started = time.monotonic()
+        # The partial file is removed even though it would otherwise be kept
+        downloaded, response = await download_file(
+            "{}/slow".format(self.url),
+            output_path,
+            chunk_size=1024,
+            max_chunk_size=1024,
+            keep_partial=True,
+            cancel_event=cancel_event,
+        )
+        self.assertFalse(downloaded)
+        self.assertFalse(response["retryable"])
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertFalse(exists(output_path))
+        self.assertFalse(exists("{}.partial".format(output_path)))
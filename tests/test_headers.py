@@ -0,0 +1,285 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import lzma
+import os
+import random
+import struct
+import unittest
+
+from gen_vm_image.common.codes import SUCCESS
+from gen_vm_image.common.defaults import TMP_DIR
+from gen_vm_image.image import (
+    decompressed_input_path,
+    detect_image_format,
+    input_cache_path,
+    prepare_input,
+)
+from gen_vm_image.utils.headers import (
+    QCOW2_MAGIC,
+    QED_F_BACKING_FILE,
+    QED_MAGIC,
+    VDI_SIGNATURE,
+    VHDX_FILE_PARAMETERS,
+    VHDX_HAS_PARENT,
+    VHDX_METADATA_REGION,
+    VHDX_REGION_TABLE_OFFSET,
+    VHDX_VIRTUAL_DISK_SIZE,
+    VMDK_SPARSE_MAGIC,
+    read_image_header,
+)
+from gen_vm_image.utils.io import (
+    STAGING_FILE,
+    exists,
+    join,
+    load,
+    makedirs,
+    remove,
+    write,
+)
+from gen_vm_image.utils.scheduler import ResourceScheduler
+
+GiB = 1024 * 1024 * 1024
+
+
+def qcow2_image(size, cluster_bits=16, backing_file=None):
+    header = bytearray(1024)
+    header[0:4] = QCOW2_MAGIC
+    backing_file_offset = 0
+    if backing_file:
+        backing_file_offset = 512
+        header[512 : 512 + len(backing_file)] = backing_file.encode()
+    struct.pack_into(
+        ">IQIIQ",
+        header,
+        4,
+        3,
+        backing_file_offset,
+        len(backing_file or ""),
+        cluster_bits,
+        size,
+    )
+    return bytes(header)
+
+
+def qed_image(size, backing_file=None):
+    header = bytearray(1024)
+    header[0:4] = QED_MAGIC
+    features = QED_F_BACKING_FILE if backing_file else 0
+    struct.pack_into(
+        "<IIIQQQQQII",
+        header,
+        4,
+        64 * 1024,
+        16,
+        1,
+        features,
+        0,
+        0,
+        4096,
+        size,
+        512,
+        len(backing_file or ""),
+    )
+    if backing_file:
+        header[512 : 512 + len(backing_file)] = backing_file.encode()
+    return bytes(header)
+
+
+def vmdk_image(size, parent=None):
+    descriptor = '# Disk DescriptorFile\ncreateType="monolithicSparse"\n'
+    if parent:
+        descriptor += 'parentFileNameHint="{}"\n'.format(parent)
+    header = bytearray(2048)
+    header[0:4] = VMDK_SPARSE_MAGIC
+    struct.pack_into("<IIQQQQ", header, 4, 1, 3, size // 512, 128, 1, 2)
+    header[512 : 512 + len(descriptor)] = descriptor.encode()
+    return bytes(header)
+
+
+def vdi_image(size, image_type=1):
+    header = bytearray(512)
+    header[0:64] = b"<<< Oracle VM VirtualBox Disk Image >>>\n".ljust(64, b"\x00")
+    struct.pack_into("<IIII", header, 64, VDI_SIGNATURE, 0x00010001, 400, image_type)
+    struct.pack_into("<QI", header, 368, size, 1024 * 1024)
+    return bytes(header)
+
+
+def vhdx_image(size, has_parent=False):
+    metadata_offset = VHDX_REGION_TABLE_OFFSET + 64 * 1024
+    image = bytearray(metadata_offset + 64 * 1024)
+    image[0:8] = b"vhdxfile"
+    region_table = bytearray(b"regi") + struct.pack("<III", 0, 1, 0)
+    region_table += VHDX_METADATA_REGION + struct.pack(
+        "<QII", metadata_offset, 64 * 1024, 1
+    )
+    image[VHDX_REGION_TABLE_OFFSET : VHDX_REGION_TABLE_OFFSET + len(region_table)] = (
+        region_table
+    )
+    table = bytearray(b"metadata") + struct.pack("<HH", 0, 2) + bytes(20)
+    table += VHDX_FILE_PARAMETERS + struct.pack("<IIII", 4096, 8, 0, 0)
+    table += VHDX_VIRTUAL_DISK_SIZE + struct.pack("<IIII", 4104, 8, 0, 0)
+    image[metadata_offset : metadata_offset + len(table)] = table
+    flags = VHDX_HAS_PARENT if has_parent else 0
+    struct.pack_into("<II", image, metadata_offset + 4096, 32 * 1024 * 1024, flags)
+    struct.pack_into("<Q", image, metadata_offset + 4104, size)
+    return bytes(image)
+
+
+class TestImageHeaders(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = join("tests", "tmp", "headers", self.seed)
+        assert makedirs(self.tmp_dir)
+        # The extension is deliberately misleading
+        self.path = join(self.tmp_dir, "image.img")
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    def read(self, content):
+        assert write(self.path, content, mode="wb")
+        return read_image_header(self.path)
+
+    def test_qcow2(self):
+        header = self.read(qcow2_image(10 * GiB))
+        self.assertEqual(header["format"], "qcow2")
+        self.assertEqual(header["virtual_size"], 10 * GiB)
+        self.assertEqual(header["cluster_size"], 64 * 1024)
+        self.assertEqual(header["compat"], "1.1")
+        self.assertIsNone(header["backing_file"])
+
+        header = self.read(qcow2_image(GiB, backing_file="base.qcow2"))
+        self.assertTrue(header["has_backing_file"])
+        self.assertEqual(header["backing_file"], "base.qcow2")
+
+    def test_qed(self):
+        header = self.read(qed_image(5 * GiB, backing_file="base.raw"))
+        self.assertEqual(header["format"], "qed")
+        self.assertEqual(header["virtual_size"], 5 * GiB)
+        self.assertEqual(header["cluster_size"], 64 * 1024)
+        self.assertEqual(header["backing_file"], "base.raw")
+
+    def test_vmdk(self):
+        header = self.read(vmdk_image(2 * GiB, parent="parent.vmdk"))
+        self.assertEqual(header["format"], "vmdk")
+        self.assertEqual(header["virtual_size"], 2 * GiB)
+        self.assertEqual(header["cluster_size"], 64 * 1024)
+        self.assertEqual(header["compat"], "monolithicSparse")
+        self.assertEqual(header["backing_file"], "parent.vmdk")
+
+        descriptor = (
+            "# Disk DescriptorFile\n"
+            'createType="monolithicFlat"\n'
+            'RW 2097152 FLAT "image-flat.vmdk" 0\n'
+        )
+        header = self.read(descriptor.encode())
+        self.assertEqual(header["format"], "vmdk")
+        self.assertEqual(header["virtual_size"], GiB)
+        self.assertFalse(header["has_backing_file"])
+
+    def test_vdi(self):
+        header = self.read(vdi_image(3 * GiB))
+        self.assertEqual(header["format"], "vdi")
+        self.assertEqual(header["virtual_size"], 3 * GiB)
+        self.assertEqual(header["cluster_size"], 1024 * 1024)
+        self.assertEqual(header["compat"], "1.1")
+        self.assertFalse(header["has_backing_file"])
+        self.assertTrue(self.read(vdi_image(GiB, image_type=4))["has_backing_file"])
+
+    def test_vhdx(self):
+        header = self.read(vhdx_image(4 * GiB, has_parent=True))
+        self.assertEqual(header["format"], "vhdx")
+        self.assertEqual(header["virtual_size"], 4 * GiB)
+        self.assertEqual(header["cluster_size"], 32 * 1024 * 1024)
+        self.assertTrue(header["has_backing_file"])
+
+    async def test_detect_image_format(self):
+        assert write(self.path, qcow2_image(GiB), mode="wb")
+        self.assertEqual(await detect_image_format(self.path), "qcow2")
+        # An image without a recognised header is raw
+        assert write(self.path, os.urandom(4096), mode="wb")
+        self.assertIsNone(read_image_header(self.path))
+        self.assertEqual(await detect_image_format(self.path), "raw")
+
+    def test_input_cache_path_ignores_query(self):
+        self.assertEqual(
+            input_cache_path("https://example.org/rocky.x86_64.qcow2?download=1"),
+            join(TMP_DIR, "rocky.x86_64.qcow2"),
+        )
+
+    def test_decompressed_input_path_is_unique(self):
+        path = join(self.tmp_dir, "foo.qcow2.xz")
+        assert write(path, b"compressed", mode="wb")
+        paths = [decompressed_input_path(path, "xz") for _ in range(2)]
+        # Every build decompresses the input into a file of its own
+        self.assertNotEqual(paths[0], paths[1])
+        for decompressed_path in paths:
+            self.assertEqual(os.path.dirname(decompressed_path), TMP_DIR)
+            self.assertTrue(
+                STAGING_FILE.match(os.path.basename(decompressed_path)),
+                decompressed_path,
+            )
+            self.assertIn(".qcow2.", decompressed_path)
+            self.assertNotEqual(
+                decompressed_path, input_cache_path("https://example.org/foo.qcow2")
+            )
+
+    async def test_prepare_input_reports_decompressed_image(self):
+        content = qcow2_image(GiB)
+        path = join(self.tmp_dir, "prepared.qcow2.xz")
+        assert write(path, lzma.compress(content), mode="wb")
+        intermediate_paths = []
+        return_code, response = await prepare_input(
+            path, intermediate_paths=intermediate_paths
+        )
+        try:
+            self.assertEqual(return_code, SUCCESS)
+            self.assertEqual(response["input_format"], "qcow2")
+            self.assertEqual(intermediate_paths, [response["input_path"]])
+            self.assertEqual(load(response["input_path"], mode="rb"), content)
+        finally:
+            for intermediate_path in intermediate_paths:
+                remove(intermediate_path)
+
+    async def test_prepare_input_reserves_decompressed_size(self):
+        content = qcow2_image(GiB) + bytes(1024 * 1024)
+        path = join(self.tmp_dir, "reserved.qcow2.xz")
+        assert write(path, lzma.compress(content), mode="wb")
+
+        reservations = []
+
+        class RecordingScheduler(ResourceScheduler):
+            def reserve(self, path, size):
+                reservations.append((path, size))
+                return super().reserve(path, size)
+
+        intermediate_paths = []
+        return_code, _ = await prepare_input(
+            path,
+            scheduler=RecordingScheduler(),
+            intermediate_paths=intermediate_paths,
+        )
+        try:
+            self.assertEqual(return_code, SUCCESS)
+            self.assertEqual(
+                reservations,
+                [("{}.partial".format(intermediate_paths[0]), len(content))],
+            )
+        finally:
+            for intermediate_path in intermediate_paths:
+                remove(intermediate_path)
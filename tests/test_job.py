@@ -0,0 +1,133 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import os
+import random
+import signal
+import sys
+import time
+import unittest
+
+from gen_vm_image.common.codes import JOB_CANCELLED_ERROR
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove
+from gen_vm_image.utils.job import JobRunner, cancel_event, run_until_signalled
+
+# A command that starts a child, writes the pid of the child to a file
+# and waits for it, such that the test can check whether the child was killed
+PARENT_AND_CHILD = """
+import subprocess, sys, time
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+with open(sys.argv[1], "w") as fh:
+    fh.write(str(child.pid))
+child.wait()
+"""
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        # A killed child that is not reaped yet is a zombie
+        with open("/proc/{}/stat".format(pid)) as fh:
+            return fh.read().split(")")[-1].split()[0] != "Z"
+    except (ProcessLookupError, FileNotFoundError):
+        return False
+
+
+async def exited(pid, timeout=5):
+    """Returns whether pid exits within timeout seconds, since a signal
+    is delivered asynchronously."""
+    deadline = time.monotonic() + timeout
+    while pid_alive(pid):
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+class TestJobRunner(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = join("tests", "tmp", "job", self.seed)
+        assert makedirs(self.tmp_dir)
+        self.pid_path = join(self.tmp_dir, "child.pid")
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    async def child_pid(self):
+        while not exists(self.pid_path) or not load(self.pid_path):
+            await asyncio.sleep(0.05)
+        return int(load(self.pid_path))
+
+    async def test_output_is_bounded(self):
+        runner = JobRunner(output_limit=1024)
+        lines = []
+        result = await runner.run(
+            [sys.executable, "-c", "print('x' * 4096); print('last')"],
+            on_output=lines.append,
+        )
+        self.assertEqual(result["returncode"], 0)
+        self.assertFalse(result["timed_out"])
+        self.assertEqual(len(result["output"]), 1024)
+        self.assertTrue(result["output"].endswith(b"last\n"))
+        self.assertEqual(result["output_truncated"], 4096 + 6 - 1024)
+        self.assertEqual(lines[-1], "last")
+
+    async def test_timeout_kills_process_group(self):
+        runner = JobRunner(timeout=2, kill_timeout=1)
+        job = asyncio.ensure_future(
+            runner.run([sys.executable, "-c", PARENT_AND_CHILD, self.pid_path])
+        )
+        pid = await self.child_pid()
+        result = await job
+        self.assertTrue(result["timed_out"])
+        self.assertNotEqual(result["returncode"], 0)
+        self.assertIn(b"timed out after 2 seconds", result["error"])
+        self.assertTrue(await exited(pid))
+        self.assertFalse(runner.processes)
+
+    async def test_cancel_kills_process_group(self):
+        runner = JobRunner(kill_timeout=1)
+        job = asyncio.ensure_future(
+            runner.run([sys.executable, "-c", PARENT_AND_CHILD, self.pid_path])
+        )
+        pid = await self.child_pid()
+        job.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await job
+        self.assertTrue(await exited(pid))
+        self.assertFalse(runner.processes)
+
+    async def test_max_jobs(self):
+        runner = JobRunner(max_jobs=1)
+        command = [sys.executable, "-c", "import time; time.sleep(0.3)"]
+        started = time.monotonic()
+        await asyncio.gather(runner.run(command), runner.run(command))
+        self.assertGreaterEqual(time.monotonic() - started, 0.6)
+
+    async def test_run_until_signalled(self):
+        async def build():
+            await asyncio.sleep(60)
+
+        self.addCleanup(cancel_event.clear)
+        asyncio.get_running_loop().call_later(0.1, os.kill, os.getpid(), signal.SIGTERM)
+        return_code, response = await run_until_signalled(build())
+        self.assertEqual(return_code, JOB_CANCELLED_ERROR)
+        self.assertEqual(response["signal"], "SIGTERM")
+        # The loops that run in executor threads are told to stop as well
+        self.assertTrue(cancel_event.is_set())
@@ -0,0 +1,143 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+import unittest
+
+from gen_vm_image.common.codes import SUCCESS
+from gen_vm_image.common.defaults import TMP_DIR
+from gen_vm_image.image import prepare_input
+from gen_vm_image.utils.cache import cache_metadata_path
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove
+from gen_vm_image.utils.lock import FileLock, lock_path
+
+from .http_server import LocalHTTPServer, QuietHandler
+
+# Holds the lock of the path in argv[1] until it is killed
+HOLD_LOCK = """
+import fcntl, sys, time
+fh = open(sys.argv[1], "a+")
+fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+print("locked", flush=True)
+time.sleep(60)
+"""
+
+
+class SlowHandler(QuietHandler):
+    body = b""
+    gets = 0
+
+    def do_GET(self):
+        SlowHandler.gets += 1
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        # Send the body slowly such that the download is in-flight for a while
+        half = len(self.body) // 2
+        self.wfile.write(self.body[:half])
+        self.wfile.flush()
+        time.sleep(0.3)
+        self.wfile.write(self.body[half:])
+
+
+class TestFileLock(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = join("tests", "tmp", "lock", self.seed)
+        assert makedirs(self.tmp_dir)
+        self.path = join(self.tmp_dir, "image.qcow2")
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    async def test_lock_is_exclusive(self):
+        first = FileLock(self.path, poll_interval=0.01)
+        second = FileLock(self.path, poll_interval=0.01)
+        self.assertTrue(first.try_acquire())
+        self.assertEqual(first.holder(), os.getpid())
+        self.assertFalse(second.try_acquire())
+        self.assertFalse(await second.acquire_async(timeout=0.05))
+
+        order = []
+
+        async def wait_for_lock():
+            async with second:
+                order.append("second")
+
+        waiter = asyncio.ensure_future(wait_for_lock())
+        await asyncio.sleep(0.05)
+        order.append("first")
+        first.release()
+        await waiter
+        self.assertEqual(order, ["first", "second"])
+        self.assertTrue(second.waited)
+        self.assertFalse(second.locked)
+
+    def test_lock_of_killed_process_is_released(self):
+        process = subprocess.Popen(
+            [sys.executable, "-c", HOLD_LOCK, lock_path(self.path)],
+            stdout=subprocess.PIPE,
+        )
+        try:
+            self.assertEqual(process.stdout.readline().strip(), b"locked")
+            lock = FileLock(self.path, poll_interval=0.01)
+            self.assertFalse(lock.acquire(timeout=0.05))
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+        # The lock is released by the kernel when its holder dies
+        self.assertTrue(lock.acquire(timeout=5))
+        lock.release()
+
+
+class TestSharedDownload(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalHTTPServer(SlowHandler)
+        cls.seed = str(random.random())[2:10]
+        cls.url = "{}/shared-{}.raw".format(cls.server.url, cls.seed)
+        cls.cache_path = join(TMP_DIR, "shared-{}.raw".format(cls.seed))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        for path in [
+            cls.cache_path,
+            cache_metadata_path(cls.cache_path),
+            lock_path(cls.cache_path),
+        ]:
+            if exists(path):
+                remove(path)
+
+    async def test_inflight_download_is_reused(self):
+        SlowHandler.body = os.urandom(256 * 1024)
+        results = await asyncio.gather(
+            *[
+                prepare_input(self.url, input_format="raw", input_cache_ttl=3600)
+                for _ in range(3)
+            ]
+        )
+        for return_code, response in results:
+            self.assertEqual(return_code, SUCCESS, response)
+        self.assertEqual(SlowHandler.gets, 1)
+        self.assertEqual(load(self.cache_path, mode="rb"), SlowHandler.body)
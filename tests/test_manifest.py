@@ -0,0 +1,248 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import hashlib
+import os
+import random
+import unittest
+
+from gen_vm_image.common.codes import CHECKSUM_MANIFEST_ERROR, SUCCESS
+from gen_vm_image.common.defaults import TMP_DIR
+from gen_vm_image.image import prepare_input
+from gen_vm_image.utils.cache import cache_metadata_path
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove, write
+from gen_vm_image.utils.manifest import (
+    ChecksumManifests,
+    OutputManifest,
+    checksum_manifest_path,
+    manifest_checksum,
+    parse_checksum_manifest,
+)
+
+from .http_server import LocalHTTPServer, QuietHandler
+
+SHA256_DIGEST = hashlib.sha256(b"image").hexdigest()
+SHA512_DIGEST = hashlib.sha512(b"image").hexdigest()
+
+
+class ManifestHandler(QuietHandler):
+    files = {}
+    paths = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        body = self.files.get(self.path, None)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestManifest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalHTTPServer(ManifestHandler)
+        cls.url = cls.server.url
+        cls.seed = str(random.random())[2:10]
+        cls.image_name = "manifest-{}.raw".format(cls.seed)
+        cls.image = os.urandom(64 * 1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        ManifestHandler.paths = []
+        self.cleanup_paths = [join(TMP_DIR, self.image_name)]
+
+    def tearDown(self):
+        for path in self.cleanup_paths:
+            for cached_path in [path, cache_metadata_path(path)]:
+                if exists(cached_path):
+                    remove(cached_path)
+
+    def serve_manifest(self, name, content):
+        ManifestHandler.files["/{}".format(name)] = content.encode("utf-8")
+        manifest_url = "{}/{}".format(self.url, name)
+        self.cleanup_paths.append(checksum_manifest_path(manifest_url))
+        return manifest_url
+
+    def test_parse_gnu_manifest(self):
+        entries = parse_checksum_manifest(
+            "{}  image.qcow2\n{} *./other.raw\n# A comment\n".format(
+                SHA256_DIGEST, SHA512_DIGEST.upper()
+            )
+        )
+        self.assertEqual(entries["image.qcow2"], {None: SHA256_DIGEST})
+        self.assertEqual(entries["other.raw"], {None: SHA512_DIGEST})
+        self.assertEqual(
+            manifest_checksum(entries, "image.qcow2", "sha256"), SHA256_DIGEST
+        )
+        # The digest does not have the length of the algorithm
+        self.assertIsNone(manifest_checksum(entries, "image.qcow2", "sha512"))
+        self.assertIsNone(manifest_checksum(entries, "missing.qcow2", "sha256"))
+
+    def test_parse_bsd_manifest(self):
+        entries = parse_checksum_manifest(
+            "# image.qcow2: 1024 bytes\n"
+            "SHA256 (image.qcow2) = {}\n"
+            "SHA512 (image.qcow2) = {}\n".format(SHA256_DIGEST, SHA512_DIGEST)
+        )
+        self.assertEqual(
+            manifest_checksum(entries, "image.qcow2", "sha256"), SHA256_DIGEST
+        )
+        self.assertEqual(
+            manifest_checksum(entries, "image.qcow2", "SHA-512"), SHA512_DIGEST
+        )
+        self.assertIsNone(manifest_checksum(entries, "image.qcow2", "md5"))
+
+    async def test_manifest_is_fetched_once(self):
+        manifest_url = self.serve_manifest(
+            "SHA256SUMS-{}".format(self.seed),
+            "{}  a.qcow2\n{}  b.qcow2\n".format(SHA256_DIGEST, SHA256_DIGEST),
+        )
+        manifests = ChecksumManifests()
+        results = await asyncio.gather(
+            manifests.checksum(manifest_url, "a.qcow2", "sha256"),
+            manifests.checksum(manifest_url, "b.qcow2", "sha256"),
+            manifests.checksum(manifest_url, "c.qcow2", "sha256"),
+        )
+        self.assertEqual([found for found, _ in results], [True, True, False], results)
+        self.assertEqual(results[0][1]["checksum"], SHA256_DIGEST)
+        self.assertEqual(len(ManifestHandler.paths), 1)
+
+    async def test_prepare_input_with_checksum_url(self):
+        ManifestHandler.files["/{}".format(self.image_name)] = self.image
+        manifest_url = self.serve_manifest(
+            "CHECKSUM-{}".format(self.seed),
+            "SHA256 ({}) = {}\n".format(
+                self.image_name, hashlib.sha256(self.image).hexdigest()
+            ),
+        )
+        return_code, response = await prepare_input(
+            "{}/{}".format(self.url, self.image_name),
+            input_format="raw",
+            input_checksum_type="sha256",
+            input_checksum_url=manifest_url,
+        )
+        self.assertEqual(return_code, SUCCESS, response)
+
+        # An image that is not in the manifest is rejected before it is downloaded
+        ManifestHandler.paths = []
+        return_code, response = await prepare_input(
+            "{}/missing-{}.raw".format(self.url, self.seed),
+            input_format="raw",
+            input_checksum_type="sha256",
+            input_checksum_url=manifest_url,
+        )
+        self.assertEqual(return_code, CHECKSUM_MANIFEST_ERROR)
+        self.assertEqual(ManifestHandler.paths, ["/CHECKSUM-{}".format(self.seed)])
+
+
+class TestOutputManifest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.output_directory = join("tests", "tmp", "output-manifest", self.seed)
+        assert makedirs(self.output_directory)
+        self.images = {}
+        for name in ["a.qcow2", "b.qcow2"]:
+            self.write_image(name)
+
+    def tearDown(self):
+        if exists(self.output_directory):
+            assert remove(self.output_directory, recursive=True)
+
+    def write_image(self, name):
+        self.images[name] = os.urandom(64 * 1024)
+        assert write(join(self.output_directory, name), self.images[name], mode="wb")
+
+    def sha256sums(self):
+        return parse_checksum_manifest(load(join(self.output_directory, "SHA256SUMS")))
+
+    async def build(self, names, algorithms=("sha256", "md5")):
+        manifest = OutputManifest(self.output_directory, algorithms)
+        for name in names:
+            manifest.add(join(self.output_directory, name))
+        return await manifest.write()
+
+    async def test_write_manifests(self):
+        written, response = await self.build(["a.qcow2", "b.qcow2"])
+        self.assertTrue(written, response)
+        self.assertEqual(
+            response["output_checksums"]["a.qcow2"]["sha256"],
+            hashlib.sha256(self.images["a.qcow2"]).hexdigest(),
+        )
+        entries = self.sha256sums()
+        self.assertEqual(sorted(entries), ["a.qcow2", "b.qcow2"])
+        for name, content in self.images.items():
+            self.assertEqual(entries[name][None], hashlib.sha256(content).hexdigest())
+        md5sums = parse_checksum_manifest(load(join(self.output_directory, "MD5SUMS")))
+        self.assertEqual(
+            md5sums["b.qcow2"][None], hashlib.md5(self.images["b.qcow2"]).hexdigest()
+        )
+        self.assertTrue(exists(join(self.output_directory, "checksums.json")))
+
+    async def test_manifests_are_updated_incrementally(self):
+        written, _ = await self.build(["a.qcow2", "b.qcow2"])
+        self.assertTrue(written)
+
+        # Only the rebuilt image is added, the unchanged image is kept
+        # and the removed image is dropped from the manifests
+        self.write_image("a.qcow2")
+        self.write_image("c.qcow2")
+        remove(join(self.output_directory, "b.qcow2"))
+        written, response = await self.build(["a.qcow2", "c.qcow2"])
+        self.assertTrue(written, response)
+        entries = self.sha256sums()
+        self.assertEqual(sorted(entries), ["a.qcow2", "c.qcow2"])
+        self.assertEqual(
+            entries["a.qcow2"][None],
+            hashlib.sha256(self.images["a.qcow2"]).hexdigest(),
+        )
+
+        self.write_image("b.qcow2")
+        written, _ = await self.build(["b.qcow2"])
+        self.assertTrue(written)
+        self.assertEqual(sorted(self.sha256sums()), ["a.qcow2", "b.qcow2", "c.qcow2"])
+
+    async def test_dropped_algorithm_manifests_are_removed(self):
+        written, _ = await self.build(["a.qcow2", "b.qcow2"])
+        self.assertTrue(written)
+
+        # The SHA256SUMS would otherwise keep the old checksum of a.qcow2
+        self.write_image("a.qcow2")
+        written, response = await self.build(["a.qcow2"], algorithms=["md5"])
+        self.assertTrue(written, response)
+        self.assertFalse(exists(join(self.output_directory, "SHA256SUMS")))
+        md5sums = parse_checksum_manifest(load(join(self.output_directory, "MD5SUMS")))
+        self.assertEqual(
+            md5sums["a.qcow2"][None], hashlib.md5(self.images["a.qcow2"]).hexdigest()
+        )
+
+    async def test_image_removed_after_hashing(self):
+        manifest = OutputManifest(self.output_directory, ["sha256"])
+        manifest.add(join(self.output_directory, "a.qcow2"))
+        manifest.add(join(self.output_directory, "b.qcow2"))
+        await asyncio.gather(*manifest._tasks.values())
+        remove(join(self.output_directory, "b.qcow2"))
+        written, response = await manifest.write()
+        self.assertFalse(written)
+        self.assertIn("b.qcow2", response["msg"])
+        self.assertEqual(sorted(self.sha256sums()), ["a.qcow2"])
@@ -0,0 +1,162 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import random
+import socket
+import time
+import unittest
+
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove
+from gen_vm_image.utils.mirrors import (
+    MirrorStats,
+    download_from_mirrors,
+    mirror_key,
+    rank_mirrors,
+)
+
+from .http_server import LocalHTTPServer, QuietHandler
+
+BODY = os.urandom(2 * 1024 * 1024)
+
+
+def make_handler(latency=0, fail_after=None):
+    """Returns a handler that serves BODY with support for Range requests,
+    which responds after latency seconds and drops the connection after
+    fail_after bytes of the body if it is set."""
+
+    class MirrorHandler(QuietHandler):
+        ranges = []
+
+        def send_body_headers(self):
+            time.sleep(latency)
+            start = 0
+            byte_range = self.headers.get("Range", None)
+            self.ranges.append(byte_range)
+            if byte_range:
+                start = int(byte_range.split("=")[1].split("-")[0])
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range",
+                    "bytes {}-{}/{}".format(start, len(BODY) - 1, len(BODY)),
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY) - start))
+            self.end_headers()
+            return start
+
+        def do_HEAD(self):
+            self.send_body_headers()
+
+        def do_GET(self):
+            start = self.send_body_headers()
+            if fail_after is not None:
+                self.wfile.write(BODY[start : start + fail_after])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(BODY[start:])
+
+    return MirrorHandler
+
+
+class TestMirrors(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.seed = str(random.random())[2:10]
+        cls.tmp_dir = os.path.realpath(join("tests", "tmp", "mirrors", cls.seed))
+        if not exists(cls.tmp_dir):
+            assert makedirs(cls.tmp_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        if exists(cls.tmp_dir):
+            assert remove(cls.tmp_dir, recursive=True)
+
+    def start_mirror(self, handler):
+        server = LocalHTTPServer(handler)
+        self.addCleanup(server.stop)
+        return "{}/image.raw".format(server.url)
+
+    def unused_url(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        return "http://127.0.0.1:{}/image.raw".format(port)
+
+    def test_rank_mirrors(self):
+        urls = ["http://a/image", "http://b/image", "http://c/image"]
+        probes = [(None, None), (0.2, 1000), (0.1, 1000)]
+        self.assertEqual(rank_mirrors(urls, probes), [urls[2], urls[1], urls[0]])
+
+        # The measured throughput takes precedence over the latency
+        stats = MirrorStats(path=join(self.tmp_dir, "rank-stats.json"))
+        stats.record(urls[1], received=1000, duration=0.1)
+        stats.record(urls[2], received=1000, duration=10)
+        self.assertEqual(
+            rank_mirrors(urls, probes, stats=stats), [urls[1], urls[2], urls[0]]
+        )
+
+    def test_mirror_stats_persist(self):
+        path = join(self.tmp_dir, "persist-stats.json")
+        stats = MirrorStats(path=path)
+        stats.record("http://a:8080/image", latency=0.5)
+        stats.record("http://a:8080/other", received=100, duration=1, failed=True)
+        self.assertTrue(stats.save())
+
+        loaded = MirrorStats(path=path).get("http://a:8080/another")
+        self.assertEqual(mirror_key("http://a:8080/image"), "http://a:8080")
+        self.assertEqual(loaded["latency"], 0.5)
+        self.assertEqual(loaded["throughput"], 100)
+        self.assertEqual(loaded["successes"], 1)
+        self.assertEqual(loaded["failures"], 1)
+
+    async def test_download_skips_unreachable_mirror(self):
+        urls = [self.unused_url(), self.start_mirror(make_handler())]
+        output_path = join(self.tmp_dir, "unreachable.raw")
+        stats = MirrorStats(path=join(self.tmp_dir, "unreachable-stats.json"))
+        downloaded, response = await download_from_mirrors(
+            urls, output_path, stats=stats
+        )
+        self.assertTrue(downloaded)
+        self.assertEqual(response["download_mirrors"], [urls[1]])
+        self.assertIsNone(response["download_probes"][urls[0]])
+        self.assertEqual(load(output_path, mode="rb"), BODY)
+        self.assertEqual(stats.get(urls[0])["failures"], 1)
+        self.assertIn("throughput", stats.get(urls[1]))
+
+    async def test_download_fails_over_mid_transfer(self):
+        failing_handler = make_handler(fail_after=512 * 1024)
+        slow_handler = make_handler(latency=0.3)
+        urls = [self.start_mirror(slow_handler), self.start_mirror(failing_handler)]
+        output_path = join(self.tmp_dir, "failover.raw")
+        downloaded, response = await download_from_mirrors(urls, output_path)
+        self.assertTrue(downloaded, response)
+        # The fastest mirror is used first and the slow one resumes its download
+        self.assertEqual(response["download_mirrors"], [urls[1], urls[0]])
+        self.assertEqual(response["download_resumed_from"], 512 * 1024)
+        self.assertEqual(slow_handler.ranges[-1], "bytes={}-".format(512 * 1024))
+        self.assertEqual(load(output_path, mode="rb"), BODY)
+
+    async def test_download_every_mirror_fails(self):
+        urls = [self.unused_url(), self.unused_url()]
+        output_path = join(self.tmp_dir, "failed.raw")
+        downloaded, response = await download_from_mirrors(urls, output_path)
+        self.assertFalse(downloaded)
+        self.assertIn("msg", response)
+        self.assertFalse(exists(output_path))
+        self.assertFalse(exists("{}.partial".format(output_path)))
@@ -0,0 +1,195 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import random
+import time
+import unittest
+
+import yaml
+
+from gen_vm_image.architecture import build_architecture, plan_architecture
+from gen_vm_image.common.codes import PATH_NOT_FOUND_ERROR, SUCCESS
+from gen_vm_image.common.defaults import (
+    PLAN_IMAGE_BUILD,
+    PLAN_IMAGE_SKIP,
+    PLAN_INPUT_CACHED,
+    PLAN_INPUT_DOWNLOAD,
+    PLAN_INPUT_LOCAL,
+    TMP_DIR,
+)
+from gen_vm_image.utils.cache import (
+    cache_metadata_path,
+    load_cache_metadata,
+    save_cache_metadata,
+)
+from gen_vm_image.utils.io import exists, join, makedirs, remove, write
+
+from .http_server import LocalHTTPServer, QuietHandler
+
+
+class ImageHandler(QuietHandler):
+    body = b""
+    # The method of each request
+    requests = []
+
+    def do_HEAD(self):
+        self.requests.append(self.command)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.do_HEAD()
+        self.wfile.write(self.body)
+
+
+class TestPlan(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalHTTPServer(ImageHandler)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        ImageHandler.body = os.urandom(64 * 1024)
+        ImageHandler.requests = []
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = join("tests", "tmp", "plan", self.seed)
+        self.output_directory = join(self.tmp_dir, "output")
+        assert makedirs(self.output_directory)
+        self.url = "{}/plan-{}.qcow2".format(self.server.url, self.seed)
+        self.cache_path = join(TMP_DIR, "plan-{}.qcow2".format(self.seed))
+        self.local_path = join(self.tmp_dir, "local.raw")
+        assert write(self.local_path, os.urandom(32 * 1024), mode="wb")
+        # An image that was built by an earlier build
+        assert write(join(self.output_directory, "existing.qcow2"), b"", mode="wb")
+        self.architecture_path = join(self.tmp_dir, "architecture.yml")
+        self.write_architecture(
+            {
+                "blank": {"name": "blank", "size": "1G", "format": "raw"},
+                "remote": {"name": "remote", "size": "2G", "input": {"url": self.url}},
+                "local": {
+                    "name": "local",
+                    "size": "3G",
+                    "input": {"path": self.local_path, "format": "raw"},
+                },
+                "existing": {"name": "existing", "size": "4G"},
+            }
+        )
+
+    def tearDown(self):
+        for path in [self.cache_path, cache_metadata_path(self.cache_path)]:
+            if exists(path):
+                remove(path)
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    def write_architecture(self, images):
+        assert write(
+            self.architecture_path,
+            yaml.safe_dump({"owner": "plan", "images": images}),
+        )
+
+    async def test_plan_does_not_build(self):
+        return_code, response = await build_architecture(
+            self.architecture_path,
+            output_directory=self.output_directory,
+            plan=True,
+        )
+        self.assertEqual(return_code, SUCCESS, response)
+        plan = response["plan"]
+        images = {image["name"]: image for image in plan["images"]}
+        self.assertEqual(images["existing"]["action"], PLAN_IMAGE_SKIP)
+        self.assertEqual(images["existing"]["estimated_size"], 0)
+        self.assertEqual(images["blank"]["action"], PLAN_IMAGE_BUILD)
+        self.assertEqual(images["blank"]["operations"], ["create"])
+        self.assertEqual(
+            images["remote"]["operations"], ["download", "convert", "resize"]
+        )
+        self.assertEqual(images["local"]["operations"], ["convert", "resize"])
+        for name in ["blank", "remote", "local"]:
+            self.assertGreater(images[name]["estimated_size"], 0)
+
+        inputs = {input_plan["input"]: input_plan for input_plan in plan["inputs"]}
+        self.assertEqual(inputs[PLAN_INPUT_DOWNLOAD]["source"], self.url)
+        self.assertEqual(
+            inputs[PLAN_INPUT_DOWNLOAD]["download_size"], len(ImageHandler.body)
+        )
+        self.assertEqual(inputs[PLAN_INPUT_LOCAL]["download_size"], 0)
+
+        capacity = plan["capacity"]
+        self.assertEqual(capacity["download_bytes"], len(ImageHandler.body))
+        self.assertEqual(
+            capacity["output_bytes"],
+            sum(image["estimated_size"] for image in plan["images"]),
+        )
+        self.assertTrue(capacity["filesystems"])
+        for filesystem in capacity["filesystems"]:
+            self.assertIn("free", filesystem)
+            self.assertIn("fits", filesystem)
+
+        # Nothing was downloaded or written
+        self.assertEqual(ImageHandler.requests, ["HEAD"])
+        self.assertFalse(exists(self.cache_path))
+        self.assertEqual(os.listdir(self.output_directory), ["existing.qcow2"])
+
+    async def test_cached_input_is_not_downloaded(self):
+        if not exists(TMP_DIR):
+            assert makedirs(TMP_DIR)
+        assert write(self.cache_path, ImageHandler.body, mode="wb")
+        metadata = {
+            "url": self.url,
+            "etag": None,
+            "last_modified": None,
+            "size": len(ImageHandler.body),
+            "validated": time.time() - 60,
+        }
+        assert save_cache_metadata(self.cache_path, metadata)
+        self.write_architecture(
+            {
+                "remote": {
+                    "name": "remote",
+                    "size": "2G",
+                    "input": {"url": self.url, "cache_ttl": 0},
+                }
+            }
+        )
+        return_code, response = await plan_architecture(
+            self.architecture_path, output_directory=self.output_directory
+        )
+        self.assertEqual(return_code, SUCCESS, response)
+        input_plan = response["plan"]["inputs"][0]
+        self.assertEqual(input_plan["input"], PLAN_INPUT_CACHED)
+        self.assertEqual(response["plan"]["capacity"]["download_bytes"], 0)
+        self.assertEqual(response["plan"]["images"][0]["operations"][0], "convert")
+        # The cache was revalidated without updating its metadata
+        self.assertEqual(ImageHandler.requests, ["HEAD"])
+        self.assertEqual(load_cache_metadata(self.cache_path), metadata)
+
+    async def test_missing_input(self):
+        missing_path = join(self.tmp_dir, "missing.raw")
+        self.write_architecture(
+            {"missing": {"name": "missing", "size": "1G", "input": missing_path}}
+        )
+        return_code, response = await plan_architecture(
+            self.architecture_path, output_directory=self.output_directory
+        )
+        self.assertEqual(return_code, PATH_NOT_FOUND_ERROR)
+        self.assertIn(missing_path, response["msg"])
+        self.assertEqual(response["plan"]["images"][0]["action"], PLAN_IMAGE_BUILD)
@@ -0,0 +1,104 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import json
+import os
+import sys
+import unittest
+
+from gen_vm_image.utils.job import (
+    JobRunner,
+    job_runner,
+    priority_verbose_outputs,
+    run_in_worker,
+    set_job_priority,
+)
+from gen_vm_image.utils.priority import (
+    effective_priority,
+    new_process_priority,
+    parse_cpu_list,
+)
+
+# A command that prints the priority that it runs with
+PRINT_PRIORITY = """
+import json
+from gen_vm_image.utils.priority import effective_priority
+print(json.dumps(effective_priority()))
+"""
+
+
+class TestProcessPriority(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cpu = min(os.sched_getaffinity(0))
+        created, response = new_process_priority(
+            nice=min(os.getpriority(os.PRIO_PROCESS, 0) + 5, 19),
+            io_class="idle",
+            cpu_affinity=[self.cpu],
+        )
+        assert created, response
+        self.priority = response["priority"]
+
+    def tearDown(self):
+        set_job_priority(None)
+
+    def assert_priority(self, effective):
+        self.assertEqual(effective["nice"], self.priority.nice)
+        self.assertEqual(effective["io_class"], "idle")
+        self.assertEqual(effective["cpu_affinity"], [self.cpu])
+
+    def test_validation(self):
+        self.assertEqual(parse_cpu_list("0-3,6"), {0, 1, 2, 3, 6})
+        self.assertEqual(parse_cpu_list([1, 2]), {1, 2})
+        for cpus in ["", "a", "3-1", "1,,2", [], [-1], [True]]:
+            self.assertIsNone(parse_cpu_list(cpus))
+
+        for settings in [
+            {"nice": 20},
+            {"nice": "10"},
+            {"io_class": "fast"},
+            {"io_priority": 8},
+            {"cpu_affinity": "0-"},
+        ]:
+            created, response = new_process_priority(**settings)
+            self.assertFalse(created, settings)
+            self.assertIn("Invalid attribute type", response["msg"])
+        created, response = new_process_priority()
+        self.assertTrue(created)
+        self.assertFalse(response["priority"])
+
+    async def test_command_priority(self):
+        runner = JobRunner(priority=self.priority)
+        result = await runner.run([sys.executable, "-c", PRINT_PRIORITY])
+        self.assertEqual(result["returncode"], 0, result["error"])
+        self.assert_priority(json.loads(result["output"]))
+        self.assertEqual(self.priority.effective["errors"], [])
+        # The priority of the builds themselves is unchanged
+        self.assertNotEqual(effective_priority()["io_class"], "idle")
+
+    async def test_worker_priority(self):
+        set_job_priority(self.priority)
+        self.assertIs(job_runner.priority, self.priority)
+        self.assert_priority(await run_in_worker(effective_priority))
+        self.assertNotEqual(effective_priority()["io_class"], "idle")
+        outputs = priority_verbose_outputs()
+        self.assertEqual(len(outputs), 2)
+        self.assertIn("'io_class': 'idle'", outputs[1])
+
+        set_job_priority(None)
+        self.assertEqual(priority_verbose_outputs(), [])
+        self.assertNotEqual(
+            (await run_in_worker(effective_priority))["io_class"], "idle"
+        )
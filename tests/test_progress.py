@@ -0,0 +1,100 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import json
+import os
+import sys
+import unittest
+
+from gen_vm_image.utils.job import run_streaming_async
+from gen_vm_image.utils.progress import (
+    IMAGE_COMPLETE,
+    PROGRESS,
+    STAGE_END,
+    STAGE_START,
+    ProgressReporter,
+    new_progress_reporter,
+)
+
+
+class TestProgress(unittest.IsolatedAsyncioTestCase):
+    def test_stage_events(self):
+        events = []
+        progress = ProgressReporter(events.append, interval=0).bind(image="test")
+        with progress.stage("download", total=100) as outcome:
+            progress.update("download", 50)
+            outcome["success"] = False
+        progress.emit(IMAGE_COMPLETE, return_code=0)
+
+        self.assertEqual(
+            [event["event"] for event in events],
+            [STAGE_START, PROGRESS, STAGE_END, IMAGE_COMPLETE],
+        )
+        self.assertTrue(all(event["image"] == "test" for event in events))
+        self.assertEqual(events[1]["percent"], 50)
+        self.assertEqual(events[1]["total"], 100)
+        self.assertIn("eta", events[1])
+        self.assertFalse(events[2]["success"])
+
+    def test_stage_exception(self):
+        events = []
+        progress = ProgressReporter(events.append)
+        with self.assertRaises(RuntimeError):
+            with progress.stage("checksum"):
+                raise RuntimeError("failed")
+        self.assertFalse(events[-1]["success"])
+
+    def test_rate_limit(self):
+        events = []
+        progress = ProgressReporter(events.append, interval=3600)
+        progress.start("download")
+        for done in range(1000):
+            progress.update("download", done)
+        self.assertEqual(events, [])
+
+        progress.update("download", 1000, force=True)
+        self.assertEqual(len(events), 1)
+        self.assertNotIn("percent", events[0])
+
+    def test_new_progress_reporter(self):
+        self.assertIsNone(new_progress_reporter(None))
+        self.assertIsNone(new_progress_reporter("none"))
+        with self.assertRaises(ValueError):
+            new_progress_reporter("unknown")
+
+        read_fd, write_fd = os.pipe()
+        try:
+            progress = new_progress_reporter("ndjson", progress_fd=write_fd)
+            progress.emit(STAGE_START, stage="convert")
+            event = json.loads(os.read(read_fd, 4096).decode("utf-8"))
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        self.assertEqual(event["event"], STAGE_START)
+        self.assertEqual(event["stage"], "convert")
+
+    async def test_run_streaming(self):
+        lines = []
+        result = await run_streaming_async(
+            [
+                sys.executable,
+                "-c",
+                "import sys; sys.stdout.write('(0.00/100%)\\r(50.00/100%)\\rdone\\n')",
+            ],
+            lines.append,
+        )
+        self.assertEqual(result["returncode"], 0)
+        self.assertEqual(lines, ["(0.00/100%)", "(50.00/100%)", "done"])
@@ -0,0 +1,171 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import errno
+import os
+import random
+import unittest
+
+import requests
+
+from gen_vm_image.common.defaults import RETRY_DOWNLOAD
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove
+from gen_vm_image.utils.net import download_file
+from gen_vm_image.utils.retry import (
+    Retrier,
+    RetryPolicy,
+    retried,
+    retryable_error,
+    retryable_qemu_img_error,
+)
+
+from .http_server import LocalHTTPServer, QuietHandler
+
+
+class FlakyHandler(QuietHandler):
+    body = b""
+    # The failures that the next requests are answered with, either a status
+    # code or "truncated" for a body that is cut short
+    failures = []
+    requests = 0
+
+    def do_GET(self):
+        FlakyHandler.requests += 1
+        failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, int):
+            self.send_response(failure)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        if failure == "truncated":
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(self.body[: len(self.body) // 2])
+            self.close_connection = True
+            return
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+class TestRetry(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalHTTPServer(FlakyHandler)
+        cls.url = "{}/image.qcow2".format(cls.server.url)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        FlakyHandler.body = os.urandom(256 * 1024)
+        FlakyHandler.failures = []
+        FlakyHandler.requests = 0
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = join("tests", "tmp", "retry", self.seed)
+        assert makedirs(self.tmp_dir)
+        self.output_path = join(self.tmp_dir, "image.qcow2")
+        self.delays = []
+
+        async def sleep(delay):
+            self.delays.append(delay)
+
+        self.sleep = sleep
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    def test_policy_delay(self):
+        policy = RetryPolicy(backoff=1, multiplier=2, max_backoff=5, jitter=0.5)
+        for retry, delay in [(1, 1), (2, 2), (3, 4), (4, 5), (10, 5)]:
+            self.assertLessEqual(policy.delay(retry), delay)
+            self.assertGreaterEqual(policy.delay(retry), delay / 2)
+        # The server may ask for a longer delay, up to max_retry_after
+        policy = RetryPolicy(backoff=1, jitter=0, max_retry_after=30)
+        self.assertEqual(policy.delay(1, retry_after=10), 10)
+        self.assertEqual(policy.delay(1, retry_after=600), 30)
+
+    def test_error_classification(self):
+        def http_error(status_code, headers=None):
+            http_response = requests.Response()
+            http_response.status_code = status_code
+            http_response.headers.update(headers or {})
+            return requests.HTTPError(response=http_response)
+
+        self.assertEqual(
+            retryable_error(http_error(503, {"Retry-After": "7"})), (True, 7.0)
+        )
+        self.assertEqual(retryable_error(http_error(429)), (True, None))
+        self.assertEqual(retryable_error(http_error(404)), (False, None))
+        self.assertTrue(retryable_error(requests.ConnectionError())[0])
+        self.assertFalse(retryable_error(requests.exceptions.SSLError())[0])
+        self.assertTrue(retryable_error(ConnectionResetError(errno.ECONNRESET, ""))[0])
+        self.assertFalse(retryable_error(OSError(errno.ENOSPC, ""))[0])
+
+        self.assertTrue(
+            retryable_qemu_img_error(
+                b'qemu-img: Failed to get "write" lock\n'
+                b"Is another process using the image [image.qcow2]?"
+            )[0]
+        )
+        self.assertFalse(retryable_qemu_img_error(b"Invalid image format")[0])
+
+    async def test_retrier_stops_on_permanent_errors(self):
+        attempts = []
+
+        async def stage(error):
+            attempts.append(error)
+            return False, {"msg": error, "retryable": error == "transient"}
+
+        retrier = Retrier(default_policy={"retries": 3}, sleep=self.sleep)
+        succeeded, _ = await retrier.run("convert", stage, "permanent")
+        self.assertFalse(succeeded)
+        self.assertEqual(len(attempts), 1)
+
+        succeeded, response = await retrier.run("convert", stage, "transient")
+        self.assertFalse(succeeded)
+        self.assertEqual(len(attempts), 1 + 4)
+        self.assertEqual(retrier.counts, {"convert": 3})
+        self.assertEqual(len(self.delays), 3)
+        self.assertEqual([retry["retry"] for retry in retrier.retries], [1, 2, 3])
+
+    async def test_download_is_retried(self):
+        FlakyHandler.failures = [503, "truncated"]
+        retrier = Retrier(
+            policies={RETRY_DOWNLOAD: {"retries": 2, "backoff": 0}}, sleep=self.sleep
+        )
+        downloaded, response = await retried(
+            retrier, RETRY_DOWNLOAD, download_file, self.url, self.output_path
+        )
+        self.assertTrue(downloaded, response)
+        self.assertEqual(FlakyHandler.requests, 3)
+        self.assertEqual(retrier.counts, {RETRY_DOWNLOAD: 2})
+        self.assertEqual(load(self.output_path, mode="rb"), FlakyHandler.body)
+
+    async def test_client_errors_are_not_retried(self):
+        FlakyHandler.failures = [404]
+        retrier = Retrier(sleep=self.sleep)
+        downloaded, response = await retried(
+            retrier, RETRY_DOWNLOAD, download_file, self.url, self.output_path
+        )
+        self.assertFalse(downloaded)
+        self.assertFalse(response["retryable"])
+        self.assertEqual(FlakyHandler.requests, 1)
+        self.assertEqual(retrier.counts, {})
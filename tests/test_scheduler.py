@@ -0,0 +1,90 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import os
+import random
+import unittest
+
+from gen_vm_image.common.defaults import SCHEDULER_CONVERT, SCHEDULER_NETWORK
+from gen_vm_image.utils.io import exists, join, makedirs, remove
+from gen_vm_image.utils.scheduler import ResourceScheduler, free_space, scheduled
+
+
+class TestResourceScheduler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = os.path.realpath(join("tests", "tmp", "scheduler", self.seed))
+        if not exists(self.tmp_dir):
+            assert makedirs(self.tmp_dir)
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    async def test_slots_are_limited_per_kind(self):
+        scheduler = ResourceScheduler(network_jobs=2, convert_jobs=1)
+        running = {SCHEDULER_NETWORK: 0, SCHEDULER_CONVERT: 0}
+        peaks = dict(running)
+
+        async def job(kind):
+            async with scheduled(scheduler, kind):
+                running[kind] += 1
+                peaks[kind] = max(peaks[kind], running[kind])
+                await asyncio.sleep(0.01)
+                running[kind] -= 1
+
+        await asyncio.gather(
+            *[job(SCHEDULER_NETWORK) for _ in range(5)],
+            *[job(SCHEDULER_CONVERT) for _ in range(3)],
+        )
+        self.assertEqual(peaks, {SCHEDULER_NETWORK: 2, SCHEDULER_CONVERT: 1})
+
+        # Without a scheduler the stages are not limited
+        async with scheduled(None, SCHEDULER_CONVERT):
+            pass
+
+    async def test_reservation_is_delayed_until_space_is_released(self):
+        # Half of the free space can only be reserved once at a time
+        size = free_space(self.tmp_dir) // 2 + 1
+        scheduler = ResourceScheduler(disk_space_margin=0, poll_interval=0.01)
+        order = []
+
+        async def job(name):
+            path = join(self.tmp_dir, "{}.qcow2".format(name))
+            async with scheduler.reserve(path, size):
+                order.append("start-{}".format(name))
+                await asyncio.sleep(0.05)
+                order.append("end-{}".format(name))
+
+        await asyncio.gather(job("first"), job("second"))
+        self.assertEqual(
+            order, ["start-first", "end-first", "start-second", "end-second"]
+        )
+        self.assertEqual(len(scheduler.delays), 1)
+        path, delayed_size, waited = scheduler.delays[0]
+        self.assertEqual(path, join(self.tmp_dir, "second.qcow2"))
+        self.assertEqual(delayed_size, size)
+        self.assertGreater(waited, 0)
+
+    async def test_oversized_reservation_is_admitted_when_idle(self):
+        # A stage is never failed, even if it can't fit on an idle filesystem
+        scheduler = ResourceScheduler(poll_interval=0.01)
+        size = free_space(self.tmp_dir) * 2
+        path = join(self.tmp_dir, "huge.raw")
+        async with scheduler.reserve(path, size):
+            pass
+        self.assertEqual(scheduler.delays, [])
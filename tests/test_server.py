@@ -0,0 +1,183 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import os
+import random
+import unittest
+
+from gen_vm_image.common.codes import (
+    JOB_CANCELLED_ERROR,
+    JOB_ERROR,
+    PATH_NOT_FOUND_ERROR,
+)
+from gen_vm_image.common.defaults import SINGLE
+from gen_vm_image.server import (
+    CANCELLED,
+    FAILED,
+    QUEUED,
+    BuildServer,
+    client_request,
+)
+from gen_vm_image.utils.io import exists, join, makedirs, remove
+from gen_vm_image.utils.progress import IMAGE_COMPLETE
+
+
+class TestBuildServer(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.seed = str(random.random())[2:10]
+        cls.tmp_dir = os.path.realpath(join("tests", "tmp", "server", cls.seed))
+        if not exists(cls.tmp_dir):
+            assert makedirs(cls.tmp_dir)
+        cls.socket_path = join(cls.tmp_dir, "server.sock")
+
+    @classmethod
+    def tearDownClass(cls):
+        if exists(cls.tmp_dir):
+            assert remove(cls.tmp_dir, recursive=True)
+
+    def missing_input_job(self, name):
+        return {
+            "action": "submit",
+            "kind": SINGLE,
+            "args": [name, "1G"],
+            "kwargs": {
+                "input": join(self.tmp_dir, "missing.qcow2"),
+                "output_directory": self.tmp_dir,
+            },
+        }
+
+    async def test_priority_order(self):
+        server = BuildServer()
+        low = server.submit(SINGLE, args=["low", "1G"], priority=0)
+        high = server.submit(SINGLE, args=["high", "1G"], priority=10)
+        normal = server.submit(SINGLE, args=["normal", "1G"], priority=5)
+        self.assertEqual(server.queued_jobs(), [high, normal, low])
+        self.assertEqual(low.status, QUEUED)
+
+        self.assertTrue(server.cancel(normal.id))
+        self.assertEqual(normal.status, CANCELLED)
+        self.assertEqual(normal.return_code, JOB_CANCELLED_ERROR)
+        self.assertEqual(server.queued_jobs(), [high, low])
+
+    async def test_unknown_kind(self):
+        server = BuildServer()
+        with self.assertRaises(ValueError):
+            server.submit("unknown")
+
+    async def test_invalid_submit(self):
+        server = BuildServer()
+        for invalid in [
+            {"args": "name"},
+            {"kwargs": ["input"]},
+            {"kwargs": {1: "input"}},
+            {"priority": "10"},
+            {"priority": True},
+        ]:
+            with self.assertRaises(ValueError, msg=invalid):
+                server.submit(SINGLE, **invalid)
+        # No job is left behind by the requests that were rejected
+        self.assertEqual(len(server.jobs), 0)
+        self.assertTrue(server.queue.empty())
+
+    async def test_worker_survives_failing_job(self):
+        server = BuildServer()
+        server.start_workers()
+        try:
+            broken = server.submit(SINGLE, args=["broken", "1G"])
+            # Corrupt the job after it was validated
+            broken.kwargs = None
+            job = server.submit(
+                SINGLE,
+                args=["next", "1G"],
+                kwargs={
+                    "input": join(self.tmp_dir, "missing.qcow2"),
+                    "output_directory": self.tmp_dir,
+                },
+            )
+            await asyncio.wait_for(server.queue.join(), timeout=10)
+            self.assertEqual(broken.status, FAILED)
+            self.assertEqual(broken.return_code, JOB_ERROR)
+            self.assertEqual(job.status, FAILED)
+            self.assertEqual(job.return_code, PATH_NOT_FOUND_ERROR)
+            self.assertFalse(any(worker.done() for worker in server.workers))
+        finally:
+            await server.stop()
+
+    async def test_submit_and_watch(self):
+        server = BuildServer(concurrency=2)
+        await server.start(socket_path=self.socket_path)
+        try:
+            responses = [
+                response
+                async for response in client_request(
+                    dict(self.missing_input_job("watched"), watch=True),
+                    socket_path=self.socket_path,
+                )
+            ]
+            self.assertEqual(responses[0]["status"], "ok")
+            job_id = responses[0]["job"]["id"]
+            events = [response["event"] for response in responses[1:]]
+            self.assertEqual(events, ["queued", "running", IMAGE_COMPLETE, FAILED])
+            self.assertEqual(responses[-1]["return_code"], PATH_NOT_FOUND_ERROR)
+
+            status = [
+                response
+                async for response in client_request(
+                    {"action": "status", "job_id": job_id},
+                    socket_path=self.socket_path,
+                )
+            ]
+            self.assertEqual(len(status), 1)
+            self.assertEqual(status[0]["job"]["status"], FAILED)
+
+            listed = [
+                response
+                async for response in client_request(
+                    {"action": "list"}, socket_path=self.socket_path
+                )
+            ]
+            self.assertIn(job_id, [job["id"] for job in listed[0]["jobs"]])
+        finally:
+            await server.stop()
+
+    async def test_socket_permissions(self):
+        umask = os.umask(0o022)
+        server = BuildServer()
+        try:
+            await server.start(socket_path=self.socket_path)
+            self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+            # The umask of the process is restored once the socket is created
+            self.assertEqual(os.umask(umask), 0o022)
+        finally:
+            os.umask(umask)
+            await server.stop()
+
+    async def test_invalid_request(self):
+        server = BuildServer()
+        await server.start(socket_path=self.socket_path)
+        try:
+            responses = [
+                response
+                async for response in client_request(
+                    {"action": "status", "job_id": "missing"},
+                    socket_path=self.socket_path,
+                )
+            ]
+            self.assertEqual(responses[0]["status"], "error")
+        finally:
+            await server.stop()
@@ -0,0 +1,161 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import hashlib
+import json
+import random
+import unittest
+
+from gen_vm_image.architecture import (
+    build_architecture,
+    group_images_by_input,
+    load_architecture,
+    validate_architecture,
+)
+from gen_vm_image.common.codes import MERGE_ERROR, SHARD_ERROR, SUCCESS
+from gen_vm_image.shard import (
+    merge_shard_reports,
+    parse_shard,
+    plan_shards,
+    shard_weight,
+    write_shard_report,
+)
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove
+from gen_vm_image.utils.manifest import parse_checksum_manifest
+
+SHA256_DIGEST = hashlib.sha256(b"image").hexdigest()
+
+
+def shard_names(shards):
+    return [
+        sorted(build_data["name"] for group in groups for build_data in group)
+        for groups in shards
+    ]
+
+
+class TestShard(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = join("tests", "tmp", "shard", self.seed)
+        assert makedirs(self.tmp_dir)
+        self.architecture_path = join("tests", "res", "advanced_architecture.yml")
+        loaded, response = load_architecture(self.architecture_path)
+        assert loaded
+        valid, response = validate_architecture(response["architecture"])
+        assert valid
+        self.images = response["architecture"]["images"]
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard("2/3"), (True, {"index": 2, "count": 3}))
+        for shard in ["0/3", "4/3", "3", "a/b", "1/0"]:
+            parsed, response = parse_shard(shard)
+            self.assertFalse(parsed, shard)
+            self.assertIn("msg", response)
+
+    def test_every_image_is_in_one_shard(self):
+        groups = group_images_by_input(self.images)
+        names = sorted(build_data["name"] for build_data in self.images.values())
+        for weighted in [False, True]:
+            shards = shard_names(plan_shards(groups, 3, weighted=weighted))
+            self.assertEqual(len(shards), 3)
+            self.assertEqual(sorted(sum(shards, [])), names)
+            # Images that share an input are built by the same shard
+            shared = [
+                shard
+                for shard in shards
+                if "input-path-image" in shard or "convert_input_image_format" in shard
+            ]
+            self.assertEqual(len(shared), 1)
+
+    def test_hashed_shards_are_stable(self):
+        groups = group_images_by_input(self.images)
+        shards = shard_names(plan_shards(groups, 3))
+        # Adding an image does not move any of the other images
+        added = dict(self.images)
+        added["new"] = {"name": "new-image", "size": "1G", "format": "raw"}
+        added_shards = shard_names(plan_shards(group_images_by_input(added), 3))
+        for shard, added_shard in zip(shards, added_shards):
+            self.assertEqual(
+                shard, [name for name in added_shard if name != "new-image"]
+            )
+
+    def test_weighted_shards_are_balanced(self):
+        groups = [
+            [{"name": "image-{}".format(index), "size": "{}G".format(size)}]
+            for index, size in enumerate([10, 10, 20, 20, 30, 30])
+        ]
+        weights = [
+            sum(shard_weight(group) for group in shard)
+            for shard in plan_shards(groups, 3, weighted=True)
+        ]
+        self.assertEqual(len(set(weights)), 1)
+
+    async def test_list_shards(self):
+        return_code, response = await build_architecture(
+            self.architecture_path, list_shards=2
+        )
+        self.assertEqual(return_code, SUCCESS, response)
+        self.assertEqual(
+            [shard["shard"] for shard in response["shards"]], ["1/2", "2/2"]
+        )
+
+        return_code, response = await build_architecture(
+            self.architecture_path, shard="3/2"
+        )
+        self.assertEqual(return_code, SHARD_ERROR)
+
+    def test_merge_shard_reports(self):
+        report_paths = []
+        for index in [1, 2]:
+            report_path = join(self.tmp_dir, "report-{}.json".format(index))
+            filename = "image-{}.qcow2".format(index)
+            report = {
+                "architecture": self.architecture_path,
+                "shard": "{}/2".format(index),
+                "return_code": SUCCESS,
+                "images": {
+                    filename: {
+                        "name": "image-{}".format(index),
+                        "return_code": SUCCESS,
+                        "size": 5,
+                        "checksums": {"sha256": SHA256_DIGEST},
+                    }
+                },
+            }
+            self.assertTrue(write_shard_report(report_path, report))
+            report_paths.append(report_path)
+
+        output_path = join(self.tmp_dir, "report.json")
+        return_code, response = merge_shard_reports(
+            report_paths, output_path=output_path, output_directory=self.tmp_dir
+        )
+        self.assertEqual(return_code, SUCCESS, response)
+        merged = json.loads(load(output_path))
+        self.assertEqual(merged["shards"], ["1/2", "2/2"])
+        self.assertEqual(sorted(merged["images"]), ["image-1.qcow2", "image-2.qcow2"])
+        entries = parse_checksum_manifest(load(join(self.tmp_dir, "SHA256SUMS")))
+        self.assertEqual(sorted(entries), ["image-1.qcow2", "image-2.qcow2"])
+
+        # A missing shard is reported
+        return_code, response = merge_shard_reports(
+            report_paths[:1], output_directory=self.tmp_dir
+        )
+        self.assertEqual(return_code, MERGE_ERROR)
+        self.assertEqual(response["report"]["missing_shards"], ["2/2"])
@@ -0,0 +1,76 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import random
+import subprocess
+import sys
+import unittest
+
+from gen_vm_image.utils.io import (
+    exists,
+    join,
+    load,
+    makedirs,
+    publish,
+    remove,
+    remove_stale_staging_files,
+    staging_path,
+    write,
+)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+class TestStaging(unittest.TestCase):
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.output_directory = join("tests", "tmp", "staging", self.seed)
+        assert makedirs(self.output_directory)
+        self.image_path = join(self.output_directory, "image.qcow2")
+
+    def tearDown(self):
+        if exists(self.output_directory):
+            assert remove(self.output_directory, recursive=True)
+
+    def test_publish_staged_file(self):
+        staged_path = staging_path(self.image_path)
+        self.assertEqual(os.path.dirname(staged_path), self.output_directory)
+        self.assertTrue(os.path.basename(staged_path).startswith("."))
+        assert write(self.image_path, "old")
+        assert write(staged_path, "new")
+        self.assertTrue(publish(staged_path, self.image_path))
+        self.assertEqual(load(self.image_path), "new")
+        self.assertFalse(exists(staged_path))
+
+    def test_remove_stale_staging_files(self):
+        stale_path = join(
+            self.output_directory, ".image.qcow2.{}.staging".format(dead_pid())
+        )
+        active_path = staging_path(self.image_path)
+        for path in [stale_path, active_path, self.image_path]:
+            assert write(path, "")
+
+        self.assertEqual(
+            remove_stale_staging_files(self.output_directory), [stale_path]
+        )
+        self.assertFalse(exists(stale_path))
+        self.assertTrue(exists(active_path))
+        self.assertTrue(exists(self.image_path))
@@ -0,0 +1,151 @@
+# Copyright (C) 2025  The gen-vm-image Project by the Science HPC Center at UCPH
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import asyncio
+import os
+import random
+import time
+import unittest
+
+from gen_vm_image.common.codes import INVALID_ATTRIBUTE_TYPE_ERROR, SUCCESS
+from gen_vm_image.image import generate_image
+from gen_vm_image.utils.io import exists, join, load, makedirs, remove, write
+from gen_vm_image.utils.net import download_file
+from gen_vm_image.utils.throttle import (
+    TokenBucket,
+    new_bandwidth,
+    parse_bandwidth,
+)
+
+from .http_server import LocalHTTPServer, QuietHandler
+
+MiB = 1024 * 1024
+
+
+class ImageHandler(QuietHandler):
+    body = b""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+class TestThrottle(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        ImageHandler.body = os.urandom(4 * MiB)
+        cls.server = LocalHTTPServer(ImageHandler)
+        cls.url = "{}/image.qcow2".format(cls.server.url)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.seed = str(random.random())[2:10]
+        self.tmp_dir = join("tests", "tmp", "throttle", self.seed)
+        assert makedirs(self.tmp_dir)
+
+    def tearDown(self):
+        if exists(self.tmp_dir):
+            assert remove(self.tmp_dir, recursive=True)
+
+    async def timed_download(self, name, **kwargs):
+        output_path = join(self.tmp_dir, name)
+        started = time.monotonic()
+        downloaded, response = await download_file(self.url, output_path, **kwargs)
+        self.assertTrue(downloaded, response)
+        self.assertEqual(load(output_path, mode="rb"), ImageHandler.body)
+        return time.monotonic() - started
+
+    def test_parse_bandwidth(self):
+        for bandwidth, rate in [
+            (1000, 1000),
+            (2.5, 2.5),
+            ("500K", 500 * 1000),
+            ("10M", 10 * 1000**2),
+            ("10MB/s", 10 * 1000**2),
+            ("50MiB", 50 * MiB),
+            ("1.5gib", 1.5 * 1024**3),
+        ]:
+            self.assertEqual(parse_bandwidth(bandwidth), rate)
+        for bandwidth in [None, True, 0, -1, "", "fast", "10X", "0M", [10]]:
+            self.assertIsNone(parse_bandwidth(bandwidth))
+
+    def test_token_bucket_debt(self):
+        now = [0.0]
+        bucket = TokenBucket(1000, burst=100, clock=lambda: now[0])
+        self.assertEqual(bucket.reserve(100), 0)
+        # The consumers that take more than is available wait in turn
+        self.assertAlmostEqual(bucket.reserve(100), 0.1)
+        self.assertAlmostEqual(bucket.reserve(100), 0.2)
+        now[0] = 0.2
+        self.assertEqual(bucket.reserve(0), 0)
+        # Unused bandwidth is only kept up to the burst
+        now[0] = 10.0
+        self.assertEqual(bucket.reserve(100), 0)
+        self.assertAlmostEqual(bucket.reserve(100), 0.1)
+
+    async def test_download_bandwidth_limit(self):
+        elapsed = await self.timed_download("image.qcow2", bandwidth_limit="2MiB")
+        self.assertAlmostEqual(elapsed, 2.0, delta=2.0 * 0.05)
+
+    async def test_invalid_bandwidth_limit(self):
+        with self.assertRaises(ValueError):
+            new_bandwidth("fast")
+        downloaded, response = await download_file(
+            self.url, join(self.tmp_dir, "image.qcow2"), bandwidth_limit="fast"
+        )
+        self.assertFalse(downloaded)
+        self.assertIn("Invalid attribute type", response["msg"])
+        for limits in [{"input_bandwidth_limit": "fast"}, {"bandwidth_limit": 0}]:
+            return_code, response = await generate_image(
+                "image", "1G", input=self.url, output_directory=self.tmp_dir, **limits
+            )
+            self.assertEqual(return_code, INVALID_ATTRIBUTE_TYPE_ERROR, limits)
+
+    async def test_bandwidth_limits_keep_the_image_name(self):
+        # The existing output image is reused, which reports its path
+        output_path = join(self.tmp_dir, "named-image.qcow2")
+        assert write(output_path, b"image", mode="wb")
+        return_code, response = await generate_image(
+            "named-image",
+            "1G",
+            output_directory=self.tmp_dir,
+            input_bandwidth_limit="10M",
+            bandwidth_limit="10M",
+            verbose=True,
+        )
+        self.assertEqual(return_code, SUCCESS, response)
+        self.assertIn(
+            "The output image: {} already exists".format(output_path),
+            response["verbose_outputs"],
+        )
+        self.assertFalse(exists(join(self.tmp_dir, "bandwidth_limit.qcow2")))
+
+    async def test_downloads_share_bandwidth(self):
+        shared_bandwidth = new_bandwidth("4MiB")
+        started = time.monotonic()
+        elapsed = await asyncio.gather(
+            self.timed_download("first.qcow2", shared_bandwidth=shared_bandwidth),
+            self.timed_download("second.qcow2", shared_bandwidth=shared_bandwidth),
+        )
+        # The 8MiB of both downloads take 2 seconds at the shared 4MiB/s,
+        # and since they share it equally, they finish at the same time
+        self.assertAlmostEqual(time.monotonic() - started, 2.0, delta=2.0 * 0.05)
+        self.assertAlmostEqual(elapsed[0], elapsed[1], delta=2.0 * 0.05)